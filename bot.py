@@ -1,10 +1,24 @@
-import telebot
+import hashlib
 import logging
 import os
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import datetime
+from broadcast import BroadcastEngine
+from callback_router import CallbackRouter
+from catalog_cache import CatalogCache
+from conversation import (
+    BroadcastState, ConversationManager, ProductDraftState, ProductEditState, ProfileEditState,
+    PurchaseState, RegistrationState, State, dump_state, load_state
+)
 from database import DatabaseManager
+from dispatcher import OrderedTeleBot
 from dotenv import load_dotenv
-from functools import wraps
+from expiry import ExpirySweeper
+from functools import partial, wraps
+from keyboards import FrozenKeyboard, KeyboardRegistry
+from telegram_gateway import TelegramGateway, PRIORITY_BROADCAST, PRIORITY_NOTIFICATION, is_flood_error
+from state_store import RedisClient, create_state_store
+from webhook import WebhookServer
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import time
 
@@ -26,40 +40,133 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 ADMIN_SESSION_DURATION = int(os.getenv('ADMIN_SESSION_DURATION', 3600))  # 1 ساعت
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 1800))  # انقضای گفتگوهای نیمه‌تمام (ثانیه)
+PURCHASE_SCREENSHOT_TTL = int(os.getenv('PURCHASE_SCREENSHOT_TTL', 86400))  # مهلت ارسال اسکرین‌شات پرداخت (ثانیه)
+CONVERSATION_MAX_USERS = int(os.getenv('CONVERSATION_MAX_USERS', 100000))  # حداکثر گفتگوهای باز در حافظه
+ADMIN_SESSIONS_MAX = int(os.getenv('ADMIN_SESSIONS_MAX', 1000))  # حداکثر session های ادمین همزمان
+LAST_MESSAGE_TTL = int(os.getenv('LAST_MESSAGE_TTL', 86400))  # نگهداری مرجع آخرین پیام هر کاربر (ثانیه)
+LAST_MESSAGES_MAX = int(os.getenv('LAST_MESSAGES_MAX', 100000))  # حداکثر مرجع‌های آخرین پیام در حافظه
+RENDERED_MESSAGES_TTL = int(os.getenv('RENDERED_MESSAGES_TTL', 86400))  # نگهداری اثر انگشت محتوای پیام‌های ویرایش شده (ثانیه)
+RENDERED_MESSAGES_MAX = int(os.getenv('RENDERED_MESSAGES_MAX', 100000))  # حداکثر اثر انگشت‌های پیام در حافظه
+STATE_SWEEP_INTERVAL = float(os.getenv('STATE_SWEEP_INTERVAL', 60))  # فاصله پاکسازی داده‌های منقضی شده (ثانیه)
+KEYBOARD_CACHE_SIZE = int(os.getenv('KEYBOARD_CACHE_SIZE', 1024))  # حداکثر کیبوردهای پارامتری cache شده
+RENDERED_PAGES_CACHE_SIZE = int(os.getenv('RENDERED_PAGES_CACHE_SIZE', 500))  # حداکثر صفحه‌های محصولات رندر شده (0 = غیرفعال)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()  # memory / mysql / redis
+STATE_CACHE_TTL = float(os.getenv('STATE_CACHE_TTL', 1))  # cache محلی وضعیت‌های مشترک (ثانیه، 0 = غیرفعال)
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', 10000))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = os.getenv('REDIS_KEY_PREFIX', 'heshmatbot:')
+BOT_NUM_THREADS = int(os.getenv('BOT_NUM_THREADS', 4))  # تعداد worker های پردازش آپدیت‌ها
+BOT_UPDATE_QUEUE_SIZE = int(os.getenv('BOT_UPDATE_QUEUE_SIZE', 1000))  # حداکثر آپدیت‌های در انتظار هر worker
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))  # حداکثر پیام در ثانیه (محدودیت تلگرام حدود 30)
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 4))  # تعداد thread های فرستنده همزمان
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))  # فاصله گزارش پیشرفت (ثانیه)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # حداکثر درخواست در ثانیه برای کل ربات
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))  # حداکثر پیام در ثانیه برای هر چت
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))  # حداکثر انفجار پیام برای هر چت
+TELEGRAM_MAX_RETRY_WAIT = float(os.getenv('TELEGRAM_MAX_RETRY_WAIT', 10))  # حداکثر retry_after برای تکرار خودکار
+TELEGRAM_CHAT_WAIT = float(os.getenv('TELEGRAM_CHAT_WAIT', 2))  # حداکثر انتظار پاسخ‌های تعاملی برای سهمیه چت (ثانیه)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # آدرس عمومی (https) ربات؛ خالی یعنی حالت polling
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # در حالت webhook الزامی و یکسان برای تمام پروسه‌ها
+WEBHOOK_SSL_CERT = os.getenv('WEBHOOK_SSL_CERT')  # گواهی (مثلاً self-signed) در صورت نبود reverse proxy
+WEBHOOK_SSL_KEY = os.getenv('WEBHOOK_SSL_KEY')
+
+# دروازه خروجی: تمام درخواست‌های API با محدودیت نرخ و اولویت ارسال می‌شوند
+gateway = TelegramGateway(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retry_wait=TELEGRAM_MAX_RETRY_WAIT,
+    chat_wait=TELEGRAM_CHAT_WAIT
+)
+gateway.install()
 
-# ایجاد نمونه ربات
-bot = telebot.TeleBot(BOT_TOKEN)
+# ایجاد نمونه ربات؛ آپدیت‌های هر چت به ترتیب و چت‌های مختلف به صورت موازی پردازش می‌شوند
+bot = OrderedTeleBot(BOT_TOKEN, workers=BOT_NUM_THREADS, queue_size=BOT_UPDATE_QUEUE_SIZE)
 
 # ایجاد نمونه دیتابیس
 db = DatabaseManager()
 
-# ذخیره وضعیت کاربران و session های ادمین
-user_states = {}
-admin_sessions = {}  # {user_id: {'expires': datetime, 'login_time': datetime}}
-admin_last_messages = {}  # {user_id: {'chat_id': int, 'message_id': int}}
+# جدول مسیریابی callback دکمه‌های inline
+router = CallbackRouter()
+
+# کیبوردهای inline ساخته شده یک باره (همراه JSON آماده)
+keyboards = KeyboardRegistry(cache_size=KEYBOARD_CACHE_SIZE)
+
+# صفحه‌های محصولات رندر شده (متن و کیبورد نهایی) به ازای نسخه کاتالوگ
+rendered_pages = CatalogCache(max_entries=RENDERED_PAGES_CACHE_SIZE, copy_values=False)
+
+# موتور ارسال پیام همگانی در پس‌زمینه
+def send_broadcast_message(chat_id: int, text: str) -> None:
+    """ارسال یک پیام همگانی در پایین‌ترین مسیر اولویت دروازه"""
+    with gateway.lane(PRIORITY_BROADCAST):
+        bot.send_message(chat_id, f"📢 **پیام ادمین:**\n\n{text}", parse_mode='Markdown')
+
+
+broadcast_engine = BroadcastEngine(
+    send_func=send_broadcast_message,
+    iter_recipients=db.iter_segment_user_ids,
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+    progress_interval=BROADCAST_PROGRESS_INTERVAL,
+    store=db
+)
+
+# وضعیت گفتگوی کاربران و session های ادمین
+# در حالت memory وضعیت‌ها در همین پروسه هستند؛ mysql و redis بین چند پروسه ربات مشترک‌اند
+state_redis = RedisClient.from_url(REDIS_URL) if STATE_BACKEND == 'redis' else None
+
+
+def create_store(namespace: str, default_ttl: float, max_size: int, **codec):
+    """ساخت store یک namespace روی STATE_BACKEND"""
+    return create_state_store(
+        STATE_BACKEND, namespace, default_ttl, max_size=max_size, db=db, redis=state_redis,
+        redis_prefix=REDIS_KEY_PREFIX, cache_ttl=STATE_CACHE_TTL, cache_size=STATE_CACHE_SIZE, **codec
+    )
+
+
+conversations = ConversationManager(default_ttl=CONVERSATION_TTL, ttls={
+    'admin_password': 300,
+    'broadcast_city': ADMIN_SESSION_DURATION,
+    'broadcast_text': ADMIN_SESSION_DURATION,
+    'purchase_screenshot': PURCHASE_SCREENSHOT_TTL
+}, store=create_store('conversations', CONVERSATION_TTL, CONVERSATION_MAX_USERS,
+                      dumps=dump_state, loads=load_state))
+admin_sessions = create_store('admin_sessions', ADMIN_SESSION_DURATION, ADMIN_SESSIONS_MAX)  # {user_id: {'expires': epoch, 'login_time': epoch}}
+admin_last_messages = create_store('last_messages', LAST_MESSAGE_TTL, LAST_MESSAGES_MAX)  # {user_id: {'chat_id': int, 'message_id': int}}
+rendered_messages = create_store('rendered_messages', RENDERED_MESSAGES_TTL, RENDERED_MESSAGES_MAX)  # {'chat_id:message_id': [hash متن، hash کیبورد]}
+edit_stats = Counter()  # تعداد ویرایش‌های متن، فقط کیبورد و حذف شده به دلیل بدون تغییر بودن
+
+# نسخه کاتالوگ در backend مشترک تا تغییر محصولات در یک پروسه cache کاتالوگ و صفحه‌های رندر شده
+# پروسه‌های دیگر را هم باطل کند
+if STATE_BACKEND != 'memory':
+    db.catalog.share_version(create_store('catalog', 30 * 86400, 1))
+
+
+# پاکسازی دوره‌ای وضعیت‌ها، session ها و مرجع پیام‌های منقضی شده
+expiry_sweeper = ExpirySweeper({
+    'conversations': conversations,
+    'admin sessions': admin_sessions,
+    'last message refs': admin_last_messages,
+    'rendered messages': rendered_messages
+}, interval=STATE_SWEEP_INTERVAL)
 
 
 def is_admin_session_valid(user_id: int) -> bool:
-    """بررسی اعتبار session ادمین"""
-    if user_id not in admin_sessions:
-        return False
-    
-    session = admin_sessions[user_id]
-    if datetime.now() > session['expires']:
-        # session منقضی شده
-        del admin_sessions[user_id]
-        return False
-    
-    return True
+    """بررسی اعتبار session ادمین (session منقضی شده حذف می‌شود)"""
+    return user_id in admin_sessions
 
 
 def create_admin_session(user_id: int) -> None:
     """ایجاد session ادمین"""
-    expires = datetime.now() + timedelta(seconds=ADMIN_SESSION_DURATION)
-    admin_sessions[user_id] = {
-        'expires': expires,
-        'login_time': datetime.now()
-    }
+    now = time.time()
+    admin_sessions.set(user_id, {
+        'expires': now + ADMIN_SESSION_DURATION,
+        'login_time': now
+    })
     logger.info(f"Admin session created for user {user_id}")
 
 
@@ -81,22 +188,20 @@ def admin_required(func):
     return wrapper
 
 
-def cleanup_expired_sessions():
-    """پاک کردن session های منقضی شده"""
-    current_time = datetime.now()
-    expired_users = [
-        user_id for user_id, session in admin_sessions.items()
-        if current_time > session['expires']
-    ]
-    
-    for user_id in expired_users:
-        del admin_sessions[user_id]
-        logger.info(f"Admin session expired for user {user_id}")
+def admin_callback(func):
+    """دکوریتور برای callback های پنل ادمین"""
+    @wraps(func)
+    def wrapper(call, *args):
+        if not is_admin_session_valid(call.from_user.id):
+            bot.answer_callback_query(call.id, "❌ Session منقضی شده! دوباره وارد شوید.")
+            return
+        return func(call, *args)
+    return wrapper
 
 
 def remember_admin_message(user_id: int, chat_id: int, message_id: int) -> None:
     """ذخیره آخرین پیام پنل ادمین برای کاربر جهت ویرایش‌های بعدی"""
-    admin_last_messages[user_id] = { 'chat_id': chat_id, 'message_id': message_id }
+    admin_last_messages.set(user_id, {'chat_id': chat_id, 'message_id': message_id})
 
 
 def get_admin_message_ref(user_id: int):
@@ -104,6 +209,7 @@ def get_admin_message_ref(user_id: int):
     return admin_last_messages.get(user_id)
 
 
+@keyboards.static
 def create_admin_menu():
     """ایجاد منوی ادمین"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -120,6 +226,12 @@ def create_admin_menu():
         InlineKeyboardButton("🧾 سفارش‌ها", callback_data="admin_orders")
     )
     
+    # ردیف ارسال همگانی
+    keyboard.add(
+        InlineKeyboardButton("📢 پیام همگانی", callback_data="admin_broadcast"),
+        InlineKeyboardButton("📋 ارسال‌های همگانی", callback_data="admin_broadcast_jobs")
+    )
+    
     # ردیف سوم
     keyboard.add(
         InlineKeyboardButton("🔐 Session", callback_data="admin_session"),
@@ -132,6 +244,7 @@ def create_admin_menu():
     return keyboard
 
 
+@keyboards.static
 def create_back_menu():
     """ایجاد دکمه بازگشت"""
     keyboard = InlineKeyboardMarkup()
@@ -139,6 +252,7 @@ def create_back_menu():
     return keyboard
 
 
+@keyboards.static
 def create_main_menu():
     """ایجاد منوی اصلی کاربر زیر پیام خوش‌آمدگویی"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -153,6 +267,7 @@ def create_main_menu():
     return keyboard
 
 
+@keyboards.static
 def create_user_back_menu():
     """ایجاد دکمه بازگشت به منوی اصلی کاربر"""
     keyboard = InlineKeyboardMarkup()
@@ -195,13 +310,69 @@ def create_product_info_text(product, index, is_admin=False):
     return text
 
 
-def display_products_page(chat_id, message_id, products_data):
-    """نمایش صفحه محصولات با pagination"""
+def get_pending_product_image(draft: ProductDraftState):
+    """ساخت اطلاعات عکس اول محصول در حال افزودن (برای ذخیره در همان تراکنش add_product)"""
+    if not draft.image_file_id:
+        return None
+    return {
+        'file_id': draft.image_file_id,
+        'file_unique_id': draft.image_file_unique_id,
+        'file_size': draft.image_file_size,
+        'width': draft.image_width,
+        'height': draft.image_height
+    }
+
+
+
+def page_position(page, cursor):
+    """(page, cursor) آرگومان‌های callback صفحه‌بندی
+
+    قالب جدید '{page}_{cursor}' است؛ callback های قدیمی بدون cursor به صفحه اول می‌روند.
+    """
+    if not cursor:
+        return 1, None
+    return page, cursor
+
+
+def get_products_page_view(cursor=None, page=1, per_page=5, is_admin=False):
+    """(متن، کیبورد، تعداد صفحات) یک صفحه محصولات یا None اگر صفحه محصولی نداشته باشد
+
+    صفحه رندر شده با کلید (نقش، cursor، صفحه، تعداد در صفحه، نسخه کاتالوگ) cache می‌شود؛
+    هر تغییر کاتالوگ نسخه را عوض می‌کند و صفحه‌های قبلی دیگر استفاده نمی‌شوند. صفحه خالی
+    (که در صورت خطای دیتابیس هم برگردانده می‌شود) ذخیره نمی‌شود.
+    """
+    version = db.catalog.version
+    key = ('admin' if is_admin else 'user', cursor, page, per_page, version)
+    view = rendered_pages.get(key, None)
+    if view is not None:
+        return view
+
+    products_data = db.get_products_page(cursor, page, per_page=per_page)
     if not products_data['products']:
+        return None
+    if is_admin:
+        text, keyboard = render_admin_products_page(products_data)
+    else:
+        text, keyboard = render_products_page(products_data)
+    view = (text, FrozenKeyboard(keyboard), products_data['total_pages'])
+    if db.catalog.version == version:
+        rendered_pages.set(key, view, rendered_pages.version)
+    return view
+
+
+def display_products_page(chat_id, message_id, page_view):
+    """نمایش صفحه محصولات (خروجی get_products_page_view) با pagination"""
+    if page_view is None:
         text = "🛍️ **محصولات**\n\n❌ هیچ محصولی موجود نیست."
         safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
         return
-    
+
+    text, keyboard, _ = page_view
+    safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
+
+
+def render_products_page(products_data):
+    """ساخت متن و کیبورد صفحه محصولات کاربران"""
     text = f"🛍️ **محصولات موجود**\n\n📄 صفحه {products_data['current_page']} از {products_data['total_pages']}\n\n"
     keyboard = InlineKeyboardMarkup()
     product_buttons = []
@@ -222,31 +393,37 @@ def display_products_page(chat_id, message_id, products_data):
     pagination_row = []
     
     # دکمه قبلی - اگر صفحه اول نیست، فعال است
-    if products_data['current_page'] > 1:
+    if products_data['has_prev']:
         prev_page = products_data['current_page'] - 1
-        pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data=f"products_page_{prev_page}"))
+        pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data=f"products_page_{prev_page}_{products_data['prev_cursor']}"))
     else:
         pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data="noop"))
     
     # دکمه بعدی - اگر صفحه آخر نیست، فعال است
-    if products_data['current_page'] < products_data['total_pages']:
+    if products_data['has_next']:
         next_page = products_data['current_page'] + 1
-        pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data=f"products_page_{next_page}"))
+        pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data=f"products_page_{next_page}_{products_data['next_cursor']}"))
     else:
         pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data="noop"))
     
     keyboard.add(*pagination_row)
     keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="menu_main"))
-    safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
+    return text, keyboard
 
 
-def display_admin_products_page(chat_id, message_id, products_data):
-    """نمایش صفحه محصولات ادمین با pagination"""
-    if not products_data['products']:
+def display_admin_products_page(chat_id, message_id, page_view):
+    """نمایش صفحه محصولات ادمین (خروجی get_products_page_view) با pagination"""
+    if page_view is None:
         text = "📋 **لیست محصولات**\n\n❌ هیچ محصولی ثبت نشده است."
         safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
         return
-    
+
+    text, keyboard, _ = page_view
+    safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
+
+
+def render_admin_products_page(products_data):
+    """ساخت متن و کیبورد صفحه محصولات ادمین"""
     text = f"📋 **لیست محصولات**\n\n📄 صفحه {products_data['current_page']} از {products_data['total_pages']}\n\n"
     keyboard = InlineKeyboardMarkup()
     
@@ -261,24 +438,25 @@ def display_admin_products_page(chat_id, message_id, products_data):
     pagination_row = []
     
     # دکمه قبلی - اگر صفحه اول نیست، فعال است
-    if products_data['current_page'] > 1:
+    if products_data['has_prev']:
         prev_page = products_data['current_page'] - 1
-        pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data=f"admin_products_page_{prev_page}"))
+        pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data=f"admin_products_page_{prev_page}_{products_data['prev_cursor']}"))
     else:
         pagination_row.append(InlineKeyboardButton("⬅️ صفحه قبلی", callback_data="noop"))
     
     # دکمه بعدی - اگر صفحه آخر نیست، فعال است
-    if products_data['current_page'] < products_data['total_pages']:
+    if products_data['has_next']:
         next_page = products_data['current_page'] + 1
-        pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data=f"admin_products_page_{next_page}"))
+        pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data=f"admin_products_page_{next_page}_{products_data['next_cursor']}"))
     else:
         pagination_row.append(InlineKeyboardButton("صفحه بعدی ➡️", callback_data="noop"))
     
     keyboard.add(*pagination_row)
     keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_products"))
-    safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
+    return text, keyboard
 
 
+@keyboards.static
 def create_registration_menu():
     """ایجاد منوی ثبت نام"""
     keyboard = InlineKeyboardMarkup()
@@ -288,6 +466,7 @@ def create_registration_menu():
 
 
 
+@keyboards.static
 def create_profile_edit_menu():
     """ایجاد منوی ویرایش پروفایل"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -303,6 +482,7 @@ def create_profile_edit_menu():
     return keyboard
 
 
+@keyboards.static
 def create_products_menu():
     """ایجاد منوی مدیریت محصولات"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -314,6 +494,7 @@ def create_products_menu():
     return keyboard
 
 
+@keyboards.cached
 def create_product_edit_menu(product_id):
     """ایجاد منوی ویرایش محصول"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -340,41 +521,78 @@ def escape_markdown(text):
     return text.replace('_', '\\_').replace('*', '\\*').replace('[', '\\[').replace('`', '\\`').replace(']', '\\]')
 
 
+def message_digest(text, reply_markup=None, parse_mode='Markdown'):
+    """اثر انگشت [متن، کیبورد] محتوای یک پیام برای تشخیص ویرایش‌های بدون تغییر"""
+    text_hash = hashlib.blake2b(f"{parse_mode}\n{text}".encode('utf-8'), digest_size=16).hexdigest()
+    markup_json = reply_markup.to_json() if reply_markup else ''
+    markup_hash = hashlib.blake2b(markup_json.encode('utf-8'), digest_size=16).hexdigest()
+    return [text_hash, markup_hash]
+
+
+def forget_rendered_message(chat_id, message_id):
+    """حذف اثر انگشت پیامی که خارج از safe_edit_message ویرایش شده است"""
+    rendered_messages.pop(f"{chat_id}:{message_id}")
+
+
 def safe_edit_message(chat_id, message_id, text, reply_markup=None, parse_mode='Markdown'):
-    """ویرایش امن پیام با مدیریت خطا. در صورت ارسال پیام جدید، همان Message را برمی‌گرداند."""
+    """ویرایش امن پیام با مدیریت خطا. در صورت ارسال پیام جدید، همان Message را برمی‌گرداند.
+
+    اثر انگشت آخرین محتوای هر پیام نگهداری می‌شود: ویرایش بدون تغییر اصلاً ارسال نمی‌شود
+    و اگر فقط کیبورد عوض شده باشد تنها edit_message_reply_markup فراخوانی می‌شود.
+    """
+    key = f"{chat_id}:{message_id}"
+    digest = message_digest(text, reply_markup, parse_mode)
+    last = rendered_messages.get(key)
+    if last == digest:
+        edit_stats['suppressed'] += 1
+        return None
+    markup_only = last is not None and last[0] == digest[0]
     try:
-        bot.edit_message_text(
-            text,
-            chat_id,
-            message_id,
-            parse_mode=parse_mode,
-            reply_markup=reply_markup
-        )
+        if markup_only:
+            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+            edit_stats['markup_only'] += 1
+        else:
+            bot.edit_message_text(
+                text,
+                chat_id,
+                message_id,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup
+            )
+            edit_stats['text'] += 1
+        rendered_messages.set(key, digest)
         return None
     except Exception as e:
+        if is_flood_error(e):
+            # در محدودیت نرخ پیام جدید ساخته نمی‌شود تا فشار بیشتر نشود
+            logger.warning(f"⚠️ Edit skipped due to Telegram flood limit: {e}")
+            return None
         if "message is not modified" in str(e):
-            # اگر پیام تغییر نکرده، فقط keyboard را به‌روزرسانی کن
-            if reply_markup:
+            # محتوای پیام از قبل معلوم نبوده؛ اگر متن تغییر نکرده، فقط keyboard را به‌روزرسانی کن
+            if reply_markup and not markup_only:
                 try:
                     bot.edit_message_reply_markup(
                         chat_id,
                         message_id,
                         reply_markup=reply_markup
                     )
-                except Exception:
-                    # اگر keyboard هم تغییر نکرده، هیچ پیام جدیدی نساز
-                    pass
+                except Exception as markup_error:
+                    if "message is not modified" not in str(markup_error):
+                        return None
             # هیچ کاری نکن تا پیام جدید ساخته نشود
+            rendered_messages.set(key, digest)
             return None
         else:
             # اگر خطای دیگری است، پیام جدید ارسال کن
             try:
-                return bot.send_message(
+                sent = bot.send_message(
                     chat_id,
                     text,
                     parse_mode=parse_mode,
                     reply_markup=reply_markup
                 )
+                rendered_messages.set(f"{sent.chat.id}:{sent.message_id}", digest)
+                return sent
             except Exception:
                 return None
 
@@ -399,6 +617,116 @@ def safe_edit_last_admin_message(user_id: int, text: str, reply_markup=None, par
             return False
 
 
+def describe_broadcast_segment(segment: str, value=None) -> str:
+    """عنوان فارسی بخش مخاطبان ارسال همگانی"""
+    if segment == 'registered':
+        return "کاربران ثبت‌نام‌شده"
+    if segment == 'city':
+        return f"کاربران شهر {value}"
+    if segment == 'active':
+        return f"کاربران فعال در {value} روز اخیر"
+    if segment == 'orders':
+        return "کاربران دارای سفارش در انتظار یا تایید شده"
+    return "همه کاربران"
+
+
+@keyboards.static
+def create_broadcast_segments_menu():
+    """منوی انتخاب بخش مخاطبان ارسال همگانی"""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("👥 همه کاربران", callback_data="admin_bseg_all"),
+        InlineKeyboardButton("📝 ثبت‌نام‌شده‌ها", callback_data="admin_bseg_registered")
+    )
+    keyboard.add(
+        InlineKeyboardButton("🟢 فعال در ۷ روز اخیر", callback_data="admin_bseg_active_7"),
+        InlineKeyboardButton("🟢 فعال در ۳۰ روز اخیر", callback_data="admin_bseg_active_30")
+    )
+    keyboard.add(
+        InlineKeyboardButton("🛒 دارای سفارش", callback_data="admin_bseg_orders"),
+        InlineKeyboardButton("🏙️ بر اساس شهر", callback_data="admin_bseg_city")
+    )
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت به منو", callback_data="admin_menu"))
+    return keyboard
+
+
+def request_broadcast_text(user_id: int, segment: str, value=None) -> str:
+    """ذخیره بخش انتخاب شده و ساخت متن پیش‌نمایش تعداد گیرنده‌ها"""
+    total = db.count_segment_users(segment, value)
+    conversations.set(user_id, BroadcastState('broadcast_text', segment=segment, segment_value=value, total=total))
+    return f"""
+📢 **ارسال پیام همگانی**
+
+🎯 مخاطبان: {describe_broadcast_segment(segment, value)}
+👥 تعداد گیرنده‌ها: {total}
+
+لطفاً پیام خود را ارسال کنید:
+    """
+
+
+def format_broadcast_progress(job) -> str:
+    """متن وضعیت یک ارسال همگانی برای نمایش به ادمین"""
+    total = job.total or 0
+    percent = f" ({job.processed * 100 // total}%)" if total else ""
+    rate = job.sent / job.elapsed if job.elapsed > 0 else 0
+    title = {
+        'running': "⏳ **در حال ارسال پیام همگانی...**",
+        'paused': "⏸️ **ارسال پیام همگانی متوقف موقت شد**",
+        'cancelled': "🚫 **ارسال پیام همگانی لغو شد**",
+        'done': "✅ **ارسال پیام تکمیل شد**",
+        'failed': "❌ **ارسال پیام متوقف شد**"
+    }.get(job.status, job.status)
+    return f"""
+{title} (#{job.job_id})
+
+🎯 مخاطبان: {describe_broadcast_segment(job.segment, job.segment_value)}
+
+📊 **نتایج:**
+• پردازش شده: {job.processed} از {total}{percent}
+• ارسال موفق: {job.sent}
+• ارسال ناموفق: {job.failed}
+• غیرقابل دسترس (غیرفعال شدند): {job.blocked}
+• سرعت: {rate:.1f} پیام در ثانیه
+    """
+
+
+@keyboards.cached
+def create_broadcast_status_controls(job_id: int, status: str):
+    """دکمه‌های کنترل (توقف موقت/ادامه/لغو) ارسال همگانی job_id در وضعیت status"""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    if status == 'running':
+        keyboard.add(
+            InlineKeyboardButton("⏸️ توقف موقت", callback_data=f"admin_bcast_pause_{job_id}"),
+            InlineKeyboardButton("🚫 لغو", callback_data=f"admin_bcast_cancel_{job_id}")
+        )
+    elif status == 'paused':
+        keyboard.add(
+            InlineKeyboardButton("▶️ ادامه", callback_data=f"admin_bcast_resume_{job_id}"),
+            InlineKeyboardButton("🚫 لغو", callback_data=f"admin_bcast_cancel_{job_id}")
+        )
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت به منو", callback_data="admin_menu"))
+    return keyboard
+
+
+def create_broadcast_controls(job):
+    """دکمه‌های کنترل یک ارسال همگانی بر اساس وضعیت فعلی آن"""
+    return create_broadcast_status_controls(job.job_id, job.status)
+
+
+
+def report_broadcast_progress(job) -> None:
+    """نمایش پیشرفت ارسال همگانی روی آخرین پیام ادمین"""
+    with gateway.lane(PRIORITY_NOTIFICATION):
+        safe_edit_last_admin_message(job.admin_id, format_broadcast_progress(job), reply_markup=create_broadcast_controls(job))
+
+
+def report_broadcast_finished(job) -> None:
+    """ثبت لاگ و نمایش نتیجه نهایی ارسال همگانی"""
+    db.add_log(job.admin_id, 'broadcast_sent', f'ارسال پیام به {job.sent} کاربر')
+    with gateway.lane(PRIORITY_NOTIFICATION):
+        safe_edit_last_admin_message(job.admin_id, format_broadcast_progress(job), reply_markup=create_back_menu())
+
+
 def safe_edit_admin(call, text: str, reply_markup=None, parse_mode: str = 'Markdown'):
     """ویرایش امن پیام ادمین.
     - اگر پیام فعلی عکس باشد، ابتدا سعی می‌کنیم کپشن را ادیت کنیم تا پیام جدید نسازیم.
@@ -418,17 +746,24 @@ def safe_edit_admin(call, text: str, reply_markup=None, parse_mode: str = 'Markd
                 parse_mode=parse_mode,
                 reply_markup=reply_markup
             )
+            forget_rendered_message(chat_id, message_id)
             try:
                 remember_admin_message(user_id, chat_id, message_id)
             except Exception:
                 pass
             return
         except Exception as e:
+            if is_flood_error(e):
+                # در محدودیت نرخ پیام حذف و دوباره ارسال نمی‌شود
+                logger.warning(f"⚠️ Caption edit skipped due to Telegram flood limit: {e}")
+                return
             # اگر کپشن تغییر نکرد یا ادیت نشد، سعی می‌کنیم فقط کیبورد را ادیت کنیم
             if "message is not modified" in str(e):
                 try:
                     bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+                    forget_rendered_message(chat_id, message_id)
                     remember_admin_message(user_id, chat_id, message_id)
+
                     return
                 except Exception:
                     pass
@@ -502,20 +837,34 @@ def admin_panel(message):
     user_id = message.from_user.id
     
     # بررسی اینکه آیا کاربر در حال وارد کردن رمز است
-    if user_id in user_states and user_states[user_id] == 'waiting_password':
-        password = message.text.strip()
+    state = conversations.get(user_id)
+    if state is not None and state.name == 'admin_password':
+        handle_admin_password(message, state)
+    else:
+        # درخواست رمز عبور
+        conversations.set(user_id, State('admin_password'))
+        bot.reply_to(message, 
+            "🔐 **ورود به پنل ادمین**\n\n"
+            "لطفاً رمز عبور ادمین را وارد کنید:",
+            parse_mode='Markdown')
+
+
+@conversations.on('admin_password')
+def handle_admin_password(message, state):
+    """بررسی رمز عبور ادمین"""
+    user_id = message.from_user.id
+    password = message.text.strip()
+    # حذف وضعیت انتظار رمز
+    conversations.clear(user_id)
+    
+    if password == ADMIN_PASSWORD:
+        # ایجاد session ادمین
+        create_admin_session(user_id)
         
-        if password == ADMIN_PASSWORD:
-            # حذف وضعیت انتظار رمز
-            del user_states[user_id]
-            
-            # ایجاد session ادمین
-            create_admin_session(user_id)
-            
-            # ثبت لاگ
-            db.add_log(user_id, 'admin_login', 'Successful admin panel login')
-            
-            admin_text = f"""
+        # ثبت لاگ
+        db.add_log(user_id, 'admin_login', 'Successful admin panel login')
+        
+        admin_text = f"""
 🔐 **پنل ادمین** 🔐
 
 ✅ **ورود موفق!** خوش آمدید!
@@ -523,62 +872,56 @@ def admin_panel(message):
 ⏰ **مدت زمان session:** {ADMIN_SESSION_DURATION // 60} دقیقه
 
 🎯 **منوی ادمین را انتخاب کنید:**
-            """
-            sent = bot.reply_to(message, admin_text, parse_mode='Markdown', reply_markup=create_admin_menu())
-            try:
-                remember_admin_message(user_id, sent.chat.id, sent.message_id)
-            except Exception:
-                pass
-        else:
-            # ثبت تلاش ناموفق
-            db.add_log(user_id, 'admin_login_failed', f'Failed login attempt with password: {password[:3]}***')
-            bot.reply_to(message, "❌ رمز عبور اشتباه است! دوباره تلاش کنید.")
-            del user_states[user_id]
+        """
+        sent = bot.reply_to(message, admin_text, parse_mode='Markdown', reply_markup=create_admin_menu())
+        try:
+            remember_admin_message(user_id, sent.chat.id, sent.message_id)
+        except Exception:
+            pass
     else:
-        # درخواست رمز عبور
-        user_states[user_id] = 'waiting_password'
-        bot.reply_to(message, 
-            "🔐 **ورود به پنل ادمین**\n\n"
-            "لطفاً رمز عبور ادمین را وارد کنید:",
-            parse_mode='Markdown')
+        # ثبت تلاش ناموفق
+        db.add_log(user_id, 'admin_login_failed', f'Failed login attempt with password: {password[:3]}***')
+        bot.reply_to(message, "❌ رمز عبور اشتباه است! دوباره تلاش کنید.")
 
 # دستورات قدیمی ادمین حذف شدند - حالا از منوی تعاملی استفاده می‌شود
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'noop')
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback_query(call):
+    """اجرای handler ثبت شده در router برای callback_data"""
+    if not router.dispatch(call):
+        bot.answer_callback_query(call.id, "❌ داده نامعتبر")
+
+
+@router.route('noop')
 def handle_noop_callback(call):
     """مدیریت کلیک روی دکمه‌های غیرفعال"""
     bot.answer_callback_query(call.id, "⚠️ این دکمه در حال حاضر غیرفعال است", show_alert=False)
-    return
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_'))
-def handle_admin_callback(call):
-    """مدیریت callback های منوی ادمین"""
-    user_id = call.from_user.id
-    
-    # بررسی اعتبار session
-    if not is_admin_session_valid(user_id):
-        bot.answer_callback_query(call.id, "❌ Session منقضی شده! دوباره وارد شوید.")
-        return
-    
-    if call.data == "admin_menu":
-        # نمایش منوی اصلی
-        admin_text = f"""
+
+@router.route('admin_menu')
+@admin_callback
+def handle_admin_menu_callback(call):
+    """نمایش منوی اصلی"""
+    admin_text = f"""
 🔐 **پنل ادمین** 🔐
 
 ⏰ **مدت زمان session:** {ADMIN_SESSION_DURATION // 60} دقیقه
 
 🎯 **منوی ادمین را انتخاب کنید:**
-        """
-        safe_edit_admin(call, admin_text, reply_markup=create_admin_menu())
-    
-    elif call.data == "admin_stats":
-        # نمایش آمار
-        try:
-            total_users = db.get_users_count()
-            daily_stats = db.get_daily_stats()
-            
-            stats_text = f"""
+    """
+    safe_edit_admin(call, admin_text, reply_markup=create_admin_menu())
+
+
+@router.route('admin_stats')
+@admin_callback
+def handle_admin_stats_callback(call):
+    """نمایش آمار"""
+    try:
+        total_users = db.get_users_count()
+        daily_stats = db.get_daily_stats()
+        
+        stats_text = f"""
 📊 **آمار ربات**
 
 👥 **کاربران:**
@@ -589,50 +932,111 @@ def handle_admin_callback(call):
 💬 **پیام‌ها:**
 • پیام‌های امروز: {daily_stats.get('messages_today', 0)}
 
+🧾 **سفارش‌های امروز:**
+• ثبت شده: {daily_stats.get('orders_created_today', 0)}
+• تایید شده: {daily_stats.get('orders_approved_today', 0)}
+• رد شده: {daily_stats.get('orders_rejected_today', 0)}
+
 📅 **زمان:**
 • تاریخ: {datetime.now().strftime('%Y/%m/%d')}
 • ساعت: {datetime.now().strftime('%H:%M:%S')}
 
 🔧 **وضعیت:** آنلاین ✅
-            """
-            safe_edit_admin(call, stats_text, reply_markup=create_back_menu())
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ خطا در دریافت آمار: {str(e)}")
-    
-    elif call.data == "admin_users":
-        # نمایش لیست کاربران
-        try:
-            users = db.get_all_users()
-            if not users:
-                users_text = "📝 هیچ کاربری ثبت نشده است."
-            else:
-                users_text = "👥 **لیست کاربران:**\n\n"
-                for i, user in enumerate(users[:10], 1):
-                    username = user['username'] or 'بدون نام کاربری'
-                    first_name = user['first_name'] or 'نامشخص'
-                    join_date = user['join_date'].strftime('%Y/%m/%d') if user['join_date'] else 'نامشخص'
-                    # Escape special characters for Markdown
-                    username = escape_markdown(username)
-                    first_name = escape_markdown(first_name)
-                    users_text += f"{i}. {first_name} (@{username})\n📅 {join_date}\n\n"
-                
-                if len(users) > 10:
-                    users_text += f"... و {len(users) - 10} کاربر دیگر"
+        """
+        stats_text += "\n🧠 **حافظه (باز / منقضی / حذف به دلیل ظرفیت):**\n" + "\n".join(
+            f"• {title}: {len(store)} / {store.stats['expired']} / {store.stats['evicted']}"
+            for title, store in (('گفتگوها', conversations), ('session های ادمین', admin_sessions),
+                                 ('مرجع پیام‌ها', admin_last_messages),
+                                 ('محتوای پیام‌ها', rendered_messages))) + "\n"
+
+        stats_text += (f"\n⌨️ **کیبوردها:** {len(keyboards.keyboards)} ثابت، "
+                       f"cache: {keyboards.stats['hits']} hit / {keyboards.stats['misses']} miss\n")
+        stats_text += (f"📄 **صفحه‌های محصولات رندر شده:** {rendered_pages.stats['hits']} hit / "
+                       f"{rendered_pages.stats['misses']} miss\n")
+        stats_text += (f"✏️ **ویرایش پیام‌ها:** {edit_stats['text']} متن / {edit_stats['markup_only']} فقط کیبورد / "
+                       f"{edit_stats['suppressed']} بدون تغییر (ارسال نشد)\n")
+
+
+        top_routes = router.hits.most_common(5)
+        if top_routes:
+            stats_text += "\n🔘 **دکمه‌های پرکاربرد:**\n" + "\n".join(
+                f"• `{action}`: {count}" for action, count in top_routes)
+        safe_edit_admin(call, stats_text, reply_markup=create_back_menu())
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ خطا در دریافت آمار: {str(e)}")
+
+
+@router.route('admin_users')
+@admin_callback
+def handle_admin_users_callback(call):
+    """نمایش لیست کاربران"""
+    try:
+        users = db.get_all_users()
+        if not users:
+            users_text = "📝 هیچ کاربری ثبت نشده است."
+        else:
+            users_text = "👥 **لیست کاربران:**\n\n"
+            for i, user in enumerate(users[:10], 1):
+                username = user['username'] or 'بدون نام کاربری'
+                first_name = user['first_name'] or 'نامشخص'
+                join_date = user['join_date'].strftime('%Y/%m/%d') if user['join_date'] else 'نامشخص'
+                # Escape special characters for Markdown
+                username = escape_markdown(username)
+                first_name = escape_markdown(first_name)
+                users_text += f"{i}. {first_name} (@{username})\n📅 {join_date}\n\n"
             
-            safe_edit_admin(call, users_text, reply_markup=create_back_menu())
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ خطا در دریافت لیست کاربران: {str(e)}")
-    
-    elif call.data == "admin_orders":
-        # لیست سفارش‌های در انتظار تایید - صفحه اول
-        page = 1
-        orders_data = db.get_pending_orders(page, per_page=10)
-        text = "🧾 سفارش‌های در انتظار تایید\n\n"
-        if not orders_data['orders']:
-            text += "هیچ سفارشی در انتظار نیست."
-            safe_edit_admin(call, text, reply_markup=create_admin_menu())
-            return
-        keyboard = InlineKeyboardMarkup()
+            if len(users) > 10:
+                users_text += f"... و {len(users) - 10} کاربر دیگر"
+        
+        safe_edit_admin(call, users_text, reply_markup=create_back_menu())
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ خطا در دریافت لیست کاربران: {str(e)}")
+
+
+@router.route('admin_orders')
+@admin_callback
+def handle_admin_orders_callback(call):
+    """لیست سفارش‌های در انتظار تایید - صفحه اول"""
+    orders_data = db.get_pending_orders_page(per_page=10)
+    text = "🧾 سفارش‌های در انتظار تایید\n\n"
+    if not orders_data['orders']:
+        text += "هیچ سفارشی در انتظار نیست."
+        safe_edit_admin(call, text, reply_markup=create_admin_menu())
+        return
+    keyboard = InlineKeyboardMarkup()
+    for order in orders_data['orders']:
+        otext = (
+            f"#{order['id']} - {escape_markdown(order['product_name'])} - {order['price']} تومان\n"
+            f"کاربر: {escape_markdown(order.get('first_name') or '')} @{escape_markdown(order.get('username') or '-') }\n"
+            f"تاریخ: {order['created_at'].strftime('%Y/%m/%d %H:%M')}\n\n"
+        )
+        text += otext
+        keyboard.add(InlineKeyboardButton(f"بررسی سفارش #{order['id']}", callback_data=f"admin_view_order_{order['id']}"))
+    # pagination
+    pag = []
+    if orders_data['has_prev']:
+        pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_orders_page_{orders_data['current_page']-1}_{orders_data['prev_cursor']}"))
+    else:
+        pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data="noop"))
+    if orders_data['has_next']:
+        pag.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_orders_page_{orders_data['current_page']+1}_{orders_data['next_cursor']}"))
+    else:
+        pag.append(InlineKeyboardButton("بعدی ➡️", callback_data="noop"))
+    keyboard.add(*pag)
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu"))
+    safe_edit_admin(call, text, reply_markup=keyboard)
+
+
+@router.route('admin_orders_page', int, str)
+@admin_callback
+def handle_admin_orders_page_callback(call, page, cursor):
+    page, cursor = page_position(page, cursor)
+    orders_data = db.get_pending_orders_page(cursor, page, per_page=10)
+    text = "🧾 سفارش‌های در انتظار تایید\n\n"
+    keyboard = InlineKeyboardMarkup()
+    if not orders_data['orders']:
+        text += "در این صفحه سفارشی نیست."
+    else:
         for order in orders_data['orders']:
             otext = (
                 f"#{order['id']} - {escape_markdown(order['product_name'])} - {order['price']} تومان\n"
@@ -641,169 +1045,216 @@ def handle_admin_callback(call):
             )
             text += otext
             keyboard.add(InlineKeyboardButton(f"بررسی سفارش #{order['id']}", callback_data=f"admin_view_order_{order['id']}"))
-        # pagination
-        pag = []
-        if orders_data['current_page'] > 1:
-            pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_orders_page_{orders_data['current_page']-1}"))
-        else:
-            pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data="noop"))
-        if orders_data['current_page'] < orders_data['total_pages']:
-            pag.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_orders_page_{orders_data['current_page']+1}"))
-        else:
-            pag.append(InlineKeyboardButton("بعدی ➡️", callback_data="noop"))
-        keyboard.add(*pag)
-        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu"))
-        safe_edit_admin(call, text, reply_markup=keyboard)
-
-    elif call.data.startswith("admin_orders_page_"):
-        page = int(call.data.replace("admin_orders_page_", ""))
-        orders_data = db.get_pending_orders(page, per_page=10)
-        text = "🧾 سفارش‌های در انتظار تایید\n\n"
+    pag = []
+    if orders_data['has_prev']:
+        pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_orders_page_{orders_data['current_page']-1}_{orders_data['prev_cursor']}"))
+    else:
+        pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data="noop"))
+    if orders_data['has_next']:
+        pag.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_orders_page_{orders_data['current_page']+1}_{orders_data['next_cursor']}"))
+    else:
+        pag.append(InlineKeyboardButton("بعدی ➡️", callback_data="noop"))
+    keyboard.add(*pag)
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu"))
+    safe_edit_admin(call, text, reply_markup=keyboard)
+
+
+@router.route('admin_view_order', int)
+@admin_callback
+def handle_admin_view_order_callback(call, order_id):
+    order = db.get_order(order_id)
+    if not order:
+        bot.answer_callback_query(call.id, "❌ سفارش یافت نشد")
+        return
+    text = (
+        f"🧾 سفارش #{order['id']}\n\n"
+        f"محصول: {escape_markdown(order['product_name'])}\n"
+        f"مبلغ: {order['price']} تومان\n"
+        f"وضعیت: {order['status']}\n"
+        f"تاریخ: {order['created_at'].strftime('%Y/%m/%d %H:%M')}\n"
+    )
+    if order.get('shipping_address'):
+        text += f"📦 نشانی ارسال: {escape_markdown(order['shipping_address'])}\n"
+    keyboard = InlineKeyboardMarkup()
+    if order.get('screenshot_file_id'):
+        keyboard.add(InlineKeyboardButton("مشاهده اسکرین‌شات", callback_data=f"admin_view_orders_ss_{order['id']}"))
+    keyboard.add(
+        InlineKeyboardButton("✅ تایید", callback_data=f"admin_approve_order_{order['id']}"),
+        InlineKeyboardButton("❌ رد", callback_data=f"admin_reject_order_{order['id']}"),
+    )
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders"))
+    safe_edit_admin(call, text, reply_markup=keyboard)
+
+
+@router.route('admin_view_orders_ss', int)
+@admin_callback
+def handle_admin_view_orders_ss_callback(call, order_id):
+    message_id = call.message.message_id
+    order = db.get_order(order_id)
+    if order and order.get('screenshot_file_id'):
         keyboard = InlineKeyboardMarkup()
-        if not orders_data['orders']:
-            text += "در این صفحه سفارشی نیست."
-        else:
-            for order in orders_data['orders']:
-                otext = (
-                    f"#{order['id']} - {escape_markdown(order['product_name'])} - {order['price']} تومان\n"
-                    f"کاربر: {escape_markdown(order.get('first_name') or '')} @{escape_markdown(order.get('username') or '-') }\n"
-                    f"تاریخ: {order['created_at'].strftime('%Y/%m/%d %H:%M')}\n\n"
-                )
-                text += otext
-                keyboard.add(InlineKeyboardButton(f"بررسی سفارش #{order['id']}", callback_data=f"admin_view_order_{order['id']}"))
-        pag = []
-        if orders_data['current_page'] > 1:
-            pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_orders_page_{orders_data['current_page']-1}"))
-        else:
-            pag.append(InlineKeyboardButton("⬅️ قبلی", callback_data="noop"))
-        if orders_data['current_page'] < orders_data['total_pages']:
-            pag.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_orders_page_{orders_data['current_page']+1}"))
-        else:
-            pag.append(InlineKeyboardButton("بعدی ➡️", callback_data="noop"))
-        keyboard.add(*pag)
-        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu"))
-        safe_edit_admin(call, text, reply_markup=keyboard)
+        keyboard.add(
+            InlineKeyboardButton("✅ تایید", callback_data=f"admin_approve_order_{order_id}"),
+            InlineKeyboardButton("❌ رد", callback_data=f"admin_reject_order_{order_id}")
+        )
+        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"admin_view_order_{order_id}"))
+        caption = (
+            f"🧾 سفارش #{order_id}\n"
+            f"اسکرین‌شات پرداخت"
+        )
+        # حذف پیام قبلی تا پیام جدید بجای آن نمایش داده شود
+        try:
+            bot.delete_message(call.message.chat.id, call.message.message_id)
+        except Exception:
+            pass
+        sent = bot.send_photo(
+            call.message.chat.id,
+            order['screenshot_file_id'],
+            caption=caption,
+            parse_mode='Markdown',
+            reply_markup=keyboard
+        )
+        # پیام عکس جدید را به عنوان مرجع ذخیره نکن؛ اجازه بده safe_edit_admin روی همان پیام (اگر لازم شد) ادیت کپشن انجام دهد
+    else:
+        bot.answer_callback_query(call.id, "❌ اسکرین‌شات موجود نیست")
+
 
-    elif call.data.startswith("admin_view_order_"):
+@router.route('admin_approve_order', int)
+@admin_callback
+def handle_admin_approve_order_callback(call, order_id):
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    if db.update_order_status(order_id, 'approved', admin_id=user_id):
         try:
-            order_id = int(call.data.replace("admin_view_order_", ""))
             order = db.get_order(order_id)
-            if not order:
-                bot.answer_callback_query(call.id, "❌ سفارش یافت نشد")
-                return
-            text = (
-                f"🧾 سفارش #{order['id']}\n\n"
-                f"محصول: {escape_markdown(order['product_name'])}\n"
-                f"مبلغ: {order['price']} تومان\n"
-                f"وضعیت: {order['status']}\n"
-                f"تاریخ: {order['created_at'].strftime('%Y/%m/%d %H:%M')}\n"
-            )
-            if order.get('shipping_address'):
-                text += f"📦 نشانی ارسال: {escape_markdown(order['shipping_address'])}\n"
-            keyboard = InlineKeyboardMarkup()
-            if order.get('screenshot_file_id'):
-                keyboard.add(InlineKeyboardButton("مشاهده اسکرین‌شات", callback_data=f"admin_view_orders_ss_{order['id']}"))
-            keyboard.add(
-                InlineKeyboardButton("✅ تایید", callback_data=f"admin_approve_order_{order['id']}"),
-                InlineKeyboardButton("❌ رد", callback_data=f"admin_reject_order_{order['id']}"),
-            )
-            keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders"))
-            safe_edit_admin(call, text, reply_markup=keyboard)
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ داده نامعتبر")
-            logger.error(f"Invalid callback data for admin_view_order: {call.data}")
-            return
+            if order:
+                with gateway.lane(PRIORITY_NOTIFICATION):
+                    bot.send_message(order['user_id'], f"✅ سفارش #{order_id} شما تایید شد و در صف ارسال است.")
+        except:
+            pass
+        bot.answer_callback_query(call.id, "✅ سفارش تایید شد")
+        # refresh view
+        order = db.get_order(order_id)
+        if order:
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders")
+            ))
+            forget_rendered_message(call.message.chat.id, call.message.message_id)
+    else:
+        bot.answer_callback_query(call.id, "❌ خطا در تایید سفارش")
 
-    elif call.data.startswith("admin_view_orders_ss_"):
+
+@router.route('admin_reject_order', int)
+@admin_callback
+def handle_admin_reject_order_callback(call, order_id):
+    """رد بدون دلیل متنی در این نسخه ساده"""
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    if db.update_order_status(order_id, 'rejected', admin_id=user_id, rejection_reason='rejected by admin'):
         try:
-            order_id = int(call.data.replace("admin_view_orders_ss_", ""))
-            order = db.get_order(order_id)
-            if order and order.get('screenshot_file_id'):
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(
-                    InlineKeyboardButton("✅ تایید", callback_data=f"admin_approve_order_{order_id}"),
-                    InlineKeyboardButton("❌ رد", callback_data=f"admin_reject_order_{order_id}")
-                )
-                keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"admin_view_order_{order_id}"))
-                caption = (
-                    f"🧾 سفارش #{order_id}\n"
-                    f"اسکرین‌شات پرداخت"
-                )
-                # حذف پیام قبلی تا پیام جدید بجای آن نمایش داده شود
-                try:
-                    bot.delete_message(call.message.chat.id, call.message.message_id)
-                except Exception:
-                    pass
-                sent = bot.send_photo(
-                    call.message.chat.id,
-                    order['screenshot_file_id'],
-                    caption=caption,
-                    parse_mode='Markdown',
-                    reply_markup=keyboard
-                )
-                # پیام عکس جدید را به عنوان مرجع ذخیره نکن؛ اجازه بده safe_edit_admin روی همان پیام (اگر لازم شد) ادیت کپشن انجام دهد
-            else:
-                bot.answer_callback_query(call.id, "❌ اسکرین‌شات موجود نیست")
-        except ValueError:
-            bot.answer_callback_query(call.id, "❌ داده نامعتبر")
-            logger.error(f"Invalid callback data for admin_view_order_ss: {call.data}")
-            return
-
-    elif call.data.startswith("admin_approve_order_"):
-        order_id = int(call.data.replace("admin_approve_order_", ""))
-        if db.update_order_status(order_id, 'approved', admin_id=user_id):
-            try:
-                order = db.get_order(order_id)
-                if order:
-                    bot.send_message(order['user_id'], f"✅ سفارش #{order_id} شما تایید شد و در صف ارسال است.")
-            except:
-                pass
-            bot.answer_callback_query(call.id, "✅ سفارش تایید شد")
-            # refresh view
             order = db.get_order(order_id)
             if order:
-                bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders")
-                ))
-        else:
-            bot.answer_callback_query(call.id, "❌ خطا در تایید سفارش")
-
-    elif call.data.startswith("admin_reject_order_"):
-        order_id = int(call.data.replace("admin_reject_order_", ""))
-        # رد بدون دلیل متنی در این نسخه ساده
-        if db.update_order_status(order_id, 'rejected', admin_id=user_id, rejection_reason='rejected by admin'):
-            try:
-                order = db.get_order(order_id)
-                if order:
+                with gateway.lane(PRIORITY_NOTIFICATION):
                     bot.send_message(order['user_id'], f"❌ سفارش #{order_id} شما رد شد. در صورت مشکل با پشتیبانی تماس بگیرید.")
-            except:
-                pass
-            bot.answer_callback_query(call.id, "✅ سفارش رد شد")
-            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders")
-            ))
+        except:
+            pass
+        bot.answer_callback_query(call.id, "✅ سفارش رد شد")
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("🔙 بازگشت", callback_data="admin_orders")
+        ))
+        forget_rendered_message(call.message.chat.id, call.message.message_id)
+    else:
+        bot.answer_callback_query(call.id, "❌ خطا در رد سفارش")
+
+
+@router.route('admin_broadcast')
+@admin_callback
+def handle_admin_broadcast_callback(call):
+    """انتخاب بخش مخاطبان"""
+    broadcast_text = """
+📢 **ارسال پیام همگانی**
+
+لطفاً مخاطبان پیام را انتخاب کنید:
+    """
+    safe_edit_admin(call, broadcast_text, reply_markup=create_broadcast_segments_menu())
+
+
+@router.route('admin_bseg_city')
+@admin_callback
+def handle_admin_bseg_city_callback(call):
+    """درخواست نام شهر"""
+    user_id = call.from_user.id
+    conversations.set(user_id, State('broadcast_city'))
+    safe_edit_admin(call, "🏙️ **ارسال بر اساس شهر**\n\nلطفاً نام شهر را ارسال کنید:", reply_markup=create_back_menu())
+
+
+@router.route('admin_bseg', str, int)
+@admin_callback
+def handle_admin_bseg_callback(call, segment, value):
+    """پیش‌نمایش تعداد گیرنده‌ها و درخواست پیام برای ارسال"""
+    user_id = call.from_user.id
+    safe_edit_admin(call, request_broadcast_text(user_id, segment, value), reply_markup=create_back_menu())
+
+
+@router.route('admin_broadcast_jobs')
+@admin_callback
+def handle_admin_broadcast_jobs_callback(call):
+    """فهرست ارسال‌های همگانی ناتمام"""
+    jobs = broadcast_engine.active_jobs()
+    if not jobs:
+        safe_edit_admin(call, "📋 **ارسال‌های همگانی**\n\nهیچ ارسال فعالی وجود ندارد.", reply_markup=create_back_menu())
+        return
+    text = "📋 **ارسال‌های همگانی**\n\n"
+    keyboard = InlineKeyboardMarkup()
+    for job in jobs:
+        status_text = '⏳ در حال ارسال' if job.status == 'running' else '⏸️ متوقف موقت'
+        text += f"#{job.job_id} - {status_text} - {job.processed} از {job.total or 0}\n"
+        keyboard.add(InlineKeyboardButton(f"مدیریت ارسال #{job.job_id}", callback_data=f"admin_bcast_view_{job.job_id}"))
+    keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="admin_menu"))
+    safe_edit_admin(call, text, reply_markup=keyboard)
+
+
+@router.route('admin_bcast', str, int)
+@admin_callback
+def handle_admin_bcast_callback(call, action, job_id):
+    """کنترل ارسال همگانی: view / pause / resume / cancel"""
+    user_id = call.from_user.id
+    job = broadcast_engine.get_job(job_id)
+    if not job:
+        bot.answer_callback_query(call.id, "❌ ارسال یافت نشد!")
+        return
+    controls = {
+        'pause': (broadcast_engine.pause, "⏸️ ارسال متوقف شد"),
+        'resume': (broadcast_engine.resume, "▶️ ارسال ادامه یافت"),
+        'cancel': (broadcast_engine.cancel, "🚫 ارسال لغو شد")
+    }
+    if action in controls:
+        control, done_text = controls[action]
+        if control(job.job_id):
+            db.add_log(user_id, f'broadcast_{action}', f'broadcast job #{job.job_id}')
+            bot.answer_callback_query(call.id, done_text)
         else:
-            bot.answer_callback_query(call.id, "❌ خطا در رد سفارش")
+            bot.answer_callback_query(call.id, "❌ این عملیات در وضعیت فعلی ممکن نیست")
+    else:
+        bot.answer_callback_query(call.id)
+    safe_edit_admin(call, format_broadcast_progress(job), reply_markup=create_broadcast_controls(job))
 
-    elif call.data == "admin_broadcast":
-        # درخواست پیام برای ارسال
-        user_states[user_id] = 'waiting_broadcast'
-        broadcast_text = """
-📢 **ارسال پیام به همه کاربران**
 
-لطفاً پیام خود را ارسال کنید:
-        """
-        safe_edit_admin(call, broadcast_text, reply_markup=create_back_menu())
-    
-    elif call.data == "admin_session":
-        # نمایش اطلاعات session
-        session = admin_sessions[user_id]
-        login_time = session['login_time'].strftime('%H:%M:%S')
-        expires_time = session['expires'].strftime('%H:%M:%S')
-        remaining_time = session['expires'] - datetime.now()
-        remaining_minutes = int(remaining_time.total_seconds() // 60)
-        
-        session_text = f"""
+@router.route('admin_session')
+@admin_callback
+def handle_admin_session_callback(call):
+    """نمایش اطلاعات session"""
+    user_id = call.from_user.id
+    session = admin_sessions.get(user_id)
+    if not session:
+        bot.answer_callback_query(call.id, "❌ Session منقضی شده! دوباره وارد شوید.")
+        return
+    login_time = datetime.fromtimestamp(session['login_time']).strftime('%H:%M:%S')
+    expires_time = datetime.fromtimestamp(session['expires']).strftime('%H:%M:%S')
+    remaining_minutes = int((session['expires'] - time.time()) // 60)
+
+    
+    session_text = f"""
 🔐 **اطلاعات Session ادمین**
 
 ⏰ **زمان ورود:** {login_time}
@@ -811,92 +1262,99 @@ def handle_admin_callback(call):
 ⏱️ **زمان باقی‌مانده:** {remaining_minutes} دقیقه
 
 💡 برای تمدید session، دوباره `/admin` را اجرا کنید.
-        """
-        safe_edit_admin(call, session_text, reply_markup=create_back_menu())
-    
-    elif call.data == "admin_refresh":
-        # تازه‌سازی منو
-        admin_text = f"""
+    """
+    safe_edit_admin(call, session_text, reply_markup=create_back_menu())
+
+
+@router.route('admin_refresh')
+@admin_callback
+def handle_admin_refresh_callback(call):
+    """تازه‌سازی منو"""
+    admin_text = f"""
 🔐 **پنل ادمین** 🔐
 
 ⏰ **مدت زمان session:** {ADMIN_SESSION_DURATION // 60} دقیقه
 
 🎯 **منوی ادمین را انتخاب کنید:**
-        """
-        safe_edit_admin(call, admin_text, reply_markup=create_admin_menu())
-        bot.answer_callback_query(call.id, "🔄 منو تازه‌سازی شد!")
-    
-    elif call.data == "admin_products":
-        # مدیریت محصولات
-        products_count = db.get_products_count()
-        products_text = f"""
+    """
+    safe_edit_admin(call, admin_text, reply_markup=create_admin_menu())
+    bot.answer_callback_query(call.id, "🔄 منو تازه‌سازی شد!")
+
+
+@router.route('admin_products')
+@admin_callback
+def handle_admin_products_callback(call):
+    """مدیریت محصولات"""
+    products_count = db.get_products_count()
+    products_text = f"""
 🛍️ **مدیریت محصولات**
 
 📊 **آمار:**
 • تعداد محصولات فعال: {products_count}
 
 🎯 **عملیات:**
-        """
-        safe_edit_admin(call, products_text, reply_markup=create_products_menu())
+    """
+    safe_edit_admin(call, products_text, reply_markup=create_products_menu())
+
+
+@router.route('admin_logout')
+@admin_callback
+def handle_admin_logout_callback(call):
+    """خروج از پنل ادمین"""
+    user_id = call.from_user.id
+    db.add_log(user_id, 'admin_logout', 'خروج از پنل ادمین')
+    admin_sessions.pop(user_id)
     
-    elif call.data == "admin_logout":
-        # خروج از پنل ادمین
-        db.add_log(user_id, 'admin_logout', 'خروج از پنل ادمین')
-        del admin_sessions[user_id]
-        
-        logout_text = "👋 **خروج موفق!** از پنل ادمین خارج شدید."
-        safe_edit_admin(call, logout_text)
-        bot.answer_callback_query(call.id, "👋 خروج موفق!")
+    logout_text = "👋 **خروج موفق!** از پنل ادمین خارج شدید."
+    safe_edit_admin(call, logout_text)
+    bot.answer_callback_query(call.id, "👋 خروج موفق!")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('products_page_'))
-def handle_products_pagination_callback(call):
+@router.route('products_page', int, str)
+def handle_products_pagination_callback(call, page, cursor):
     """مدیریت pagination محصولات کاربران"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     
     try:
         # تغییر صفحه محصولات
-        page = int(call.data.replace("products_page_", ""))
+        page, cursor = page_position(page, cursor)
         logger.info(f"Products page callback: {call.data}, page: {page}")
-        print(f"DEBUG: Products page callback: {call.data}, page: {page}")
-        products_data = db.get_products_paginated(page, per_page=5)
-        logger.info(f"Products data: {products_data}")
-        print(f"DEBUG: Products data: {products_data}")
+        page_view = get_products_page_view(cursor, page, per_page=5)
         
         # بررسی اینکه آیا محصولات وجود دارند
-        if not products_data['products']:
+        if page_view is None:
             bot.answer_callback_query(call.id, "❌ هیچ محصولی در این صفحه وجود ندارد")
             return
             
-        display_products_page(chat_id, message_id, products_data)
-        bot.answer_callback_query(call.id, f"صفحه {page} از {products_data['total_pages']}")
+        display_products_page(chat_id, message_id, page_view)
+        bot.answer_callback_query(call.id, f"صفحه {page} از {page_view[2]}")
     except Exception as e:
         logger.error(f"خطا در pagination محصولات: {e}")
-        print(f"DEBUG ERROR: {e}")
         bot.answer_callback_query(call.id, f"❌ خطا در تغییر صفحه: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('menu_'))
-def handle_user_menu_callback(call):
-    """مدیریت منوی اصلی کاربر (پروفایل، محصولات، کیف پول، سفارشات)"""
+
+@router.route('menu_main')
+def handle_menu_main_callback(call):
+    """بازگشت به منوی اصلی"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
-    user_id = call.from_user.id
+    main_text = (
+        "🎯 **منوی اصلی**\n\n"
+        "از گزینه‌های زیر یکی را انتخاب کنید:"
+    )
+    safe_edit_message(chat_id, message_id, main_text, reply_markup=create_main_menu())
 
-    if call.data == 'menu_main':
-        # بازگشت به منوی اصلی
-        main_text = (
-            "🎯 **منوی اصلی**\n\n"
-            "از گزینه‌های زیر یکی را انتخاب کنید:"
-        )
-        safe_edit_message(chat_id, message_id, main_text, reply_markup=create_main_menu())
-        return
 
-    if call.data == 'menu_profile':
-        # نمایش اطلاعات پروفایل
-        user_info = db.get_user(user_id)
-        if user_info and user_info.get('is_registered'):
-            profile_text = f"""
+@router.route('menu_profile')
+def handle_menu_profile_callback(call):
+    """نمایش اطلاعات پروفایل"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    user_info = db.get_user(user_id)
+    if user_info and user_info.get('is_registered'):
+        profile_text = f"""
 👤 **پروفایل شما**
 
 📱 **شماره تلفن:** {user_info.get('phone', 'ثبت نشده')}
@@ -905,69 +1363,74 @@ def handle_user_menu_callback(call):
 🏙️ **شهر:** {user_info.get('city', 'ثبت نشده')}
 
 📅 **تاریخ عضویت:** {user_info.get('join_date', '').strftime('%Y/%m/%d') if user_info.get('join_date') else 'نامشخص'}
-            """
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("✏️ ویرایش پروفایل", callback_data="edit_profile"))
-            keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="menu_main"))
-            safe_edit_message(chat_id, message_id, profile_text, reply_markup=keyboard)
-        else:
-            text = "❌ شما هنوز ثبت نام نکرده‌اید. ابتدا ثبت نام کنید."
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
-        return
+        """
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("✏️ ویرایش پروفایل", callback_data="edit_profile"))
+        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data="menu_main"))
+        safe_edit_message(chat_id, message_id, profile_text, reply_markup=keyboard)
+    else:
+        text = "❌ شما هنوز ثبت نام نکرده‌اید. ابتدا ثبت نام کنید."
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
+
+
+@router.route('menu_products')
+def handle_menu_products_callback(call):
+    """نمایش محصولات - صفحه اول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    display_products_page(chat_id, message_id, get_products_page_view(per_page=5))
+
+
+@router.route('menu_wallet')
+def handle_menu_wallet_callback(call):
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    text = (
+        "👛 **کیف پول**\n\n"
+        "موجودی و تراکنش‌ها به‌زودی نمایش داده می‌شود."
+    )
+    safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
 
-    if call.data == 'menu_products':
-        # نمایش محصولات - صفحه اول
-        page = 1
-        products_data = db.get_products_paginated(page, per_page=5)
-        display_products_page(chat_id, message_id, products_data)
-        return
 
-    if call.data == 'menu_wallet':
+@router.route('menu_orders')
+def handle_menu_orders_callback(call):
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    orders = db.get_user_orders(user_id)
+    if not orders:
         text = (
-            "👛 **کیف پول**\n\n"
-            "موجودی و تراکنش‌ها به‌زودی نمایش داده می‌شود."
+            "🧾 **سفارشات**\n\n"
+            "هنوز سفارشی ثبت نکرده‌اید."
         )
         safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
         return
-
-    if call.data == 'menu_orders':
-        orders = db.get_user_orders(user_id)
-        if not orders:
-            text = (
-                "🧾 **سفارشات**\n\n"
-                "هنوز سفارشی ثبت نکرده‌اید."
-            )
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
-            return
-        text = "🧾 **سفارشات شما**\n\n"
-        status_map = { 'pending': '⏳ در انتظار', 'approved': '✅ تایید شده', 'rejected': '❌ رد شده' }
-        for o in orders:
-            text += (
-                f"#{o['id']} - {escape_markdown(o['product_name'])}\n"
-                f"وضعیت: {status_map.get(o['status'], o['status'])}\n"
-                f"مبلغ: {o['price']} تومان\n"
-                f"تاریخ: {o['created_at'].strftime('%Y/%m/%d %H:%M')}\n\n"
-            )
-        safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
-        return
+    text = "🧾 **سفارشات شما**\n\n"
+    status_map = { 'pending': '⏳ در انتظار', 'approved': '✅ تایید شده', 'rejected': '❌ رد شده' }
+    for o in orders:
+        text += (
+            f"#{o['id']} - {escape_markdown(o['product_name'])}\n"
+            f"وضعیت: {status_map.get(o['status'], o['status'])}\n"
+            f"مبلغ: {o['price']} تومان\n"
+            f"تاریخ: {o['created_at'].strftime('%Y/%m/%d %H:%M')}\n\n"
+        )
+    safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('images_page_'))
-def handle_images_pagination_callback(call):
+@router.route('images_page', int, int, str)
+def handle_images_pagination_callback(call, product_id, page, cursor):
     """مدیریت pagination عکس‌های محصولات"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     
     try:
         # تغییر صفحه عکس‌ها
-        parts = call.data.replace("images_page_", "").split("_")
-        product_id = int(parts[0])
-        page = int(parts[1])
+        page, cursor = page_position(page, cursor)
         logger.info(f"Images page callback: {call.data}, product_id: {product_id}, page: {page}")
-        print(f"DEBUG: Images page callback: {call.data}, product_id: {product_id}, page: {page}")
         
-        # دریافت اطلاعات محصول
-        product = db.get_product(product_id)
+        # دریافت محصول، عکس صفحه جاری و تعداد کل عکس‌ها در یک کوئری
+        images_data = db.get_product_gallery(product_id, cursor, page)
+        product = images_data['product']
         if not product:
             bot.send_message(chat_id, "❌ محصول یافت نشد!", reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("🔙 بازگشت به محصولات", callback_data="menu_products")
@@ -975,12 +1438,9 @@ def handle_images_pagination_callback(call):
             bot.answer_callback_query(call.id)
             return
         
-        # دریافت عکس‌ها با pagination
-        images_data = db.get_product_images_paginated(product_id, page, per_page=1)
         logger.info(f"Images data: {images_data}")
-        print(f"DEBUG: Images data: {images_data}")
         
-        if not images_data['images']:
+        if not images_data['image']:
             bot.send_message(chat_id, "❌ هیچ عکسی یافت نشد!", reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("🔙 بازگشت به محصول", callback_data=f"view_product_{product_id}")
             ))
@@ -994,24 +1454,24 @@ def handle_images_pagination_callback(call):
             pass
         
         # ارسال فقط اولین عکس با pagination
-        if images_data['images']:
-            first_image = images_data['images'][0]
+        if images_data['image']:
+            first_image = images_data['image']
             keyboard = InlineKeyboardMarkup()
             
             # دکمه‌های pagination - همیشه نمایش داده می‌شوند
             pagination_row = []
             
             # دکمه قبلی - اگر صفحه اول نیست، فعال است
-            if page > 1:
+            if images_data['has_prev']:
                 prev_page = page - 1
-                pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data=f"images_page_{product_id}_{prev_page}"))
+                pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data=f"images_page_{product_id}_{prev_page}_{images_data['prev_cursor']}"))
             else:
                 pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data="noop"))
             
             # دکمه بعدی - اگر صفحه آخر نیست، فعال است
-            if page < images_data['total_pages']:
+            if images_data['has_next']:
                 next_page = page + 1
-                pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data=f"images_page_{product_id}_{next_page}"))
+                pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data=f"images_page_{product_id}_{next_page}_{images_data['next_cursor']}"))
             else:
                 pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data="noop"))
             
@@ -1022,7 +1482,7 @@ def handle_images_pagination_callback(call):
             bot.send_photo(
                 chat_id, 
                 first_image['file_id'], 
-                caption=f"📸 **{escape_markdown(product['name'])}**\n\nعکس 1 از {len(images_data['images'])} (صفحه {page} از {images_data['total_pages']})",
+                caption=f"📸 **{escape_markdown(product['name'])}**\n\nعکس {page} از {images_data['total_count']}",
                 parse_mode='Markdown',
                 reply_markup=keyboard
             )
@@ -1031,23 +1491,23 @@ def handle_images_pagination_callback(call):
                 
     except Exception as e:
         logger.error(f"خطا در pagination عکس‌ها: {e}")
-        print(f"DEBUG ERROR: {e}")
         bot.answer_callback_query(call.id, f"❌ خطا در تغییر صفحه عکس‌ها: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('view_all_images_'))
-def handle_view_all_images_callback(call):
+
+@router.route('view_all_images', int)
+def handle_view_all_images_callback(call, product_id):
     """مشاهده عکس‌های محصول با pagination"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     
     try:
         # شروع مشاهده عکس‌ها
-        product_id = int(call.data.replace("view_all_images_", ""))
         page = 1
         logger.info(f"View all images callback: {call.data}, product_id: {product_id}, page: {page}")
         
-        # دریافت اطلاعات محصول
-        product = db.get_product(product_id)
+        # دریافت محصول، اولین عکس و تعداد کل عکس‌ها در یک کوئری
+        images_data = db.get_product_gallery(product_id)
+        product = images_data['product']
         if not product:
             bot.send_message(chat_id, "❌ محصول یافت نشد!", reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("🔙 بازگشت به محصولات", callback_data="menu_products")
@@ -1055,11 +1515,9 @@ def handle_view_all_images_callback(call):
             bot.answer_callback_query(call.id)
             return
         
-        # دریافت عکس‌ها با pagination
-        images_data = db.get_product_images_paginated(product_id, page, per_page=1)
         logger.info(f"Images data: {images_data}")
         
-        if not images_data['images']:
+        if not images_data['image']:
             bot.send_message(chat_id, "❌ هیچ عکسی یافت نشد!", reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("🔙 بازگشت به محصول", callback_data=f"view_product_{product_id}")
             ))
@@ -1073,24 +1531,24 @@ def handle_view_all_images_callback(call):
             pass
         
         # ارسال فقط اولین عکس با pagination
-        if images_data['images']:
-            first_image = images_data['images'][0]
+        if images_data['image']:
+            first_image = images_data['image']
             keyboard = InlineKeyboardMarkup()
             
             # دکمه‌های pagination - همیشه نمایش داده می‌شوند
             pagination_row = []
             
             # دکمه قبلی - اگر صفحه اول نیست، فعال است
-            if page > 1:
+            if images_data['has_prev']:
                 prev_page = page - 1
-                pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data=f"images_page_{product_id}_{prev_page}"))
+                pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data=f"images_page_{product_id}_{prev_page}_{images_data['prev_cursor']}"))
             else:
                 pagination_row.append(InlineKeyboardButton("⬅️ عکس قبلی", callback_data="noop"))
             
             # دکمه بعدی - اگر صفحه آخر نیست، فعال است
-            if page < images_data['total_pages']:
+            if images_data['has_next']:
                 next_page = page + 1
-                pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data=f"images_page_{product_id}_{next_page}"))
+                pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data=f"images_page_{product_id}_{next_page}_{images_data['next_cursor']}"))
             else:
                 pagination_row.append(InlineKeyboardButton("عکس بعدی ➡️", callback_data="noop"))
             
@@ -1100,7 +1558,7 @@ def handle_view_all_images_callback(call):
             bot.send_photo(
                 chat_id, 
                 first_image['file_id'], 
-                caption=f"📸 **{escape_markdown(product['name'])}**\n\nعکس 1 از {len(images_data['images'])} (صفحه {page} از {images_data['total_pages']})",
+                caption=f"📸 **{escape_markdown(product['name'])}**\n\nعکس {page} از {images_data['total_count']}",
                 parse_mode='Markdown',
                 reply_markup=keyboard
             )
@@ -1112,18 +1570,18 @@ def handle_view_all_images_callback(call):
         bot.answer_callback_query(call.id, f"❌ خطا در نمایش عکس‌ها: {str(e)}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('view_product_'))
-def handle_view_product_callback(call):
+@router.route('view_product', int)
+def handle_view_product_callback(call, product_id):
     """نمایش جزئیات محصول"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     user_id = call.from_user.id
-    product_id = int(call.data.replace("view_product_", ""))
 
     # اگر کاربر در حال خرید بود و به صفحه محصول برگشته، وضعیت خرید را لغو کن
     try:
-        if user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'buying_product':
-            del user_states[user_id]
+        if isinstance(conversations.get(user_id), PurchaseState):
+            conversations.clear(user_id)
+
     except Exception:
         pass
 
@@ -1203,17 +1661,12 @@ def handle_view_product_callback(call):
         safe_edit_message(chat_id, message_id, "❌ محصول یافت نشد!", reply_markup=create_user_back_menu())
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('buy_product_'))
-def handle_buy_product_callback(call):
+@router.route('buy_product', int)
+def handle_buy_product_callback(call, product_id):
     """شروع فرآیند خرید: دریافت نشانی ارسال سپس درخواست اسکرین‌شات پرداخت"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     user_id = call.from_user.id
-    try:
-        product_id = int(call.data.replace("buy_product_", ""))
-    except Exception:
-        bot.answer_callback_query(call.id, "❌ داده نامعتبر")
-        return
 
     product = db.get_product(product_id)
     if not product:
@@ -1221,12 +1674,7 @@ def handle_buy_product_callback(call):
         return
 
     # ذخیره وضعیت برای دریافت نشانی ارسال
-    user_states[user_id] = {
-        'action': 'buying_product',
-        'product_id': product_id,
-        'price': float(product['price']),
-        'step': 'waiting_shipping_address'
-    }
+    conversations.set(user_id, PurchaseState('purchase_address', product_id=product_id, price=float(product['price'])))
 
     text = (
         f"🛒 خرید محصول: {escape_markdown(product['name'])}\n\n"
@@ -1241,307 +1689,318 @@ def handle_buy_product_callback(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(('start_registration', 'cancel_registration', 'skip_phone', 'skip_city', 'skip_image', 'skip_description')) or call.data in ['edit_phone', 'edit_first_name', 'edit_last_name', 'edit_city', 'edit_profile'])
-def handle_registration_and_edit_callback(call):
-    """مدیریت ثبت نام و ویرایش پروفایل"""
+@router.route('start_registration')
+def handle_start_registration_callback(call):
+    """شروع فرآیند ثبت نام ساده"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    conversations.set(user_id, RegistrationState('registration_name'))
+    text = (
+        "📝 **ثبت نام سریع**\n\n"
+        "👤 لطفاً نام و نام خانوادگی خود را در یک پیام ارسال کنید:\n\n"
+        "مثال: علی احمدی"
+    )
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
+    ))
+
+
+@router.route('cancel_registration')
+def handle_cancel_registration_callback(call):
+    """لغو ثبت نام"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     user_id = call.from_user.id
+    conversations.clear(user_id)
+    text = "❌ ثبت نام لغو شد."
+    safe_edit_message(chat_id, message_id, text, reply_markup=create_registration_menu())
 
-    if call.data == 'start_registration':
-        # شروع فرآیند ثبت نام ساده
-        user_states[user_id] = 'waiting_name'
+
+@router.route('skip_phone')
+def handle_skip_phone_callback(call):
+    """رد کردن شماره تلفن و رفتن به شهر"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    state = conversations.get(user_id)
+    if isinstance(state, RegistrationState) and state.name == 'registration_phone':
+        state.phone = None
+        conversations.advance(user_id, state, 'registration_city')
+        
         text = (
-            "📝 **ثبت نام سریع**\n\n"
-            "👤 لطفاً نام و نام خانوادگی خود را در یک پیام ارسال کنید:\n\n"
-            "مثال: علی احمدی"
+            "✅ شماره تلفن رد شد\n\n"
+            "🏙️ **شهر (اختیاری):**\n"
+            "شهر خود را ارسال کنید یا Enter بزنید تا رد شود:"
         )
         safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_city"),
             InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
         ))
-        return
-
-    elif call.data == 'cancel_registration':
-        # لغو ثبت نام
-        if user_id in user_states:
-            del user_states[user_id]
-        text = "❌ ثبت نام لغو شد."
-        safe_edit_message(chat_id, message_id, text, reply_markup=create_registration_menu())
-        return
 
-    elif call.data == 'skip_phone':
-        # رد کردن شماره تلفن و رفتن به شهر
-        if user_id in user_states and isinstance(user_states[user_id], dict):
-            user_states[user_id]['phone'] = None
-            user_states[user_id]['step'] = 'waiting_city'
-            
-            text = (
-                "✅ شماره تلفن رد شد\n\n"
-                "🏙️ **شهر (اختیاری):**\n"
-                "شهر خود را ارسال کنید یا Enter بزنید تا رد شود:"
-            )
-            safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_city"),
-                InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
-            ))
-        return
 
-    elif call.data == 'skip_city':
-        # رد کردن شهر و تکمیل ثبت نام
-        if user_id in user_states and isinstance(user_states[user_id], dict):
-            user_data = user_states[user_id].copy()
+@router.route('skip_city')
+def handle_skip_city_callback(call):
+    """رد کردن شهر و تکمیل ثبت نام"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    state = conversations.get(user_id)
+    if isinstance(state, RegistrationState) and state.name == 'registration_city':
+        # ثبت نام در دیتابیس
+        if db.register_user(
+            user_id, 
+            state.first_name,
+            state.last_name,
+            state.phone,
+            None
+        ):
+            # حذف وضعیت ثبت نام
+            conversations.clear(user_id)
             
-            # ثبت نام در دیتابیس
-            if db.register_user(
-                user_id, 
-                user_data['first_name'],
-                user_data['last_name'],
-                user_data.get('phone'),
-                None
-            ):
-                # حذف وضعیت ثبت نام
-                del user_states[user_id]
-                
-                success_text = f"""
+            success_text = f"""
 ✅ **ثبت نام با موفقیت تکمیل شد!**
 
 👤 **اطلاعات شما:**
-👤 نام: {user_data['first_name']} {user_data['last_name']}
-{f"📱 شماره تلفن: {user_data.get('phone')}" if user_data.get('phone') else "📱 شماره تلفن: ثبت نشده"}
+👤 نام: {state.first_name} {state.last_name}
+{f"📱 شماره تلفن: {state.phone}" if state.phone else "📱 شماره تلفن: ثبت نشده"}
 🏙️ شهر: ثبت نشده
 
 🎉 حالا می‌توانید از تمام امکانات ربات استفاده کنید!
-                """
-                safe_edit_message(chat_id, message_id, success_text, reply_markup=create_main_menu())
-            else:
-                safe_edit_message(chat_id, message_id, "❌ خطا در ثبت نام. لطفاً دوباره تلاش کنید.")
-        return
+            """
+            safe_edit_message(chat_id, message_id, success_text, reply_markup=create_main_menu())
+        else:
+            safe_edit_message(chat_id, message_id, "❌ خطا در ثبت نام. لطفاً دوباره تلاش کنید.")
 
-    elif call.data == 'skip_image':
-        # رد کردن عکس محصول
-        if user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'adding_product':
-            user_states[user_id]['image_url'] = None
-            user_states[user_id]['step'] = 'waiting_description'
-            
-            text = (
-                "✅ عکس محصول رد شد\n\n"
-                "📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
-                "توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:"
-            )
-            safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
-                InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-            ))
-        return
 
-    elif call.data == 'skip_description':
-        # رد کردن توضیحات و تکمیل افزودن محصول
-        if user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'adding_product':
-            user_data = user_states[user_id].copy()
-            user_data['description'] = None
-            
-            # ذخیره محصول در دیتابیس
-            if db.add_product(
-                user_data['name'],
-                user_data['price'],
-                user_data.get('image_url'),
-                user_data.get('description')
-            ):
-                # ثبت لاگ افزودن موفق (skip توضیحات)
-                try:
-                    db.add_log(user_id, 'product_add_success', f'افزودن محصول جدید (skip توضیحات): {user_data["name"]} - {user_data["price"]:,} تومان')
-                except:
-                    pass
-                del user_states[user_id]
-                success_text = f"""
+@router.route('skip_image')
+def handle_skip_image_callback(call):
+    """رد کردن عکس محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    state = conversations.get(user_id)
+    if isinstance(state, ProductDraftState):
+        state.image_url = None
+        conversations.advance(user_id, state, 'product_description')
+        
+        text = (
+            "✅ عکس محصول رد شد\n\n"
+            "📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
+            "توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:"
+        )
+        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
+            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+        ))
+
+
+@router.route('skip_description')
+def handle_skip_description_callback(call):
+    """رد کردن توضیحات و تکمیل افزودن محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    state = conversations.get(user_id)
+    if isinstance(state, ProductDraftState) and state.name == 'product_description':
+        state.description = None
+        
+        # ذخیره محصول در دیتابیس
+        if db.add_product(
+            state.product_name,
+            state.price,
+            state.image_url,
+            state.description,
+            first_image=get_pending_product_image(state)
+        ):
+            # ثبت لاگ افزودن موفق (skip توضیحات)
+            try:
+                db.add_log(user_id, 'product_add_success', f'افزودن محصول جدید (skip توضیحات): {state.product_name} - {state.price:,} تومان')
+            except:
+                pass
+            conversations.clear(user_id)
+            success_text = f"""
 ✅ **محصول با موفقیت اضافه شد!**
 
 🛍️ **اطلاعات محصول:**
-📝 نام: {user_data['name']}
-💰 قیمت: {user_data['price']:,} تومان
-🖼️ عکس: {'✅' if user_data.get('image_url') else '❌'}
+📝 نام: {state.product_name}
+💰 قیمت: {state.price:,} تومان
+🖼️ عکس: {'✅' if state.image_url else '❌'}
 📄 توضیحات: ❌
-                """
-                safe_edit_message(chat_id, message_id, success_text, reply_markup=create_products_menu())
-            else:
-                # ثبت لاگ خطا در افزودن
-                try:
-                    db.add_log(user_id, 'product_add_failed', f'خطا در افزودن محصول (skip توضیحات): {user_data["name"]}')
-                except:
-                    pass
-                safe_edit_message(chat_id, message_id, "❌ خطا در افزودن محصول. لطفاً دوباره تلاش کنید.")
-        return
+            """
+            safe_edit_message(chat_id, message_id, success_text, reply_markup=create_products_menu())
+        else:
+            # ثبت لاگ خطا در افزودن
+            try:
+                db.add_log(user_id, 'product_add_failed', f'خطا در افزودن محصول (skip توضیحات): {state.product_name}')
+            except:
+                pass
+            safe_edit_message(chat_id, message_id, "❌ خطا در افزودن محصول. لطفاً دوباره تلاش کنید.")
 
-    elif call.data == 'edit_profile':
-        # نمایش منوی ویرایش پروفایل
-        text = "✏️ **ویرایش پروفایل**\n\nکدام فیلد را می‌خواهید ویرایش کنید؟"
-        safe_edit_message(chat_id, message_id, text, reply_markup=create_profile_edit_menu())
-        return
 
-    elif call.data.startswith('edit_'):
-        # شروع ویرایش فیلد خاص
-        field = call.data.replace('edit_', '')
-        field_names = {
-            'phone': 'شماره تلفن',
-            'first_name': 'نام',
-            'last_name': 'نام خانوادگی',
-            'city': 'شهر'
-        }
-        
-        if field in field_names:
-            user_states[user_id] = f'editing_{field}'
-            text = f"✏️ **ویرایش {field_names[field]}**\n\nلطفاً {field_names[field]} جدید را ارسال کنید:"
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
-        return
+@router.route('edit_profile')
+def handle_edit_profile_callback(call):
+    """نمایش منوی ویرایش پروفایل"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    text = "✏️ **ویرایش پروفایل**\n\nکدام فیلد را می‌خواهید ویرایش کنید؟"
+    safe_edit_message(chat_id, message_id, text, reply_markup=create_profile_edit_menu())
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(('add_product_image_', 'manage_images_', 'delete_image_')))
-def handle_image_management_callback(call):
-    """مدیریت عکس‌های محصولات"""
+def start_profile_field_edit(call, field):
+    """شروع ویرایش فیلد خاص"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     user_id = call.from_user.id
+    field_names = {
+        'phone': 'شماره تلفن',
+        'first_name': 'نام',
+        'last_name': 'نام خانوادگی',
+        'city': 'شهر'
+    }
     
-    # Debug log
-    logger.info(f"Image management callback: {call.data} from user {user_id}")
-    
-    # بررسی اعتبار session
-    if not is_admin_session_valid(user_id):
-        logger.warning(f"Admin session invalid for user {user_id} in image management")
-        bot.answer_callback_query(call.id, "❌ Session منقضی شده! دوباره وارد شوید.")
-        return
-    
+    if field in field_names:
+        conversations.set(user_id, ProfileEditState('profile_edit', field=field))
+        text = f"✏️ **ویرایش {field_names[field]}**\n\nلطفاً {field_names[field]} جدید را ارسال کنید:"
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_user_back_menu())
+
+
+for field in ('phone', 'first_name', 'last_name', 'city'):
+    router.route(f'edit_{field}')(partial(start_profile_field_edit, field=field))
+
+
+@router.route('add_product_image', int)
+@admin_callback
+def handle_add_product_image_callback(call, product_id):
+    """افزودن عکس جدید به محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
     bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductEditState('product_image_add', product_id=product_id))
     
-    if call.data.startswith("add_product_image_"):
-        # افزودن عکس جدید به محصول
-        product_id = int(call.data.replace("add_product_image_", ""))
-        user_states[user_id] = {'action': 'adding_image', 'product_id': product_id}
-        
-        text = f"🖼️ **افزودن عکس جدید به محصول**\n\nعکس جدید را ارسال کنید:"
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
-        ))
-        return
+    text = f"🖼️ **افزودن عکس جدید به محصول**\n\nعکس جدید را ارسال کنید:"
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
+    ))
 
-    elif call.data.startswith("manage_images_"):
-        # مدیریت عکس‌های محصول
-        product_id = int(call.data.replace("manage_images_", ""))
-        images = db.get_product_images(product_id)
+
+@router.route('manage_images', int)
+@admin_callback
+def handle_manage_images_callback(call, product_id):
+    """مدیریت عکس‌های محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    bot.answer_callback_query(call.id)
+    images = db.get_product_images(product_id)
+    
+    if not images:
+        text = "🖼️ **مدیریت عکس‌های محصول**\n\n❌ هیچ عکسی برای این محصول وجود ندارد."
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("➕ افزودن عکس", callback_data=f"add_product_image_{product_id}"))
+        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_product_{product_id}"))
+    else:
+        text = f"🖼️ **مدیریت عکس‌های محصول**\n\n📊 تعداد عکس‌ها: {len(images)}\n\n"
+        keyboard = InlineKeyboardMarkup()
         
-        if not images:
-            text = "🖼️ **مدیریت عکس‌های محصول**\n\n❌ هیچ عکسی برای این محصول وجود ندارد."
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("➕ افزودن عکس", callback_data=f"add_product_image_{product_id}"))
-            keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_product_{product_id}"))
-        else:
-            text = f"🖼️ **مدیریت عکس‌های محصول**\n\n📊 تعداد عکس‌ها: {len(images)}\n\n"
-            keyboard = InlineKeyboardMarkup()
-            
-            for i, img in enumerate(images[:5], 1):  # حداکثر 5 عکس
-                keyboard.add(InlineKeyboardButton(
-                    f"🗑️ حذف عکس {i}", 
-                    callback_data=f"delete_image_{img['id']}"
-                ))
-            
-            keyboard.add(InlineKeyboardButton("➕ افزودن عکس", callback_data=f"add_product_image_{product_id}"))
-            keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_product_{product_id}"))
+        for i, img in enumerate(images[:5], 1):  # حداکثر 5 عکس
+            keyboard.add(InlineKeyboardButton(
+                f"🗑️ حذف عکس {i}", 
+                callback_data=f"delete_image_{img['id']}"
+            ))
         
-        safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
-        return
+        keyboard.add(InlineKeyboardButton("➕ افزودن عکس", callback_data=f"add_product_image_{product_id}"))
+        keyboard.add(InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_product_{product_id}"))
+    
+    safe_edit_message(chat_id, message_id, text, reply_markup=keyboard)
 
-    elif call.data.startswith("delete_image_"):
-        # حذف عکس محصول
-        image_id = int(call.data.replace("delete_image_", ""))
-        
-        if db.delete_product_image(image_id):
-            text = "✅ عکس با موفقیت حذف شد!"
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
-        else:
-            text = "❌ خطا در حذف عکس!"
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
-        return
 
+@router.route('delete_image', int)
+@admin_callback
+def handle_delete_image_callback(call, image_id):
+    """حذف عکس محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    bot.answer_callback_query(call.id)
+    
+    if db.delete_product_image(image_id):
+        text = "✅ عکس با موفقیت حذف شد!"
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
+    else:
+        text = "❌ خطا در حذف عکس!"
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_products_page_'))
-def handle_admin_products_pagination_callback(call):
+@router.route('admin_products_page', int, str)
+@admin_callback
+def handle_admin_products_pagination_callback(call, page, cursor):
     """مدیریت pagination محصولات ادمین"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     
     try:
         # تغییر صفحه محصولات ادمین
-        page = int(call.data.replace("admin_products_page_", ""))
+        page, cursor = page_position(page, cursor)
         logger.info(f"Admin products page callback: {call.data}, page: {page}")
-        print(f"DEBUG: Admin products page callback: {call.data}, page: {page}")
-        products_data = db.get_products_paginated(page, per_page=10)
-        logger.info(f"Admin products data: {products_data}")
-        print(f"DEBUG: Admin products data: {products_data}")
+        page_view = get_products_page_view(cursor, page, per_page=10, is_admin=True)
         
         # بررسی اینکه آیا محصولات وجود دارند
-        if not products_data['products']:
+        if page_view is None:
             bot.answer_callback_query(call.id, "❌ هیچ محصولی در این صفحه وجود ندارد")
             return
             
-        display_admin_products_page(chat_id, message_id, products_data)
-        bot.answer_callback_query(call.id, f"صفحه {page} از {products_data['total_pages']}")
+        display_admin_products_page(chat_id, message_id, page_view)
+        bot.answer_callback_query(call.id, f"صفحه {page} از {page_view[2]}")
     except Exception as e:
         logger.error(f"خطا در pagination محصولات ادمین: {e}")
-        print(f"DEBUG ERROR: {e}")
         bot.answer_callback_query(call.id, f"❌ خطا در تغییر صفحه محصولات: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(('add_product', 'list_products', 'manage_product_', 'edit_product_', 'delete_product_')))
-def handle_products_callback(call):
-    """مدیریت محصولات"""
+
+@router.route('add_product')
+@admin_callback
+def handle_add_product_callback(call):
+    """شروع افزودن محصول"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
     user_id = call.from_user.id
-    
-    # Debug log
-    logger.info(f"Products callback: {call.data} from user {user_id}")
-    
-    # بررسی اعتبار session
-    if not is_admin_session_valid(user_id):
-        logger.warning(f"Admin session invalid for user {user_id}")
-        bot.answer_callback_query(call.id, "❌ Session منقضی شده! دوباره وارد شوید.")
-        return
-    
-    # پاسخ به callback query
     bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductDraftState('product_name'))
+    text = (
+        "➕ **افزودن محصول جدید**\n\n"
+        "📝 **مرحله 1/4: نام محصول**\n"
+        "لطفاً نام محصول را ارسال کنید:"
+    )
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+    ))
 
-    if call.data == "add_product":
-        # شروع افزودن محصول
-        user_states[user_id] = {'action': 'adding_product', 'step': 'waiting_name'}
-        text = (
-            "➕ **افزودن محصول جدید**\n\n"
-            "📝 **مرحله 1/4: نام محصول**\n"
-            "لطفاً نام محصول را ارسال کنید:"
-        )
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-        ))
-        return
-
-    elif call.data == "list_products":
-        # نمایش لیست محصولات - صفحه اول
-        page = 1
-        products_data = db.get_products_paginated(page, per_page=10)
-        display_admin_products_page(chat_id, message_id, products_data)
-        return
-    
 
-    elif call.data.startswith("manage_product_"):
-        # مدیریت یک محصول خاص
-        product_id = int(call.data.replace("manage_product_", ""))
-        product = db.get_product(product_id)
+@router.route('list_products')
+@admin_callback
+def handle_list_products_callback(call):
+    """نمایش لیست محصولات - صفحه اول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    bot.answer_callback_query(call.id)
+    display_admin_products_page(chat_id, message_id, get_products_page_view(per_page=10, is_admin=True))
+
+
+
+@router.route('manage_product', int)
+@admin_callback
+def handle_manage_product_callback(call, product_id):
+    """مدیریت یک محصول خاص"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    bot.answer_callback_query(call.id)
+    product = db.get_product(product_id)
+    
+    if product:
+        # دریافت عکس‌های محصول
+        images = db.get_product_images(product_id)
+        image_count = len(images)
         
-        if product:
-            # دریافت عکس‌های محصول
-            images = db.get_product_images(product_id)
-            image_count = len(images)
-            
-            text = f"""
+        text = f"""
 🛍️ **مدیریت محصول**
 
 📝 **نام:** {escape_markdown(product['name'])}
@@ -1549,80 +2008,180 @@ def handle_products_callback(call):
 🖼️ **عکس‌ها:** {image_count} عکس {'✅' if image_count > 0 else '❌'}
 📄 **توضیحات:** {'✅' if product['description'] else '❌'}
 📅 **تاریخ ایجاد:** {product['created_at'].strftime('%Y/%m/%d %H:%M')}
-            """
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_product_edit_menu(product_id))
-        else:
-            safe_edit_message(chat_id, message_id, "❌ محصول یافت نشد!", reply_markup=create_products_menu())
-        
-        return
+        """
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_product_edit_menu(product_id))
+    else:
+        safe_edit_message(chat_id, message_id, "❌ محصول یافت نشد!", reply_markup=create_products_menu())
 
-    elif call.data.startswith("edit_product_name_"):
-        # ویرایش نام محصول
-        product_id = int(call.data.replace("edit_product_name_", ""))
-        user_states[user_id] = {'action': 'editing_product', 'product_id': product_id, 'field': 'name'}
-        
-        text = f"✏️ **ویرایش نام محصول**\n\nنام جدید را ارسال کنید:"
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
-        ))
-        return
 
-    elif call.data.startswith("edit_product_price_"):
-        # ویرایش قیمت محصول
-        product_id = int(call.data.replace("edit_product_price_", ""))
-        user_states[user_id] = {'action': 'editing_product', 'product_id': product_id, 'field': 'price'}
-        
-        text = f"💰 **ویرایش قیمت محصول**\n\nقیمت جدید را به تومان ارسال کنید:"
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
-        ))
-        return
+@router.route('edit_product_name', int)
+@admin_callback
+def handle_edit_product_name_callback(call, product_id):
+    """ویرایش نام محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductEditState('product_edit', product_id=product_id, field='name'))
+    
+    text = f"✏️ **ویرایش نام محصول**\n\nنام جدید را ارسال کنید:"
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
+    ))
 
-    elif call.data.startswith("edit_product_image_"):
-        # ویرایش عکس محصول
-        product_id = int(call.data.replace("edit_product_image_", ""))
-        user_states[user_id] = {'action': 'editing_product', 'product_id': product_id, 'field': 'image_url'}
-        
-        text = f"🖼️ **ویرایش عکس محصول**\n\nعکس جدید را ارسال کنید یا لینک عکس را وارد کنید:"
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
-        ))
-        return
 
-    elif call.data.startswith("edit_product_desc_"):
-        # ویرایش توضیحات محصول
-        product_id = int(call.data.replace("edit_product_desc_", ""))
-        user_states[user_id] = {'action': 'editing_product', 'product_id': product_id, 'field': 'description'}
-        
-        text = f"📝 **ویرایش توضیحات محصول**\n\nتوضیحات جدید را ارسال کنید:"
-        safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
-            InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
-        ))
-        return
+@router.route('edit_product_price', int)
+@admin_callback
+def handle_edit_product_price_callback(call, product_id):
+    """ویرایش قیمت محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductEditState('product_edit', product_id=product_id, field='price'))
+    
+    text = f"💰 **ویرایش قیمت محصول**\n\nقیمت جدید را به تومان ارسال کنید:"
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
+    ))
 
-    elif call.data.startswith("delete_product_"):
-        # حذف محصول
-        product_id = int(call.data.replace("delete_product_", ""))
-        product = db.get_product(product_id)
-        
-        if product and db.delete_product(product_id):
-            # ثبت لاگ حذف موفق
-            try:
-                db.add_log(user_id, 'product_delete_success', f'حذف محصول {product_id} ({product["name"]}) توسط ادمین')
-            except:
-                pass
-            text = f"✅ محصول '{product['name']}' با موفقیت حذف شد!"
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
+
+@router.route('edit_product_image', int)
+@admin_callback
+def handle_edit_product_image_callback(call, product_id):
+    """ویرایش عکس محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductEditState('product_edit_image', product_id=product_id, field='image_url'))
+    
+    text = f"🖼️ **ویرایش عکس محصول**\n\nعکس جدید را ارسال کنید یا لینک عکس را وارد کنید:"
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
+    ))
+
+
+@router.route('edit_product_desc', int)
+@admin_callback
+def handle_edit_product_desc_callback(call, product_id):
+    """ویرایش توضیحات محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    bot.answer_callback_query(call.id)
+    conversations.set(user_id, ProductEditState('product_edit', product_id=product_id, field='description'))
+
+    
+    text = f"📝 **ویرایش توضیحات محصول**\n\nتوضیحات جدید را ارسال کنید:"
+    safe_edit_message(chat_id, message_id, text, reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("❌ لغو", callback_data=f"manage_product_{product_id}")
+    ))
+
+
+@router.route('delete_product', int)
+@admin_callback
+def handle_delete_product_callback(call, product_id):
+    """حذف محصول"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    user_id = call.from_user.id
+    bot.answer_callback_query(call.id)
+    product = db.get_product(product_id)
+    
+    if product and db.delete_product(product_id):
+        # ثبت لاگ حذف موفق
+        try:
+            db.add_log(user_id, 'product_delete_success', f'حذف محصول {product_id} ({product["name"]}) توسط ادمین')
+        except:
+            pass
+        text = f"✅ محصول '{product['name']}' با موفقیت حذف شد!"
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
+    else:
+        # ثبت لاگ خطا در حذف
+        try:
+            db.add_log(user_id, 'product_delete_failed', f'خطا در حذف محصول {product_id}')
+        except:
+            pass
+        text = "❌ خطا در حذف محصول!"
+        safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
+
+
+@conversations.on('product_image', 'photo')
+def handle_product_draft_photo(message, state):
+    """دریافت عکس محصول در حال افزودن"""
+    user_id = message.from_user.id
+    # ذخیره اطلاعات عکس
+    photo = message.photo[-1]  # بزرگترین سایز عکس
+    state.image_file_id = photo.file_id
+    state.image_file_unique_id = photo.file_unique_id
+    state.image_file_size = photo.file_size
+    state.image_width = photo.width
+    state.image_height = photo.height
+    conversations.advance(user_id, state, 'product_description')
+    
+    text = (
+        f"✅ عکس محصول دریافت شد!\n\n"
+        f"📏 سایز: {photo.width}x{photo.height}\n"
+        f"📁 حجم: {photo.file_size} بایت\n\n"
+        f"📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
+        f"توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:"
+    )
+    safe_edit_last_admin_message(
+        user_id,
+        text,
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
+            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+        )
+    )
+
+
+@conversations.on('product_edit_image', 'photo')
+@conversations.on('product_image_add', 'photo')
+def handle_product_image_photo(message, state):
+    """افزودن عکس جدید به محصول (از منوی ویرایش یا مدیریت عکس‌ها)، بدون حذف عکس‌های قبلی"""
+    user_id = message.from_user.id
+    product_id = state.product_id
+    photo = message.photo[-1]
+    
+    if db.add_product_image(
+        product_id, 
+        photo.file_id, 
+        photo.file_unique_id, 
+        photo.file_size, 
+        photo.width, 
+        photo.height
+    ):
+        conversations.clear(user_id)
+        product = db.get_product_with_images(product_id)
+        if product:
+            success_text = f"✅ عکس جدید با موفقیت اضافه شد!\n\n📏 سایز: {photo.width}x{photo.height}\n📊 تعداد کل عکس‌ها: {len(product.get('images', []))}"
+            safe_edit_last_admin_message(user_id, success_text, reply_markup=create_product_edit_menu(product_id))
         else:
-            # ثبت لاگ خطا در حذف
-            try:
-                db.add_log(user_id, 'product_delete_failed', f'خطا در حذف محصول {product_id}')
-            except:
-                pass
-            text = "❌ خطا در حذف محصول!"
-            safe_edit_message(chat_id, message_id, text, reply_markup=create_products_menu())
-        
-        return
+            safe_edit_last_admin_message(user_id, "✅ عکس اضافه شد!", reply_markup=create_products_menu())
+    else:
+        safe_edit_last_admin_message(user_id, "❌ خطا در اضافه کردن عکس. لطفاً دوباره تلاش کنید.")
+
+
+@conversations.on('purchase_screenshot', 'photo')
+def handle_purchase_screenshot(message, state):
+    """دریافت اسکرین‌شات پرداخت و ایجاد سفارش در انتظار تایید"""
+    user_id = message.from_user.id
+    photo = message.photo[-1]
+    order_id = db.create_order(user_id, state.product_id, state.price, photo.file_id, state.shipping_address)
+    if order_id:
+        conversations.clear(user_id)
+        confirm_text = (
+            f"✅ اسکرین‌شات پرداخت دریافت شد.\n\n"
+            f"🧾 شناسه سفارش: #{order_id}\n"
+            "⏳ سفارش شما در وضعیت در انتظار تایید است. پس از تایید ادمین، پیام تایید برای شما ارسال خواهد شد."
+        )
+        safe_edit_last_admin_message(user_id, confirm_text, reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("🧾 مشاهده سفارشات", callback_data="menu_orders")
+        ))
+    else:
+        safe_edit_last_admin_message(user_id, "❌ خطا در ثبت سفارش. لطفاً دوباره تلاش کنید.")
 
 
 @bot.message_handler(content_types=['photo'])
@@ -1631,109 +2190,10 @@ def handle_photo(message):
     user_id = message.from_user.id
     
     # Debug log
-    logger.info(f"Photo received from user {user_id}, user_states: {user_states.get(user_id)}")
+    logger.info(f"Photo received from user {user_id}, state: {conversations.get(user_id)}")
     
-    # بررسی اینکه آیا کاربر در حال اضافه کردن عکس به محصول است
-    if user_id in user_states and isinstance(user_states[user_id], dict):
-        user_data = user_states[user_id]
-        
-        if user_data.get('action') == 'adding_product' and user_data.get('step') == 'waiting_image':
-            # ذخیره اطلاعات عکس
-            photo = message.photo[-1]  # بزرگترین سایز عکس
-            user_states[user_id]['image_file_id'] = photo.file_id
-            user_states[user_id]['image_file_unique_id'] = photo.file_unique_id
-            user_states[user_id]['image_file_size'] = photo.file_size
-            user_states[user_id]['image_width'] = photo.width
-            user_states[user_id]['image_height'] = photo.height
-            user_states[user_id]['step'] = 'waiting_description'
-            
-            text = (
-                f"✅ عکس محصول دریافت شد!\n\n"
-                f"📏 سایز: {photo.width}x{photo.height}\n"
-                f"📁 حجم: {photo.file_size} بایت\n\n"
-                f"📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
-                f"توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:"
-            )
-            safe_edit_last_admin_message(
-                user_id,
-                text,
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
-                    InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-                )
-            )
-            return
-        
-        elif user_data.get('action') == 'editing_product' and user_data.get('field') == 'image_url':
-            # افزودن عکس جدید به محصول (از منوی ویرایش)
-            product_id = user_data['product_id']
-            photo = message.photo[-1]
-            
-            # اضافه کردن عکس جدید (بدون حذف عکس‌های قبلی)
-            if db.add_product_image(
-                product_id, 
-                photo.file_id, 
-                photo.file_unique_id, 
-                photo.file_size, 
-                photo.width, 
-                photo.height
-            ):
-                del user_states[user_id]
-                product = db.get_product_with_images(product_id)
-                if product:
-                    success_text = f"✅ عکس جدید با موفقیت اضافه شد!\n\n📏 سایز: {photo.width}x{photo.height}\n📊 تعداد کل عکس‌ها: {len(product.get('images', []))}"
-                    safe_edit_last_admin_message(user_id, success_text, reply_markup=create_product_edit_menu(product_id))
-                else:
-                    safe_edit_last_admin_message(user_id, "✅ عکس اضافه شد!", reply_markup=create_products_menu())
-            else:
-                safe_edit_last_admin_message(user_id, "❌ خطا در اضافه کردن عکس. لطفاً دوباره تلاش کنید.")
-            return
-        
-        elif user_data.get('action') == 'adding_image':
-            # افزودن عکس جدید به محصول (از منوی مدیریت عکس‌ها)
-            product_id = user_data['product_id']
-            photo = message.photo[-1]
-            
-            # اضافه کردن عکس جدید
-            if db.add_product_image(
-                product_id, 
-                photo.file_id, 
-                photo.file_unique_id, 
-                photo.file_size, 
-                photo.width, 
-                photo.height
-            ):
-                del user_states[user_id]
-                product = db.get_product_with_images(product_id)
-                if product:
-                    success_text = f"✅ عکس جدید با موفقیت اضافه شد!\n\n📏 سایز: {photo.width}x{photo.height}\n📊 تعداد کل عکس‌ها: {len(product.get('images', []))}"
-                    safe_edit_last_admin_message(user_id, success_text, reply_markup=create_product_edit_menu(product_id))
-                else:
-                    safe_edit_last_admin_message(user_id, "✅ عکس اضافه شد!", reply_markup=create_products_menu())
-            else:
-                safe_edit_last_admin_message(user_id, "❌ خطا در اضافه کردن عکس. لطفاً دوباره تلاش کنید.")
-            return
-
-        elif user_data.get('action') == 'buying_product' and user_data.get('step') == 'waiting_payment_screenshot':
-            # دریافت اسکرین‌شات پرداخت و ایجاد سفارش در انتظار تایید
-            product_id = user_data['product_id']
-            price = user_data['price']
-            shipping_address = user_data.get('shipping_address')
-            photo = message.photo[-1]
-            order_id = db.create_order(user_id, product_id, price, photo.file_id, shipping_address)
-            if order_id:
-                del user_states[user_id]
-                confirm_text = (
-                    f"✅ اسکرین‌شات پرداخت دریافت شد.\n\n"
-                    f"🧾 شناسه سفارش: #{order_id}\n"
-                    "⏳ سفارش شما در وضعیت در انتظار تایید است. پس از تایید ادمین، پیام تایید برای شما ارسال خواهد شد."
-                )
-                safe_edit_last_admin_message(user_id, confirm_text, reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("🧾 مشاهده سفارشات", callback_data="menu_orders")
-                ))
-            else:
-                safe_edit_last_admin_message(user_id, "❌ خطا در ثبت سفارش. لطفاً دوباره تلاش کنید.")
-            return
+    if conversations.dispatch(message, 'photo'):
+        return
     
     # اگر عکس برای محصول ارسال نشده، پیام پیش‌فرض
     try:
@@ -1761,320 +2221,312 @@ def send_help(message):
 
 
 
-@bot.message_handler(func=lambda message: True)
-def handle_text(message):
-    """پردازش پیام‌های متنی"""
+@conversations.on('broadcast_city')
+def handle_broadcast_city(message, state):
+    """دریافت نام شهر برای ارسال همگانی"""
     user_id = message.from_user.id
     text = message.text.strip()
-    
-    # بررسی وضعیت کاربر
-    if user_id in user_states and user_states[user_id] == 'waiting_password':
-        # کاربر در حال وارد کردن رمز است
-        admin_panel(message)
-        return
-    
-    elif user_id in user_states and user_states[user_id] == 'waiting_broadcast':
-        # کاربر در حال ارسال پیام broadcast است
-        if is_admin_session_valid(user_id):
-            broadcast_text = message.text.strip()
-            if not broadcast_text:
-                bot.reply_to(message, "❌ لطفاً پیام خود را ارسال کنید.")
-                return
-            
-            try:
-                users = db.get_all_users()
-                sent_count = 0
-                failed_count = 0
-                
-                # ارسال پیام به صورت تدریجی
-                for user in users:
-                    try:
-                        bot.send_message(user['user_id'], f"📢 **پیام ادمین:**\n\n{broadcast_text}", parse_mode='Markdown')
-                        sent_count += 1
-                    except Exception as e:
-                        failed_count += 1
-                        logger.error(f"خطا در ارسال پیام به کاربر {user['user_id']}: {e}")
-                
-                # ثبت لاگ
-                db.add_log(user_id, 'broadcast_sent', f'ارسال پیام به {sent_count} کاربر')
-                
-                result_text = f"""
-✅ **ارسال پیام تکمیل شد**
+    if is_admin_session_valid(user_id):
+        if not text:
+            bot.reply_to(message, "❌ لطفاً نام شهر را ارسال کنید.")
+            return
+        safe_edit_last_admin_message(user_id, request_broadcast_text(user_id, 'city', text),
+                                     reply_markup=create_back_menu())
+    else:
+        safe_edit_last_admin_message(user_id, "❌ Session ادمین منقضی شده! دوباره وارد شوید.")
+        conversations.clear(user_id)
 
-📊 **نتایج:**
-• ارسال موفق: {sent_count}
-• ارسال ناموفق: {failed_count}
-• کل کاربران: {len(users)}
-                """
-                safe_edit_last_admin_message(user_id, result_text, reply_markup=create_back_menu())
-                
-            except Exception as e:
-                logger.error(f"خطا در ارسال پیام عمومی: {e}")
-                safe_edit_last_admin_message(user_id, f"❌ خطا در ارسال پیام: {str(e)}")
-            
-            # حذف وضعیت انتظار
-            del user_states[user_id]
-        else:
-            safe_edit_last_admin_message(user_id, "❌ Session ادمین منقضی شده! دوباره وارد شوید.")
-            del user_states[user_id]
-        return
-    
-    elif user_id in user_states and user_states[user_id] == 'waiting_name':
-        # دریافت نام و نام خانوادگی
-        name_parts = text.strip().split()
-        if len(name_parts) < 2:
-            bot.reply_to(message, 
-                "❌ لطفاً نام و نام خانوادگی را با فاصله جدا کنید:\n\nمثال: علی احمدی",
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
-                )
-            )
+
+@conversations.on('broadcast_text')
+def handle_broadcast_text(message, state):
+    """دریافت پیام broadcast و شروع ارسال همگانی"""
+    user_id = message.from_user.id
+    if is_admin_session_valid(user_id):
+        broadcast_text = message.text.strip()
+        if not broadcast_text:
+            bot.reply_to(message, "❌ لطفاً پیام خود را ارسال کنید.")
             return
         
-        first_name = name_parts[0]
-        last_name = ' '.join(name_parts[1:])
-        
-        # ذخیره نام و درخواست شماره تلفن
-        user_states[user_id] = {
-            'first_name': first_name,
-            'last_name': last_name,
-            'step': 'waiting_phone'
-        }
-        
-        bot.reply_to(message, 
-            f"✅ نام دریافت شد: {first_name} {last_name}\n\n"
-            "📱 **شماره تلفن (اختیاری):**\n"
-            "شماره تلفن خود را ارسال کنید یا Enter بزنید تا رد شود:",
-            reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_phone"),
-                InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
+        try:
+            # ارسال در پس‌زمینه انجام می‌شود و پیشرفت روی آخرین پیام ادمین نمایش داده می‌شود
+            job = broadcast_engine.start(
+                user_id,
+                broadcast_text,
+                total=state.total,
+                on_progress=report_broadcast_progress,
+                on_finish=report_broadcast_finished,
+                segment=state.segment,
+                segment_value=state.segment_value
             )
-        )
-        return
-    
-    elif user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('step') == 'waiting_phone':
-        # دریافت شماره تلفن
-        user_data = user_states[user_id].copy()
-        phone = text.strip() if text.strip() else None
-        
-        # ذخیره شماره تلفن و درخواست شهر
-        user_states[user_id]['phone'] = phone
-        user_states[user_id]['step'] = 'waiting_city'
-        
+            safe_edit_last_admin_message(user_id, format_broadcast_progress(job), reply_markup=create_broadcast_controls(job))
+            
+        except Exception as e:
+            logger.error(f"خطا در ارسال پیام عمومی: {e}")
+            safe_edit_last_admin_message(user_id, f"❌ خطا در ارسال پیام: {str(e)}")
+    else:
+        safe_edit_last_admin_message(user_id, "❌ Session ادمین منقضی شده! دوباره وارد شوید.")
+    # حذف وضعیت انتظار
+    conversations.clear(user_id)
+
+
+@conversations.on('registration_name')
+def handle_registration_name(message, state):
+    """دریافت نام و نام خانوادگی"""
+    user_id = message.from_user.id
+    name_parts = message.text.strip().split()
+    if len(name_parts) < 2:
         bot.reply_to(message, 
-            f"✅ شماره تلفن دریافت شد: {phone if phone else 'رد شد'}\n\n"
-            "🏙️ **شهر (اختیاری):**\n"
-            "شهر خود را ارسال کنید یا Enter بزنید تا رد شود:",
+            "❌ لطفاً نام و نام خانوادگی را با فاصله جدا کنید:\n\nمثال: علی احمدی",
             reply_markup=InlineKeyboardMarkup().add(
-                InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_city"),
                 InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
             )
         )
         return
     
-    elif user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('step') == 'waiting_city':
-        # دریافت شهر و تکمیل ثبت نام
-        user_data = user_states[user_id].copy()
-        city = text.strip() if text.strip() else None
+    # ذخیره نام و درخواست شماره تلفن
+    state.first_name = name_parts[0]
+    state.last_name = ' '.join(name_parts[1:])
+    conversations.advance(user_id, state, 'registration_phone')
+    
+    bot.reply_to(message, 
+        f"✅ نام دریافت شد: {state.first_name} {state.last_name}\n\n"
+        "📱 **شماره تلفن (اختیاری):**\n"
+        "شماره تلفن خود را ارسال کنید یا Enter بزنید تا رد شود:",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_phone"),
+            InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
+        )
+    )
+
+
+@conversations.on('registration_phone')
+def handle_registration_phone(message, state):
+    """دریافت شماره تلفن"""
+    user_id = message.from_user.id
+    phone = message.text.strip() or None
+    
+    # ذخیره شماره تلفن و درخواست شهر
+    state.phone = phone
+    conversations.advance(user_id, state, 'registration_city')
+    
+    bot.reply_to(message, 
+        f"✅ شماره تلفن دریافت شد: {phone if phone else 'رد شد'}\n\n"
+        "🏙️ **شهر (اختیاری):**\n"
+        "شهر خود را ارسال کنید یا Enter بزنید تا رد شود:",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_city"),
+            InlineKeyboardButton("❌ لغو", callback_data="cancel_registration")
+        )
+    )
+
+
+@conversations.on('registration_city')
+def handle_registration_city(message, state):
+    """دریافت شهر و تکمیل ثبت نام"""
+    user_id = message.from_user.id
+    city = message.text.strip() or None
+    
+    # ثبت نام در دیتابیس
+    if db.register_user(
+        user_id, 
+        state.first_name,
+        state.last_name,
+        state.phone,
+        city
+    ):
+        # حذف وضعیت ثبت نام
+        conversations.clear(user_id)
         
-        # ثبت نام در دیتابیس
-        if db.register_user(
-            user_id, 
-            user_data['first_name'],
-            user_data['last_name'],
-            user_data.get('phone'),
-            city
-        ):
-            # حذف وضعیت ثبت نام
-            del user_states[user_id]
-            
-            success_text = f"""
+        success_text = f"""
 ✅ **ثبت نام با موفقیت تکمیل شد!**
 
 👤 **اطلاعات شما:**
-👤 نام: {user_data['first_name']} {user_data['last_name']}
-{f"📱 شماره تلفن: {user_data.get('phone')}" if user_data.get('phone') else "📱 شماره تلفن: ثبت نشده"}
+👤 نام: {state.first_name} {state.last_name}
+{f"📱 شماره تلفن: {state.phone}" if state.phone else "📱 شماره تلفن: ثبت نشده"}
 {f"🏙️ شهر: {city}" if city else "🏙️ شهر: ثبت نشده"}
 
 🎉 حالا می‌توانید از تمام امکانات ربات استفاده کنید!
-            """
-            bot.reply_to(message, success_text, parse_mode='Markdown', reply_markup=create_main_menu())
-        else:
-            bot.reply_to(message, "❌ خطا در ثبت نام. لطفاً دوباره تلاش کنید.")
-        return
-    
-    elif user_id in user_states and isinstance(user_states[user_id], str) and user_states[user_id].startswith('editing_'):
-        # ویرایش پروفایل
-        field = user_states[user_id].replace('editing_', '')
-        
-        if db.update_user_profile(user_id, **{field: text}):
-            del user_states[user_id]
-            bot.reply_to(message, f"✅ {field} با موفقیت به‌روزرسانی شد!", reply_markup=create_main_menu())
-        else:
-            bot.reply_to(message, f"❌ خطا در به‌روزرسانی {field}. لطفاً دوباره تلاش کنید.")
-        return
+        """
+        bot.reply_to(message, success_text, parse_mode='Markdown', reply_markup=create_main_menu())
+    else:
+        bot.reply_to(message, "❌ خطا در ثبت نام. لطفاً دوباره تلاش کنید.")
+
+
+@conversations.on('profile_edit')
+def handle_profile_edit(message, state):
+    """ویرایش پروفایل"""
+    user_id = message.from_user.id
+    field = state.field
     
-    elif user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'buying_product' and user_states[user_id].get('step') == 'waiting_shipping_address':
-        # دریافت نشانی ارسال و رفتن به مرحله پرداخت
-        user_states[user_id]['shipping_address'] = text
-        product_id = user_states[user_id]['product_id']
-        price = user_states[user_id]['price']
-        try:
-            bot.reply_to(message,
-                "📦 نشانی ارسال ثبت شد.\n\n"
-                "💳 حالا لطفاً مبلغ را واریز کرده و اسکرین‌شات پرداخت را همینجا ارسال کنید.",
-            )
-        except Exception:
-            pass
-        user_states[user_id]['step'] = 'waiting_payment_screenshot'
+    if db.update_user_profile(user_id, **{field: message.text.strip()}):
+        conversations.clear(user_id)
+        bot.reply_to(message, f"✅ {field} با موفقیت به‌روزرسانی شد!", reply_markup=create_main_menu())
+    else:
+        bot.reply_to(message, f"❌ خطا در به‌روزرسانی {field}. لطفاً دوباره تلاش کنید.")
+
+
+@conversations.on('purchase_address')
+def handle_purchase_address(message, state):
+    """دریافت نشانی ارسال و رفتن به مرحله پرداخت"""
+    state.shipping_address = message.text.strip()
+    try:
+        bot.reply_to(message,
+            "📦 نشانی ارسال ثبت شد.\n\n"
+            "💳 حالا لطفاً مبلغ را واریز کرده و اسکرین‌شات پرداخت را همینجا ارسال کنید.",
+        )
+    except Exception:
+        pass
+    conversations.advance(message.from_user.id, state, 'purchase_screenshot')
+
+
+@conversations.on('product_name')
+def handle_product_draft_name(message, state):
+    """دریافت نام محصول"""
+    text = message.text.strip()
+    state.product_name = text
+    conversations.advance(message.from_user.id, state, 'product_price')
+    bot.reply_to(message, 
+        f"✅ نام محصول دریافت شد: {text}\n\n"
+        "💰 **مرحله 2/4: قیمت محصول**\n"
+        "قیمت محصول را به تومان ارسال کنید:",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+        )
+    )
+
+
+@conversations.on('product_price')
+def handle_product_draft_price(message, state):
+    """دریافت قیمت محصول"""
+    try:
+        price = float(message.text.strip().replace(',', ''))
+    except ValueError:
+        bot.reply_to(message, "❌ لطفاً قیمت معتبر وارد کنید (مثال: 50000)")
         return
+    state.price = price
+    conversations.advance(message.from_user.id, state, 'product_image')
+    bot.reply_to(message, 
+        f"✅ قیمت محصول دریافت شد: {price:,} تومان\n\n"
+        "🖼️ **مرحله 3/4: عکس محصول (اختیاری)**\n"
+        "عکس محصول را ارسال کنید یا لینک عکس را وارد کنید:",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_image"),
+            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+        )
+    )
 
-    elif user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'adding_product':
-        # افزودن محصول
-        step = user_states[user_id].get('step')
-        
-        if step == 'waiting_name':
-            # دریافت نام محصول
-            user_states[user_id]['name'] = text
-            user_states[user_id]['step'] = 'waiting_price'
-            bot.reply_to(message, 
-                f"✅ نام محصول دریافت شد: {text}\n\n"
-                "💰 **مرحله 2/4: قیمت محصول**\n"
-                "قیمت محصول را به تومان ارسال کنید:",
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-                )
-            )
-            return
-        
-        elif step == 'waiting_price':
-            # دریافت قیمت محصول
-            try:
-                price = float(text.replace(',', ''))
-                user_states[user_id]['price'] = price
-                user_states[user_id]['step'] = 'waiting_image'
-                bot.reply_to(message, 
-                f"✅ قیمت محصول دریافت شد: {price:,} تومان\n\n"
-                "🖼️ **مرحله 3/4: عکس محصول (اختیاری)**\n"
-                "عکس محصول را ارسال کنید یا لینک عکس را وارد کنید:",
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_image"),
-                    InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-                    )
-                )
-            except ValueError:
-                bot.reply_to(message, "❌ لطفاً قیمت معتبر وارد کنید (مثال: 50000)")
-            return
-        
-        elif step == 'waiting_image':
-            # دریافت لینک عکس محصول (اختیاری)
-            user_states[user_id]['image_url'] = text if text.strip() else None
-            user_states[user_id]['step'] = 'waiting_description'
-            bot.reply_to(message, 
-                f"✅ لینک عکس محصول دریافت شد: {'✅' if user_states[user_id]['image_url'] else 'رد شد'}\n\n"
-                "📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
-                "توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:",
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
-                    InlineKeyboardButton("❌ لغو", callback_data="admin_products")
-                )
-            )
-            return
+
+@conversations.on('product_image')
+def handle_product_draft_image_url(message, state):
+    """دریافت لینک عکس محصول (اختیاری)"""
+    state.image_url = message.text.strip() or None
+    conversations.advance(message.from_user.id, state, 'product_description')
+    bot.reply_to(message, 
+        f"✅ لینک عکس محصول دریافت شد: {'✅' if state.image_url else 'رد شد'}\n\n"
+        "📝 **مرحله 4/4: توضیحات محصول (اختیاری)**\n"
+        "توضیحات محصول را ارسال کنید یا Enter بزنید تا رد شود:",
+        reply_markup=InlineKeyboardMarkup().add(
+            InlineKeyboardButton("⏭️ رد کردن", callback_data="skip_description"),
+            InlineKeyboardButton("❌ لغو", callback_data="admin_products")
+        )
+    )
+
+
+@conversations.on('product_description')
+def handle_product_draft_description(message, state):
+    """دریافت توضیحات و تکمیل افزودن محصول"""
+    user_id = message.from_user.id
+    state.description = message.text.strip() or None
+    
+    # ذخیره محصول در دیتابیس
+    new_product_id = db.add_product(
+        state.product_name,
+        state.price,
+        state.image_url,
+        state.description,
+        first_image=get_pending_product_image(state)
+    )
+    if new_product_id:
+        # ثبت لاگ افزودن موفق
+        try:
+            db.add_log(user_id, 'product_add_success', f'افزودن محصول جدید: {state.product_name} - {state.price:,} تومان')
+        except:
+            pass  # اگر user_id وجود نداشت، لاگ را نادیده بگیر
         
-        elif step == 'waiting_description':
-            # تکمیل افزودن محصول
-            user_states[user_id]['description'] = text if text.strip() else None
-            
-            # ذخیره محصول در دیتابیس
-            product_data = user_states[user_id].copy()
-            if db.add_product(
-                product_data['name'],
-                product_data['price'],
-                product_data.get('image_url'),
-                product_data.get('description')
-            ):
-                # دریافت ID محصول جدید
-                products = db.get_all_products()
-                new_product_id = products[0]['id'] if products else None
-                
-                # اضافه کردن عکس اگر وجود دارد
-                if new_product_id and product_data.get('image_file_id'):
-                    db.add_product_image(
-                        new_product_id,
-                        product_data['image_file_id'],
-                        product_data['image_file_unique_id'],
-                        product_data.get('image_file_size'),
-                        product_data.get('image_width'),
-                        product_data.get('image_height')
-                    )
-                
-                # ثبت لاگ افزودن موفق
-                try:
-                    db.add_log(user_id, 'product_add_success', f'افزودن محصول جدید: {product_data["name"]} - {product_data["price"]:,} تومان')
-                except:
-                    pass  # اگر user_id وجود نداشت، لاگ را نادیده بگیر
-                
-                del user_states[user_id]
-                success_text = f"""
+        conversations.clear(user_id)
+        success_text = f"""
 ✅ **محصول با موفقیت اضافه شد!**
 
 🛍️ **اطلاعات محصول:**
-📝 نام: {product_data['name']}
-💰 قیمت: {product_data['price']:,} تومان
-🖼️ عکس: {'✅' if product_data.get('image_file_id') or product_data.get('image_url') else '❌'}
-📄 توضیحات: {'✅' if product_data.get('description') else '❌'}
-                """
-                bot.reply_to(message, success_text, reply_markup=create_products_menu())
-            else:
-                # ثبت لاگ خطا در افزودن
-                try:
-                    db.add_log(user_id, 'product_add_failed', f'خطا در افزودن محصول: {product_data["name"]}')
-                except:
-                    pass
-                bot.reply_to(message, "❌ خطا در افزودن محصول. لطفاً دوباره تلاش کنید.")
-        return
+📝 نام: {state.product_name}
+💰 قیمت: {state.price:,} تومان
+🖼️ عکس: {'✅' if state.image_file_id or state.image_url else '❌'}
+📄 توضیحات: {'✅' if state.description else '❌'}
+        """
+        bot.reply_to(message, success_text, reply_markup=create_products_menu())
+    else:
+        # ثبت لاگ خطا در افزودن
+        try:
+            db.add_log(user_id, 'product_add_failed', f'خطا در افزودن محصول: {state.product_name}')
+        except:
+            pass
+        bot.reply_to(message, "❌ خطا در افزودن محصول. لطفاً دوباره تلاش کنید.")
+
+
+@conversations.on('product_edit_image')
+@conversations.on('product_edit')
+def handle_product_edit(message, state):
+    """ویرایش محصول"""
+    user_id = message.from_user.id
+    product_id = state.product_id
+    field = state.field
+    value = message.text.strip()
     
-    elif user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get('action') == 'editing_product':
-        # ویرایش محصول
-        product_id = user_states[user_id]['product_id']
-        field = user_states[user_id]['field']
-        
-        # تبدیل قیمت اگر لازم باشد
-        if field == 'price':
-            try:
-                text = float(text.replace(',', ''))
-            except ValueError:
-                bot.reply_to(message, "❌ لطفاً قیمت معتبر وارد کنید (مثال: 50000)")
-                return
+    # تبدیل قیمت اگر لازم باشد
+    if field == 'price':
+        try:
+            value = float(value.replace(',', ''))
+        except ValueError:
+            bot.reply_to(message, "❌ لطفاً قیمت معتبر وارد کنید (مثال: 50000)")
+            return
+    
+    if db.update_product(product_id, **{field: value}):
+        # ثبت لاگ موفقیت‌آمیز
+        field_names = {
+            'name': 'نام',
+            'price': 'قیمت',
+            'image_url': 'عکس',
+            'description': 'توضیحات'
+        }
+        field_name = field_names.get(field, field)
+        try:
+            db.add_log(user_id, 'product_edit_success', f'ویرایش {field_name} محصول {product_id} توسط ادمین')
+        except:
+            pass
         
-        if db.update_product(product_id, **{field: text}):
-            # ثبت لاگ موفقیت‌آمیز
-            field_names = {
-                'name': 'نام',
-                'price': 'قیمت',
-                'image_url': 'عکس',
-                'description': 'توضیحات'
-            }
-            field_name = field_names.get(field, field)
-            try:
-                db.add_log(user_id, 'product_edit_success', f'ویرایش {field_name} محصول {product_id} توسط ادمین')
-            except:
-                pass
-            
-            del user_states[user_id]
-            product = db.get_product(product_id)
-            if product:
-                success_text = f"✅ {field_name} محصول با موفقیت به‌روزرسانی شد!"
-                bot.reply_to(message, success_text, reply_markup=create_product_edit_menu(product_id))
-            else:
-                bot.reply_to(message, "✅ به‌روزرسانی موفق!", reply_markup=create_products_menu())
+        conversations.clear(user_id)
+        product = db.get_product(product_id)
+        if product:
+            success_text = f"✅ {field_name} محصول با موفقیت به‌روزرسانی شد!"
+            bot.reply_to(message, success_text, reply_markup=create_product_edit_menu(product_id))
         else:
-            # ثبت لاگ خطا
-            try:
-                db.add_log(user_id, 'product_edit_failed', f'خطا در ویرایش {field} محصول {product_id}')
-            except:
-                pass
-            bot.reply_to(message, f"❌ خطا در به‌روزرسانی {field}. لطفاً دوباره تلاش کنید.")
+            bot.reply_to(message, "✅ به‌روزرسانی موفق!", reply_markup=create_products_menu())
+    else:
+        # ثبت لاگ خطا
+        try:
+            db.add_log(user_id, 'product_edit_failed', f'خطا در ویرایش {field} محصول {product_id}')
+        except:
+            pass
+        bot.reply_to(message, f"❌ خطا در به‌روزرسانی {field}. لطفاً دوباره تلاش کنید.")
+
+
+@bot.message_handler(func=lambda message: True)
+def handle_text(message):
+    """پردازش پیام‌های متنی"""
+    text = message.text.strip()
+    
+    # اجرای handler مرحله فعلی گفتگوی کاربر
+    if conversations.dispatch(message):
         return
     
     # پاسخ‌های هوشمند
@@ -2102,10 +2554,75 @@ def handle_text(message):
         bot.reply_to(message, random.choice(responses))
 
 
+def run_webhook() -> bool:
+    """اجرای ربات در حالت webhook تا زمان توقف؛ اگر راه‌اندازی ممکن نباشد False برمی‌گرداند"""
+    server = WebhookServer(
+        bot.submit_update,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        ssl_cert=WEBHOOK_SSL_CERT,
+        ssl_key=WEBHOOK_SSL_KEY
+    )
+    try:
+        server.start()
+        certificate = open(WEBHOOK_SSL_CERT, 'rb') if WEBHOOK_SSL_CERT else None
+        try:
+            bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                certificate=certificate,
+                allowed_updates=['message', 'callback_query'],
+                drop_pending_updates=False,  # آپدیت‌های در انتظار تحویل داده و تکراری‌ها حذف می‌شوند
+                secret_token=WEBHOOK_SECRET
+            )
+        finally:
+            if certificate:
+                certificate.close()
+    except Exception as e:
+        logger.error(f"❌ Could not start webhook mode, falling back to polling: {e}")
+        server.stop()
+        return False
+    
+    logger.info("🚀 Start the robot (webhook mode)...")
+    print("🤖HeshmatBot Telegram bot launched (webhook mode)!")
+    print("To stop the bot, press Ctrl+C.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("⏹️ The robot stopped.")
+        print("\n👋 The robot stopped.")
+    finally:
+        server.stop()
+    return True
+
+
 def main():
     """تابع اصلی برای اجرای ربات"""
     max_retries = 5
     retry_count = 0
+
+    # secret تصادفی هر پروسه، secret ثبت شده پروسه‌های دیگر را در تلگرام جایگزین می‌کرد
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+        raise SystemExit("WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+
+
+    # ادامه ارسال‌های همگانی ناتمام از آخرین نقطه ذخیره شده
+    broadcast_engine.resume_pending(on_progress=report_broadcast_progress, on_finish=report_broadcast_finished)
+    
+    # worker های پردازش آپدیت‌ها (مشترک بین webhook و polling) و ادامه از آخرین آپدیت پردازش شده
+    bot.start_processing(offset_store=db)
+    
+    # پاکسازی دوره‌ای داده‌های موقت منقضی شده در حافظه
+    expiry_sweeper.start()
+    
+    # حالت webhook در صورت تنظیم WEBHOOK_URL؛ polling به عنوان جایگزین باقی می‌ماند
+    if WEBHOOK_URL and run_webhook():
+        expiry_sweeper.stop()
+        bot.stop_processing()
+        db.close_connection()
+        return
     
     while retry_count < max_retries:
         try:
@@ -2115,22 +2632,22 @@ def main():
             print("⏰Admin session duration:", ADMIN_SESSION_DURATION // 60, "Min")
             print("To stop the bot, press Ctrl+C.")
             
-            # پاک کردن session های منقضی شده
-            cleanup_expired_sessions()
-            
+
             # اطمینان از غیرفعال بودن webhook برای جلوگیری از Break infinity polling
             try:
                 bot.remove_webhook()
             except Exception:
                 pass
             
+            # پردازش سریع آپدیت‌هایی که هنگام خاموش بودن ربات رسیده‌اند (به جای skip_pending)
+            bot.drain_pending(allowed_updates=['message', 'callback_query'])
+            
             # شروع polling با تنظیمات بهتر
             bot.infinity_polling(
                 timeout=30,  # افزایش timeout
                 long_polling_timeout=60,  # افزایش long polling timeout
                 none_stop=True,  # عدم توقف در صورت خطا
                 interval=1,  # کاهش interval
-                skip_pending=True,  # رد کردن پیام‌های pending
                 allowed_updates=['message', 'callback_query']
             )
 
@@ -2151,15 +2668,16 @@ def main():
                 wait_time = min(30, retry_count * 10)  # افزایش تدریجی زمان انتظار
                 logger.info(f"🔄 Restarting bot in {wait_time} seconds...")
                 print(f"🔄 ربات در {wait_time} ثانیه دوباره راه‌اندازی می‌شود...")
-                import time
                 time.sleep(wait_time)
             else:
                 logger.error("❌ Maximum retry attempts reached. Bot stopped.")
                 print("❌ حداکثر تلاش‌ها انجام شد. ربات متوقف شد.")
                 break
-        finally:
-            # بستن اتصال دیتابیس
-            db.close_connection()
+    
+    # بستن اتصال دیتابیس فقط هنگام خروج نهایی؛ راه‌اندازی مجدد polling از همان pool استفاده می‌کند
+    expiry_sweeper.stop()
+    bot.stop_processing()
+    db.close_connection()
 
 if __name__ == '__main__':
     main()
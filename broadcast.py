@@ -0,0 +1,426 @@
+"""
+موتور ارسال پیام همگانی (broadcast) با محدودیت نرخ، ارسال همزمان و قابلیت ادامه پس از ری‌استارت
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# وضعیت‌هایی که job هنوز تمام نشده و پس از ری‌استارت ادامه داده می‌شود
+ACTIVE_STATUSES = ('running', 'paused')
+
+# توضیحات خطای 400 که نشان می‌دهند چت برای همیشه در دسترس نیست
+DEAD_CHAT_DESCRIPTIONS = ('chat not found', 'user is deactivated', 'peer_id_invalid')
+
+
+class TokenBucket:
+    """محدودکننده نرخ thread-safe از نوع token bucket
+
+    rate تعداد توکن در ثانیه و capacity حداکثر انفجار مجاز است. pause برای رعایت
+    retry_after پاسخ 429 تلگرام، تمام فرستنده‌ها را تا زمان مشخص شده متوقف می‌کند.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """برداشتن یک توکن؛ در صورت نبود توکن تا زمان پر شدن صبر می‌کند
+
+        اگر timeout داده شود و توکن تا آن زمان آزاد نشود، بدون انتظار بیشتر False برمی‌گرداند.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def try_acquire(self) -> float:
+        """برداشتن یک توکن بدون انتظار؛ 0 در صورت موفقیت، وگرنه ثانیه‌های لازم تا توکن بعدی"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """توقف تمام برداشت‌ها به مدت seconds (مثلاً پس از دریافت 429)"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._updated = self._blocked_until
+            self._tokens = 0
+
+
+def telegram_error_info(error: Exception):
+    """استخراج (کد خطا، retry_after) از خطای API تلگرام؛ برای خطاهای شبکه (None, None)"""
+    error_code = getattr(error, 'error_code', None)
+    result_json = getattr(error, 'result_json', None) or {}
+    retry_after = (result_json.get('parameters') or {}).get('retry_after')
+    return error_code, retry_after
+
+
+def is_dead_chat_error(error_code: Optional[int], description: str) -> bool:
+    """آیا خطا نشان می‌دهد ارسال به این چت دیگر هرگز موفق نمی‌شود (مسدود، حذف شده و ...)"""
+    if error_code == 403:
+        return True
+    description = (description or '').lower()
+    return error_code == 400 and any(text in description for text in DEAD_CHAT_DESCRIPTIONS)
+
+
+class RecipientCheckpoint:
+    """نقطه ادامه (low watermark) روی شناسه‌های مرتب گیرنده‌ها
+
+    گیرنده‌ها به ترتیب صعودی صادر و به صورت همزمان (خارج از ترتیب) تمام می‌شوند؛
+    value بزرگ‌ترین شناسه‌ای است که خودش و تمام شناسه‌های قبلی تمام شده‌اند.
+    """
+
+    def __init__(self, start: int = 0):
+        self.value = start
+        self._pending = deque()
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def issued(self, user_id: int) -> None:
+        with self._lock:
+            self._pending.append(user_id)
+
+    def completed(self, user_id: int) -> None:
+        with self._lock:
+            self._done.add(user_id)
+            self._advance()
+
+    def discard(self, user_id: int) -> None:
+        """حذف شناسه‌ای که صادر شده ولی پردازش نخواهد شد (نقطه ادامه از آن عبور نمی‌کند)"""
+        with self._lock:
+            self._pending.remove(user_id)
+            self._advance()
+
+    def _advance(self) -> None:
+        while self._pending and self._pending[0] in self._done:
+            self.value = self._pending.popleft()
+            self._done.discard(self.value)
+
+
+class BroadcastJob:
+    """وضعیت، شمارنده‌ها و کنترل (توقف موقت/ادامه/لغو) یک ارسال همگانی"""
+
+    def __init__(self, job_id: int, admin_id: int, text: str, total: int = None,
+                 sent: int = 0, failed: int = 0, blocked: int = 0,
+                 last_user_id: int = 0, status: str = 'running',
+                 segment: str = 'all', segment_value=None):
+        self.job_id = job_id
+        self.admin_id = admin_id
+        self.text = text
+        self.segment = segment  # بخش مخاطبان (مانند all / registered / city)
+        self.segment_value = segment_value
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.retries = 0
+        self.status = status  # running / paused / cancelled / done / failed
+        self.error = None
+        self.checkpoint = RecipientCheckpoint(last_user_id)
+        self.dead_chats = []  # گیرنده‌های غیرقابل دسترس که هنوز غیرفعال نشده‌اند
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._runnable = threading.Event()
+        if status == 'running':
+            self._runnable.set()
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def cancelled(self) -> bool:
+        return self.status == 'cancelled'
+
+    def record(self, outcome: str) -> None:
+        """افزایش یکی از شمارنده‌ها (sent / failed / blocked / retries)"""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def add_dead_chat(self, chat_id: int) -> None:
+        with self._lock:
+            self.dead_chats.append(chat_id)
+
+    def take_dead_chats(self) -> List[int]:
+        """برداشتن گیرنده‌های غیرقابل دسترس جمع‌شده از آخرین فراخوانی"""
+        with self._lock:
+            dead, self.dead_chats = self.dead_chats, []
+        return dead
+
+    def wait_runnable(self, timeout: float = 0.5) -> bool:
+        """صبر تا زمانی که job متوقف موقت نباشد؛ در صورت لغو False برمی‌گرداند"""
+        while not self._runnable.wait(timeout):
+            if self.cancelled:
+                return False
+        return not self.cancelled
+
+    def set_status(self, status: str) -> None:
+        self.status = status
+        if status == 'paused':
+            self._runnable.clear()
+        else:
+            self._runnable.set()
+
+
+class BroadcastEngine:
+    """ارسال پیام به تعداد زیادی کاربر در پس‌زمینه
+
+    شناسه گیرنده‌ها به صورت دسته‌ای و مرتب از
+    iter_recipients(segment, segment_value, after_user_id=...) خوانده و
+    در یک صف کوچک قرار می‌گیرند؛ چند thread فرستنده با یک TokenBucket مشترک (حداکثر rate
+    پیام در ثانیه) آن‌ها را ارسال می‌کنند. نرخ و پاسخ 429 پیام‌های همگانی فقط در همین کلاس
+    مدیریت می‌شوند (TelegramGateway مسیر PRIORITY_BROADCAST را تکرار یا محدود به ازای چت
+    نمی‌کند). خطای 429 با توقف سراسری به اندازه retry_after و
+    خطاهای 5xx و شبکه با backoff دوباره تلاش می‌شوند؛ چت‌های غیرقابل دسترس (403 یا
+    chat not found) بدون تلاش مجدد blocked ثبت و اگر prune_dead فعال باشد در هر checkpoint
+    با store.deactivate_users به صورت دسته‌ای غیرفعال می‌شوند.
+
+    اگر store داده شود، job ها و نقطه ادامه آن‌ها (آخرین شناسه‌ای که تمام گیرنده‌های قبل از
+    آن پردازش شده‌اند) هر checkpoint_interval ثانیه ذخیره می‌شوند تا پس از ری‌استارت با
+    resume_pending از همان نقطه ادامه پیدا کنند. store باید متدهای create_broadcast_job،
+    update_broadcast_job، get_broadcast_jobs و deactivate_users را داشته باشد (مانند
+    DatabaseManager).
+    """
+
+    def __init__(self, send_func: Callable[[int, str], None],
+                 iter_recipients: Callable[..., Iterable[List[int]]],
+                 rate: float = 25, workers: int = 4, max_retries: int = 3,
+                 progress_interval: float = 5.0, checkpoint_interval: float = 1.0,
+                 store=None, prune_dead: bool = True):
+        self.send_func = send_func
+        self.iter_recipients = iter_recipients
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.store = store
+        self.prune_dead = prune_dead
+        self.jobs: Dict[int, BroadcastJob] = {}
+        self._job_ids = 0
+        self._lock = threading.Lock()
+
+    def start(self, admin_id: int, text: str, total: int = None,
+              on_progress: Callable[[BroadcastJob], None] = None,
+              on_finish: Callable[[BroadcastJob], None] = None,
+              segment: str = 'all', segment_value=None) -> BroadcastJob:
+        """ایجاد و شروع یک job جدید در پس‌زمینه و برگرداندن فوری آن"""
+        if self.store:
+            job_id = self.store.create_broadcast_job(admin_id, text, total, segment, segment_value)
+            if not job_id:
+                raise RuntimeError("Could not persist broadcast job")
+        else:
+            with self._lock:
+                self._job_ids += 1
+                job_id = self._job_ids
+        job = BroadcastJob(job_id, admin_id, text, total, segment=segment, segment_value=segment_value)
+        self._launch(job, on_progress, on_finish)
+        return job
+
+    def resume_pending(self, on_progress: Callable[[BroadcastJob], None] = None,
+                       on_finish: Callable[[BroadcastJob], None] = None) -> List[BroadcastJob]:
+        """بارگذاری و ادامه job های ناتمام ذخیره شده (job های paused در همان حالت می‌مانند)"""
+        if not self.store:
+            return []
+        jobs = []
+        for row in self.store.get_broadcast_jobs(ACTIVE_STATUSES):
+            job = BroadcastJob(row['id'], row['admin_id'], row['message_text'], row['total'],
+                               row['sent'], row['failed'], row['blocked'],
+                               row['last_user_id'], row['status'],
+                               row.get('segment') or 'all', row.get('segment_value'))
+            logger.info(f"🔄 Resuming broadcast #{job.job_id} ({job.status}) after user {job.checkpoint.value}")
+            self._launch(job, on_progress, on_finish)
+            jobs.append(job)
+        return jobs
+
+    def get_job(self, job_id: int) -> Optional[BroadcastJob]:
+        return self.jobs.get(job_id)
+
+    def active_jobs(self) -> List[BroadcastJob]:
+        return [job for job in self.jobs.values() if job.status in ACTIVE_STATUSES]
+
+    def pause(self, job_id: int) -> bool:
+        """توقف موقت job؛ فرستنده‌ها پس از پیام در حال ارسال منتظر می‌مانند"""
+        return self._control(job_id, 'paused', from_statuses=('running',))
+
+    def resume(self, job_id: int) -> bool:
+        """ادامه job متوقف شده"""
+        return self._control(job_id, 'running', from_statuses=('paused',))
+
+    def cancel(self, job_id: int) -> bool:
+        """لغو job؛ گیرنده‌های باقی‌مانده پیام را دریافت نمی‌کنند"""
+        return self._control(job_id, 'cancelled', from_statuses=ACTIVE_STATUSES)
+
+    def _control(self, job_id: int, status: str, from_statuses) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or job.status not in from_statuses:
+            return False
+        job.set_status(status)
+        self._save(job)
+        logger.info(f"✅ Broadcast #{job_id} {status}")
+        return True
+
+    def _launch(self, job: BroadcastJob, on_progress, on_finish) -> None:
+        self.jobs[job.job_id] = job
+        thread = threading.Thread(target=self._run, args=(job, on_progress, on_finish),
+                                  name=f'broadcast-{job.job_id}', daemon=True)
+        thread.start()
+
+    def _run(self, job: BroadcastJob, on_progress, on_finish) -> None:
+        """هماهنگ‌کننده: راه‌اندازی تولیدکننده و فرستنده‌ها، ذخیره نقطه ادامه و گزارش پیشرفت"""
+        # صف کوچک نگه داشته می‌شود تا تعداد گیرنده‌های در جریان (و ارسال تکراری پس از crash) کم باشد
+        recipients = queue.Queue(maxsize=self.workers * 2)
+        finished = threading.Event()
+        remaining = [self.workers]
+        remaining_lock = threading.Lock()
+
+        def worker():
+            try:
+                self._worker(job, recipients)
+            finally:
+                with remaining_lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        finished.set()
+
+        threading.Thread(target=self._produce, args=(job, recipients),
+                         name=f'broadcast-{job.job_id}-producer', daemon=True).start()
+        for index in range(self.workers):
+            threading.Thread(target=worker, name=f'broadcast-{job.job_id}-sender-{index}',
+                             daemon=True).start()
+
+        last_progress = time.monotonic()
+        while not finished.wait(self.checkpoint_interval):
+            self._save(job)
+            if time.monotonic() - last_progress >= self.progress_interval:
+                last_progress = time.monotonic()
+                self._notify(on_progress, job)
+
+        job.finished_at = time.monotonic()
+        if job.status == 'running':
+            job.status = 'done'
+        self._save(job, finished=True)
+        logger.info(f"✅ Broadcast #{job.job_id} {job.status}: {job.sent} sent, "
+                    f"{job.failed} failed, {job.blocked} blocked in {job.elapsed:.1f}s")
+        self._notify(on_finish, job)
+
+    def _put(self, job: BroadcastJob, recipients: queue.Queue, item) -> bool:
+        """قرار دادن آیتم در صف تا زمانی که job لغو نشده باشد"""
+        while not job.cancelled:
+            try:
+                recipients.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, job: BroadcastJob, recipients: queue.Queue) -> None:
+        """خواندن دسته‌ای گیرنده‌ها (از نقطه ادامه) و قرار دادن آن‌ها در صف فرستنده‌ها"""
+        try:
+            for chunk in self.iter_recipients(job.segment, job.segment_value,
+                                              after_user_id=job.checkpoint.value):
+                for chat_id in chunk:
+                    job.checkpoint.issued(chat_id)
+                    if not self._put(job, recipients, chat_id):
+                        return
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"❌ Broadcast #{job.job_id} stopped reading recipients: {e}")
+        finally:
+            for _ in range(self.workers):
+                self._put(job, recipients, _STOP)
+
+    def _worker(self, job: BroadcastJob, recipients: queue.Queue) -> None:
+        """thread فرستنده"""
+        while not job.cancelled:
+            try:
+                chat_id = recipients.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if chat_id is _STOP or not job.wait_runnable():
+                return
+            outcome = self._deliver(job, chat_id)
+            job.record(outcome)
+            if outcome == 'blocked':
+                job.add_dead_chat(chat_id)
+            job.checkpoint.completed(chat_id)
+
+    def _deliver(self, job: BroadcastJob, chat_id: int) -> str:
+        """ارسال به یک گیرنده با رعایت نرخ و تلاش مجدد؛ نتیجه: sent / failed / blocked"""
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                self.send_func(chat_id, job.text)
+                return 'sent'
+            except Exception as e:
+                error_code, retry_after = telegram_error_info(e)
+                if is_dead_chat_error(error_code, getattr(e, 'description', '')):
+                    return 'blocked'
+                if error_code is not None and error_code != 429 and error_code < 500:
+                    logger.warning(f"⚠️ Broadcast #{job.job_id} to {chat_id} failed: {e}")
+                    return 'failed'
+                if attempt >= self.max_retries:
+                    logger.warning(f"⚠️ Broadcast #{job.job_id} to {chat_id} failed after retries: {e}")
+                    return 'failed'
+                job.record('retries')
+                if error_code == 429:
+                    # محدودیت سراسری تلگرام: تمام فرستنده‌ها متوقف می‌شوند
+                    self.bucket.pause(retry_after or 1)
+                else:
+                    time.sleep(0.5 * 2 ** attempt)
+        return 'failed'
+
+    def _save(self, job: BroadcastJob, finished: bool = False) -> None:
+        """غیرفعال کردن چت‌های غیرقابل دسترس و ذخیره وضعیت، شمارنده‌ها و نقطه ادامه job"""
+        if not self.store:
+            return
+        dead = job.take_dead_chats()
+        if dead and self.prune_dead:
+            self.store.deactivate_users(dead, reason=f'unreachable in broadcast #{job.job_id}')
+        self.store.update_broadcast_job(
+            job.job_id,
+            status=job.status,
+            sent=job.sent,
+            failed=job.failed,
+            blocked=job.blocked,
+            last_user_id=job.checkpoint.value,
+            finished=finished
+        )
+
+    def _notify(self, callback, job: BroadcastJob) -> None:
+        """اجرای callback پیشرفت/پایان بدون متوقف کردن ارسال در صورت خطا"""
+        if not callback:
+            return
+        try:
+            callback(job)
+        except Exception as e:
+            logger.error(f"❌ Broadcast #{job.job_id} progress callback failed: {e}")
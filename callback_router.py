@@ -0,0 +1,83 @@
+"""
+مسیریابی callback_data دکمه‌ها با جستجوی dict و تبدیل نوع آرگومان‌ها
+"""
+
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Route:
+    """یک مسیر: handler و نوع آرگومان‌های انتهای callback_data"""
+
+    def __init__(self, action: str, handler: Callable, arg_types: Tuple[Callable, ...]):
+        self.action = action
+        self.handler = handler
+        self.arg_types = arg_types
+
+    def decode(self, parts: List[str]) -> list:
+        """تبدیل بخش‌های آرگومان به نوع اعلام شده؛ آرگومان‌های انتهایی جاافتاده None می‌شوند
+
+        در صورت داده نامعتبر (تعداد یا نوع) ValueError ایجاد می‌شود.
+        """
+        if len(parts) > len(self.arg_types):
+            raise ValueError(f"too many arguments for {self.action}")
+        args = [arg_type(part) for arg_type, part in zip(self.arg_types, parts)]
+        return args + [None] * (len(self.arg_types) - len(args))
+
+
+class CallbackRouter:
+    """جدول مسیریابی callback ها
+
+    callback_data به شکل '{action}_{arg1}_{arg2}...' است (مانند 'admin_view_order_12'). برای
+    پیدا کردن مسیر، callback_data از انتها در جداکننده‌ها کوتاه می‌شود تا طولانی‌ترین action
+    ثبت شده پیدا شود؛ پس هزینه هر dispatch به تعداد بخش‌های callback_data بستگی دارد و نه
+    به تعداد مسیرها. تعداد استفاده از هر مسیر در hits شمرده می‌شود.
+    """
+
+    def __init__(self, separator: str = '_'):
+        self.separator = separator
+        self.routes: Dict[str, Route] = {}
+        self.hits = Counter()
+        self._lock = threading.Lock()
+
+    def route(self, action: str, *arg_types: Callable):
+        """دکوریتور ثبت handler(call, *args) برای action با آرگومان‌هایی از نوع arg_types"""
+        def decorator(handler):
+            if action in self.routes:
+                raise ValueError(f"Duplicate callback route: {action}")
+            self.routes[action] = Route(action, handler, arg_types)
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Tuple[Route, list]]:
+        """پیدا کردن مسیر و آرگومان‌های تبدیل شده؛ None اگر مسیری ثبت نشده باشد"""
+        action = data
+        while True:
+            route = self.routes.get(action)
+            if route:
+                rest = data[len(action) + 1:]
+                return route, route.decode(rest.split(self.separator) if rest else [])
+            index = action.rfind(self.separator)
+            if index <= 0:
+                return None
+            action = action[:index]
+
+    def dispatch(self, call) -> bool:
+        """اجرای handler مسیر callback؛ False اگر مسیری پیدا نشود یا داده نامعتبر باشد"""
+        try:
+            resolved = self.resolve(call.data or '')
+        except ValueError as e:
+            logger.warning(f"⚠️ Invalid callback data {call.data!r}: {e}")
+            return False
+        if not resolved:
+            logger.warning(f"⚠️ No route for callback data {call.data!r}")
+            return False
+        route, args = resolved
+        with self._lock:
+            self.hits[route.action] += 1
+        route.handler(call, *args)
+        return True
@@ -0,0 +1,119 @@
+"""
+cache داخل حافظه برای کاتالوگ محصولات (محصول، صفحه‌ها و عکس‌ها)
+"""
+
+import copy
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class CatalogCache:
+    """cache از نوع LRU با نسخه‌بندی برای داده‌های کاتالوگ
+
+    هر نوشتن روی محصولات یا عکس‌ها با bump نسخه را افزایش می‌دهد و تمام ورودی‌ها
+    باطل می‌شوند. مقداری که خواندنش قبل از bump شروع شده باشد ذخیره نمی‌شود تا
+    داده قدیمی دوباره وارد cache نشود. max_entries برابر 0 یعنی cache غیرفعال است.
+
+    مقادیر به صورت پیش‌فرض کپی می‌شوند تا تغییر آن‌ها توسط فراخواننده به cache نرسد؛
+    برای مقادیر تغییرناپذیر (مثل صفحه‌های رندر شده) copy_values=False این هزینه را حذف می‌کند.
+
+    با share_version نسخه در یک store مشترک (از state_store) هم نگهداری می‌شود: هر bump یک
+    شناسه تصادفی جدید در آن می‌نویسد و هر خواندن شناسه را بررسی می‌کند؛ پس تغییری که پروسه
+    دیگری انجام داده، cache این پروسه را هم باطل می‌کند (با تاخیری حداکثر برابر cache محلی store).
+    """
+
+    VERSION_KEY = 'version'
+
+    def __init__(self, max_entries: int = 1000, copy_values: bool = True):
+        self.max_entries = max_entries
+        self.copy_values = copy_values
+        self._version = 0
+        self._entries = OrderedDict()  # {key: value}
+        self._lock = threading.Lock()
+        self._version_store = None
+        self._version_ttl = 0
+        self._version_token = None  # آخرین شناسه نسخه مشترک دیده شده
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bumps': 0, 'remote_bumps': 0}
+
+    def share_version(self, store, ttl: float = 30 * 86400) -> None:
+        """نگهداری نسخه در store مشترک بین پروسه‌ها (get/set مانند ExpiringDict)"""
+        self._version_store = store
+        self._version_ttl = ttl
+
+    @property
+    def version(self) -> int:
+        """نسخه فعلی (پس از بررسی نسخه مشترک)"""
+        self._sync()
+        return self._version
+
+    def _sync(self) -> None:
+        """باطل کردن ورودی‌ها اگر پروسه دیگری نسخه مشترک را تغییر داده باشد"""
+        if self._version_store is None:
+            return
+        token = self._version_store.get(self.VERSION_KEY)
+        if token == self._version_token:
+            return
+        with self._lock:
+            if token != self._version_token:
+                self._version_token = token
+                self._version += 1
+                self._entries.clear()
+                self.stats['remote_bumps'] += 1
+
+    def get(self, key: Hashable, default: Any = _MISSING) -> Any:
+        """دریافت مقدار (یا default) و جابه‌جایی آن به انتهای LRU"""
+        self._sync()
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def set(self, key: Hashable, value: Any, version: int) -> None:
+        """ذخیره مقدار، فقط اگر از زمان شروع خواندن نسخه تغییر نکرده باشد"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = copy.deepcopy(value) if self.copy_values else value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """برگرداندن مقدار cache شده یا خواندن آن با loader و ذخیره‌اش
+
+        خطاهای loader منتشر می‌شوند و چیزی ذخیره نمی‌شود.
+        """
+        if self.max_entries <= 0:
+            return loader()
+        version = self.version
+        value = self.get(key)
+        if value is not _MISSING:
+            return value
+        value = loader()
+        self.set(key, value, version)
+        return value
+
+    def bump(self) -> None:
+        """افزایش نسخه و باطل کردن تمام ورودی‌ها پس از تغییر کاتالوگ"""
+        token = uuid.uuid4().hex if self._version_store is not None else None
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._version_token = token
+            self.stats['bumps'] += 1
+        if token is not None:
+            self._version_store.set(self.VERSION_KEY, token, self._version_ttl)
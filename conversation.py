@@ -0,0 +1,159 @@
+"""
+ماشین حالت گفتگوهای چند مرحله‌ای کاربران (ثبت نام، خرید، افزودن محصول و ...)
+"""
+
+import json
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from expiry import ExpiringDict
+
+logger = logging.getLogger(__name__)
+
+
+class State:
+    """وضعیت گفتگوی یک کاربر؛ name مرحله فعلی و کلید جدول handler ها است
+
+    زیرکلاس‌ها فیلدهای خود را در __slots__ اعلام می‌کنند تا هر وضعیت بدون dict
+    داخلی و با حافظه کم نگهداری شود. فیلدهای مقداردهی نشده None هستند.
+    """
+
+    __slots__ = ('name',)
+    types: Dict[str, type] = {}  # {نام کلاس: کلاس} برای بازسازی وضعیت‌های ذخیره شده
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        State.types[cls.__name__] = cls
+
+    def __init__(self, name: str, **fields):
+        self.name = name
+        for field in self.fields():
+            setattr(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError(f"Unknown fields for {type(self).__name__}: {', '.join(fields)}")
+
+    @classmethod
+    def fields(cls) -> Tuple[str, ...]:
+        """فیلدهای داده وضعیت (بدون name)"""
+        return tuple(field for klass in reversed(cls.__mro__)
+                     for field in getattr(klass, '__slots__', ()) if klass is not State)
+
+    def __repr__(self):
+        values = ', '.join(f"{field}={getattr(self, field)!r}" for field in self.fields())
+        return f"{type(self).__name__}({self.name!r}{', ' if values else ''}{values})"
+
+
+State.types['State'] = State
+
+
+def dump_state(state: State) -> str:
+    """تبدیل وضعیت به JSON برای store های مشترک"""
+    data = {field: getattr(state, field) for field in state.fields()}
+    return json.dumps({'type': type(state).__name__, 'name': state.name, 'fields': data})
+
+
+def load_state(raw: str) -> State:
+    """بازسازی وضعیت از خروجی dump_state"""
+    data = json.loads(raw)
+    return State.types[data['type']](data['name'], **data['fields'])
+
+
+class BroadcastState(State):
+    """انتظار متن پیام همگانی برای بخش انتخاب شده"""
+    __slots__ = ('segment', 'segment_value', 'total')
+
+
+class RegistrationState(State):
+    """ثبت نام کاربر"""
+    __slots__ = ('first_name', 'last_name', 'phone')
+
+
+class ProfileEditState(State):
+    """ویرایش یک فیلد پروفایل"""
+    __slots__ = ('field',)
+
+
+class PurchaseState(State):
+    """خرید محصول: نشانی ارسال و سپس اسکرین‌شات پرداخت"""
+    __slots__ = ('product_id', 'price', 'shipping_address')
+
+
+class ProductDraftState(State):
+    """افزودن محصول جدید توسط ادمین"""
+    __slots__ = ('product_name', 'price', 'image_url', 'description', 'image_file_id',
+                 'image_file_unique_id', 'image_file_size', 'image_width', 'image_height')
+
+
+class ProductEditState(State):
+    """ویرایش یک فیلد محصول یا افزودن عکس به آن"""
+    __slots__ = ('product_id', 'field')
+
+
+class ConversationManager:
+    """نگهداری وضعیت گفتگوی کاربران و اجرای handler مرحله فعلی
+
+    handler ها با on(name, content_type) برای هر مرحله ثبت می‌شوند و dispatch برای هر
+    پیام فقط یک جستجوی dict انجام می‌دهد. هر وضعیت پس از ttls[name] (یا default_ttl)
+    ثانیه از آخرین set منقضی می‌شود؛ حداکثر max_users گفتگوی باز نگهداری می‌شود.
+
+    وضعیت‌ها به صورت پیش‌فرض در حافظه همین پروسه هستند؛ برای اشتراک بین چند پروسه store
+    مشترک (از state_store با dump_state و load_state) داده می‌شود.
+    """
+
+    def __init__(self, default_ttl: float = 1800, ttls: Dict[str, float] = None, max_users: int = 0,
+                 store=None):
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self._states = store if store is not None else ExpiringDict(default_ttl, max_size=max_users)
+        self._handlers: Dict[Tuple[str, str], Callable] = {}
+
+    def on(self, name: str, content_type: str = 'text'):
+        """دکوریتور ثبت handler(message, state) برای پیام‌های content_type در مرحله name"""
+        def decorator(handler):
+            key = (name, content_type)
+            if key in self._handlers:
+                raise ValueError(f"Duplicate conversation handler: {name} ({content_type})")
+            self._handlers[key] = handler
+            return handler
+        return decorator
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """تعداد وضعیت‌های منقضی شده و حذف شده به دلیل ظرفیت"""
+        return self._states.stats
+
+    def get(self, user_id: int) -> Optional[State]:
+        """وضعیت فعلی کاربر یا None (وضعیت منقضی شده حذف می‌شود)"""
+        return self._states.get(user_id)
+
+    def set(self, user_id: int, state: State) -> State:
+        """ثبت وضعیت کاربر و شروع دوباره TTL آن"""
+        self._states.set(user_id, state, self.ttls.get(state.name, self.default_ttl))
+        return state
+
+    def advance(self, user_id: int, state: State, name: str) -> State:
+        """رفتن وضعیت کاربر به مرحله name"""
+        state.name = name
+        return self.set(user_id, state)
+
+    def clear(self, user_id: int) -> Optional[State]:
+        """پایان گفتگوی کاربر"""
+        return self._states.pop(user_id)
+
+    def dispatch(self, message, content_type: str = 'text') -> bool:
+        """اجرای handler مرحله فعلی کاربر؛ False اگر وضعیت یا handler وجود نداشته باشد"""
+        state = self.get(message.from_user.id)
+        if state is None:
+            return False
+        handler = self._handlers.get((state.name, content_type))
+        if handler is None:
+            return False
+        handler(message, state)
+        return True
+
+    def sweep(self) -> int:
+        """حذف وضعیت‌های منقضی شده (برای ExpirySweeper)"""
+        return self._states.sweep()
+
+    def __len__(self):
+        return len(self._states)
@@ -3,26 +3,259 @@
 """
 
 import mysql.connector
+from mysql.connector import errorcode
 import os
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Dict, Optional
+
+from catalog_cache import CatalogCache
+import migrations
+from write_behind import WriteBehindQueue
 
 logger = logging.getLogger(__name__)
 
+# خطاهایی که نشان‌دهنده قطع موقت ارتباط با سرور هستند (wait_timeout، ری‌استارت MySQL و ...)
+TRANSIENT_ERRNOS = {
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_CONNECTION_ERROR,
+    errorcode.ER_SERVER_SHUTDOWN,
+    errorcode.ER_CLIENT_INTERACTION_TIMEOUT,
+}
+
+
+def is_transient_error(error: Exception) -> bool:
+    """بررسی اینکه آیا خطا ناشی از قطع موقت اتصال است و ارزش تلاش مجدد دارد"""
+    if getattr(error, 'errno', None) in TRANSIENT_ERRNOS:
+        return True
+    return isinstance(error, mysql.connector.errors.InterfaceError)
+
+
+# بخش‌های (segment) قابل انتخاب برای ارسال همگانی
+BROADCAST_SEGMENTS = ('all', 'registered', 'city', 'active', 'orders')
+
+# ایندکس پیمایش keyset بخش‌هایی که optimizer ممکن است ایندکس فیلترشان را (با filesort) انتخاب کند
+SEGMENT_KEYSET_INDEXES = {'active': 'idx_users_active_keyset'}
+
+
+def broadcast_segment_filter(segment: str, value=None):
+    """شرط SQL (روی جدول users) و پارامترهای یک بخش از مخاطبان ارسال همگانی
+
+    all: تمام کاربران فعال، registered: ثبت‌نام‌شده‌ها، city: شهر برابر value،
+    active: فعال در value روز اخیر (بر اساس last_activity)، orders: دارای سفارش
+    در انتظار یا تایید شده. هر شرط با یکی از ایندکس‌های migration 6 پوشش داده می‌شود؛
+    پیمایش بخش active به ترتیب user_id با ایندکس migration 9 انجام می‌شود.
+    """
+    if segment == 'all':
+        return '', ()
+    if segment == 'registered':
+        return 'AND is_registered = TRUE', ()
+    if segment == 'city':
+        return 'AND city = %s', (value,)
+    if segment == 'active':
+        return 'AND last_activity >= %s', (datetime.now() - timedelta(days=int(value)),)
+    if segment == 'orders':
+        return '''AND EXISTS (
+                    SELECT 1 FROM orders o
+                    WHERE o.user_id = users.user_id AND o.status IN ('pending', 'approved')
+                )''', ()
+    raise ValueError(f"Unknown broadcast segment: {segment}")
+
+
+_CURSOR_EPOCH = datetime(1970, 1, 1)
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _to_base36(number: int) -> str:
+    """تبدیل عدد نامنفی به رشته base36"""
+    digits = ''
+    while True:
+        number, rem = divmod(number, 36)
+        digits = _BASE36[rem] + digits
+        if not number:
+            return digits
+
+
+def encode_page_cursor(direction: str, created_at: datetime, row_id: int) -> str:
+    """ساخت cursor فشرده و مات برای callback_data
+
+    direction برابر 'n' (سطرهای بعد از این موقعیت) یا 'p' (سطرهای قبل از آن) است.
+    کاراکتر '_' در cursor استفاده نمی‌شود تا با جداکننده callback_data تداخل نکند.
+    """
+    seconds = int((created_at - _CURSOR_EPOCH).total_seconds())
+    return f"{direction}{_to_base36(seconds)}.{_to_base36(row_id)}"
+
+
+def decode_page_cursor(cursor: Optional[str]):
+    """تبدیل cursor به (direction, (created_at, id)) یا ('n', None) برای صفحه اول"""
+    if not cursor:
+        return 'n', None
+    try:
+        direction = cursor[0]
+        seconds, row_id = cursor[1:].split('.')
+        if direction not in ('n', 'p'):
+            raise ValueError(direction)
+        created_at = _CURSOR_EPOCH + timedelta(seconds=int(seconds, 36))
+        return direction, (created_at, int(row_id, 36))
+    except ValueError:
+        logger.warning(f"⚠️ Invalid page cursor: {cursor!r}")
+        return 'n', None
+
+
+class ConnectionPool:
+    """Pool ساده و thread-safe از اتصال‌های MySQL
+
+    هر متد دیتابیس یک اتصال قرض می‌گیرد و پس از پایان کار آن را برمی‌گرداند،
+    بنابراین worker های TeleBot به جای صف شدن پشت یک اتصال مشترک،
+    به صورت موازی با دیتابیس کار می‌کنند.
+
+    اتصال‌های بیکار بر اساس حالت autocommit جدا نگهداری می‌شوند: خواندن‌ها با autocommit
+    روشن هیچ تراکنش بازی باقی نمی‌گذارند و هنگام برگشت rollback لازم ندارند؛ نوشتن‌ها با
+    autocommit خاموش و commit صریح انجام می‌شوند. تغییر حالت فقط وقتی لازم است که اتصال
+    بیکاری از حالت درخواستی وجود نداشته باشد.
+    """
+
+    def __init__(self, size: int, timeout: float, ping_interval: float,
+                 reconnect_attempts: int = 3, **connect_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.reconnect_attempts = reconnect_attempts
+        self._connect_kwargs = connect_kwargs
+        self._idle = {True: queue.LifoQueue(), False: queue.LifoQueue()}  # {autocommit: (connection, زمان برگشت به pool)}
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _create(self, autocommit: bool):
+        """ایجاد اتصال جدید با چند تلاش کوتاه در صورت در دسترس نبودن سرور"""
+        for attempt in range(1, self.reconnect_attempts + 1):
+            try:
+                return mysql.connector.connect(autocommit=autocommit, **self._connect_kwargs)
+            except mysql.connector.Error as e:
+                if attempt >= self.reconnect_attempts or not is_transient_error(e):
+                    raise
+                logger.warning(f"⚠️ Database connect failed, retrying ({attempt}/{self.reconnect_attempts}): {e}")
+                time.sleep(0.1 * attempt)
+
+    def _close_quietly(self, conn) -> None:
+        """بستن اتصال خراب بدون انتشار خطا"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """ping هنگام قرض گرفتن؛ اتصال قطع شده در همان جا دوباره وصل می‌شود"""
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            conn.ping(reconnect=True, attempts=self.reconnect_attempts, delay=0)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def _take_idle(self, autocommit: bool):
+        """برداشتن اتصال بیکار (ترجیحاً با همان حالت autocommit) یا None"""
+        for mode in (autocommit, not autocommit):
+            try:
+                conn, idle_since = self._idle[mode].get_nowait()
+            except queue.Empty:
+                continue
+            return conn, idle_since, mode
+        return None
+
+    def acquire(self, autocommit: bool = False):
+        """قرض گرفتن یک اتصال سالم از pool با حالت autocommit درخواستی"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise mysql.connector.errors.PoolError(
+                f"No free connection in pool (size={self.size}) after {self.timeout}s")
+        try:
+            while True:
+                idle = self._take_idle(autocommit)
+                if idle is None:
+                    return self._create(autocommit)
+                conn, idle_since, mode = idle
+                if self._is_healthy(conn, idle_since):
+                    if mode != autocommit:
+                        try:
+                            conn.autocommit = autocommit
+                        except Exception:
+                            # اتصالی که حالتش معلوم نیست به pool برنمی‌گردد
+                            self._close_quietly(conn)
+                            raise
+                    return conn
+                logger.warning("⚠️ Discarding unhealthy pooled database connection")
+                self._close_quietly(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, autocommit: bool = False) -> None:
+        """برگرداندن اتصالی که با حالت autocommit قرض گرفته شده به pool"""
+        try:
+            # پایان تراکنش نیمه‌کاره نوشتن (در صورت خطا پیش از commit) تا اتصال بعدی داده تازه ببیند؛
+            # اتصال‌های خواندن (autocommit) تراکنش بازی ندارند و round trip اضافه‌ای نمی‌گیرند
+            if not autocommit and conn.in_transaction:
+                conn.rollback()
+            self._idle[autocommit].put_nowait((conn, time.monotonic()))
+        except Exception:
+            self._close_quietly(conn)
+        finally:
+            self._slots.release()
+
+    def discard(self, conn) -> None:
+        """کنار گذاشتن اتصال قرض گرفته شده‌ای که خراب شده است"""
+        self._close_quietly(conn)
+        self._slots.release()
+
+    def close_all(self) -> int:
+        """بستن تمام اتصال‌های بیکار pool"""
+        closed = 0
+        for idle in self._idle.values():
+            while True:
+                try:
+                    conn, _ = idle.get_nowait()
+                except queue.Empty:
+                    break
+                self._close_quietly(conn)
+                closed += 1
+        return closed
+
 
 class DatabaseManager:
     """مدیریت پایگاه داده MySQL"""
     
-    def __init__(self):
-        self.connection = None
+    def __init__(self, pool_size: int = None):
+        self.pool_size = pool_size or int(os.getenv('DB_POOL_SIZE', 5))
+        self.read_retries = int(os.getenv('DB_READ_RETRIES', 2))
+        self.retry_backoff = float(os.getenv('DB_RETRY_BACKOFF', 0.05))
+        self.count_cache_ttl = float(os.getenv('DB_COUNT_CACHE_TTL', 30))
+        self._count_cache = {}  # {key: (count, زمان انقضا)}
+        self._count_lock = threading.Lock()
+        self.catalog = CatalogCache(max_entries=int(os.getenv('CATALOG_CACHE_SIZE', 1000)))
+        self.active_days = int(os.getenv('DAILY_STATS_ACTIVE_DAYS', 7))
+        self._pruned_day = None  # آخرین روزی که daily_active_users برای آن پاکسازی شد
+        self.pool = None
+        self.writer = None
         self.connect()
         self.init_database()
+        self.ensure_daily_stats()
+        self.start_writer()
     
     def connect(self):
-        """اتصال به دیتابیس MySQL"""
+        """ایجاد pool اتصال‌های دیتابیس MySQL"""
         try:
-            self.connection = mysql.connector.connect(
+            self.pool = ConnectionPool(
+                size=self.pool_size,
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+                ping_interval=float(os.getenv('DB_POOL_PING_INTERVAL', 30)),
+                reconnect_attempts=int(os.getenv('DB_RECONNECT_ATTEMPTS', 3)),
                 host=os.getenv('DB_HOST', 'localhost'),
                 port=int(os.getenv('DB_PORT', 3306)),
                 user=os.getenv('DB_USER', 'root'),
@@ -31,201 +264,352 @@ class DatabaseManager:
                 charset='utf8mb4',
                 collation='utf8mb4_unicode_ci'
             )
-            logger.info("✅ MySQL database connection established")
+            # یک اتصال برای اطمینان از صحت تنظیمات ساخته و به pool برگردانده می‌شود
+            self.pool.release(self.pool.acquire())
+            logger.info(f"✅ MySQL database connection pool established (size={self.pool_size})")
         except mysql.connector.Error as e:
             logger.error(f"❌ Database connection error: {e}")
             raise
     
-    def init_database(self):
-        """ایجاد جداول مورد نیاز"""
+    @contextmanager
+    def _get_connection(self, autocommit: bool = False):
+        """قرض گرفتن اتصال از pool برای مدت اجرای یک متد (خواندن‌ها با autocommit=True)"""
+        conn = self.pool.acquire(autocommit)
         try:
-            cursor = self.connection.cursor()
-            
-            # ایجاد جدول کاربران
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    phone VARCHAR(20),
-                    city VARCHAR(100),
-                    is_registered BOOLEAN DEFAULT FALSE,
-                    join_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    message_count INT DEFAULT 0,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            
-            # اضافه کردن ستون‌های جدید به جدول موجود (اگر وجود دارد)
-            try:
-                cursor.execute('ALTER TABLE users ADD COLUMN phone VARCHAR(20)')
-                logger.info("✅ Column phone added")
-            except mysql.connector.Error:
-                pass  # ستون قبلاً وجود دارد
-            
-            try:
-                cursor.execute('ALTER TABLE users ADD COLUMN city VARCHAR(100)')
-                logger.info("✅ Column city added")
-            except mysql.connector.Error:
-                pass  # ستون قبلاً وجود دارد
-            
-            try:
-                cursor.execute('ALTER TABLE users ADD COLUMN is_registered BOOLEAN DEFAULT FALSE')
-                logger.info("✅ Column is_registered added")
-            except mysql.connector.Error:
-                pass  # ستون قبلاً وجود دارد
-            
-            # ایجاد جدول پیام‌ها
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT,
-                    message_text TEXT,
-                    message_type VARCHAR(50) DEFAULT 'text',
-                    message_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            
-            # ایجاد جدول لاگ‌ها
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS logs (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT,
-                    action VARCHAR(255),
-                    details TEXT,
-                    log_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            
-            # ایجاد جدول محصولات
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    name VARCHAR(255) NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    image_url VARCHAR(500),
-                    description TEXT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            
-            # ایجاد جدول عکس‌های محصولات
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS product_images (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    product_id INT NOT NULL,
-                    file_id VARCHAR(255) NOT NULL,
-                    file_unique_id VARCHAR(255) NOT NULL,
-                    file_size INT,
-                    width INT,
-                    height INT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
+            yield conn
+        except mysql.connector.Error as e:
+            if is_transient_error(e):
+                # اتصال خراب است و اتصال‌های بیکار دیگر هم احتمالاً قطع شده‌اند
+                self.pool.discard(conn)
+                self.pool.close_all()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.pool.release(conn, autocommit)
+    
+    def _run_read(self, work, dictionary: bool = False):
+        """اجرای یک خواندن idempotent با تلاش مجدد محدود در برابر قطع موقت اتصال
 
-            # ایجاد جدول سفارش‌ها
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    product_id INT NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    status ENUM('pending','approved','rejected') DEFAULT 'pending',
-                    screenshot_file_id VARCHAR(255),
-                    shipping_address TEXT NULL,
-                    admin_id BIGINT NULL,
-                    rejection_reason TEXT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                    approved_at DATETIME NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            ''')
-            
-            # ایجاد ایندکس‌ها (با بررسی وجود)
-            try:
-                cursor.execute('CREATE INDEX idx_users_username ON users(username)')
-            except mysql.connector.Error:
-                pass  # ایندکس قبلاً وجود دارد
-            
-            try:
-                cursor.execute('CREATE INDEX idx_users_join_date ON users(join_date)')
-            except mysql.connector.Error:
-                pass
-            
-            try:
-                cursor.execute('CREATE INDEX idx_messages_user_id ON messages(user_id)')
-            except mysql.connector.Error:
-                pass
-            
-            try:
-                cursor.execute('CREATE INDEX idx_messages_date ON messages(message_date)')
-            except mysql.connector.Error:
-                pass
-            
+        work یک تابع است که cursor را می‌گیرد و نتیجه را برمی‌گرداند.
+        """
+        attempt = 0
+        while True:
             try:
-                cursor.execute('CREATE INDEX idx_logs_date ON logs(log_date)')
-            except mysql.connector.Error:
-                pass
+                with self._get_connection(autocommit=True) as conn:
+                    cursor = conn.cursor(dictionary=dictionary)
+                    try:
+                        return work(cursor)
+                    finally:
+                        cursor.close()
+            except mysql.connector.Error as e:
+                if attempt >= self.read_retries or not is_transient_error(e):
+                    raise
+                attempt += 1
+                logger.warning(f"⚠️ Transient database error, retrying read ({attempt}/{self.read_retries}): {e}")
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+    
+    def _fetch_one(self, query: str, params: tuple = None, dictionary: bool = False):
+        """اجرای یک SELECT و برگرداندن اولین سطر"""
+        def work(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+        return self._run_read(work, dictionary=dictionary)
+    
+    def _fetch_all(self, query: str, params: tuple = None, dictionary: bool = False):
+        """اجرای یک SELECT و برگرداندن تمام سطرها"""
+        def work(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        return self._run_read(work, dictionary=dictionary)
 
-            # ایندکس‌های سفارش‌ها
-            try:
-                cursor.execute('CREATE INDEX idx_orders_user_id ON orders(user_id)')
-            except mysql.connector.Error:
-                pass
-            try:
-                cursor.execute('CREATE INDEX idx_orders_status ON orders(status)')
-            except mysql.connector.Error:
-                pass
-            try:
-                cursor.execute('CREATE INDEX idx_orders_created_at ON orders(created_at)')
-            except mysql.connector.Error:
-                pass
+    def _cached_count(self, key, query: str, params: tuple = None) -> int:
+        """COUNT(*) با cache کوتاه‌مدت؛ با هر تغییر داده مرتبط باطل می‌شود"""
+        now = time.monotonic()
+        with self._count_lock:
+            cached = self._count_cache.get(key)
+            if cached and cached[1] > now:
+                return cached[0]
+        count = self._fetch_one(query, params)[0]
+        with self._count_lock:
+            self._count_cache[key] = (count, now + self.count_cache_ttl)
+        return count
 
-            # اطمینان از وجود ستون آدرس ارسال در جدول سفارش‌ها (برای سازگاری با پایگاه داده‌های قدیمی)
-            try:
-                cursor.execute('ALTER TABLE orders ADD COLUMN shipping_address TEXT NULL')
-            except mysql.connector.Error:
-                # ستون قبلاً وجود دارد
-                pass
-            
-            self.connection.commit()
+    def _invalidate_counts(self, *keys) -> None:
+        """باطل کردن شمارش‌های cache شده (بدون کلید: همه)"""
+        with self._count_lock:
+            if not keys:
+                self._count_cache.clear()
+            for key in keys:
+                self._count_cache.pop(key, None)
+
+    def _seek_page(self, cursor, select_sql: str, where_sql: str, params: tuple,
+                   descending: bool, page_cursor: Optional[str], per_page: int,
+                   alias: str = '') -> Dict:
+        """اجرای یک صفحه pagination از نوع keyset روی (created_at, id)
+
+        به جای OFFSET، از آخرین/اولین سطر صفحه قبلی seek می‌شود؛ بنابراین هزینه
+        صفحات عمیق با صفحه اول برابر است. یک سطر اضافه برای تشخیص صفحه بعد خوانده می‌شود.
+        """
+        direction, position = decode_page_cursor(page_cursor)
+        backwards = direction == 'p'
+        # جهت واقعی پیمایش ایندکس: حرکت به عقب ترتیب را برعکس می‌کند
+        scan_desc = descending != backwards
+        order = 'DESC' if scan_desc else 'ASC'
+        created_col = f'{alias}created_at'
+        id_col = f'{alias}id'
+
+        conditions = [where_sql]
+        query_params = list(params)
+        if position:
+            op = '<' if scan_desc else '>'
+            conditions.append(f'({created_col} {op} %s OR ({created_col} = %s AND {id_col} {op} %s))')
+            query_params += [position[0], position[0], position[1]]
+        query_params.append(per_page + 1)
+
+        cursor.execute(f'''
+            {select_sql}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {created_col} {order}, {id_col} {order}
+            LIMIT %s
+        ''', query_params)
+        rows = cursor.fetchall()
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+            has_prev, has_next = has_more, position is not None
+        else:
+            has_prev, has_next = position is not None, has_more
+
+        return {
+            'rows': rows,
+            'has_next': bool(rows) and has_next,
+            'has_prev': bool(rows) and has_prev,
+            'next_cursor': encode_page_cursor('n', rows[-1]['created_at'], rows[-1]['id']) if rows and has_next else None,
+            'prev_cursor': encode_page_cursor('p', rows[0]['created_at'], rows[0]['id']) if rows and has_prev else None
+        }
+    
+    def start_writer(self) -> None:
+        """راه‌اندازی صف نوشتن پس‌زمینه برای لاگ‌ها، پیام‌ها و فعالیت کاربران"""
+        if os.getenv('DB_WRITE_BEHIND', 'true').lower() not in ('1', 'true', 'yes'):
+            return
+        self.writer = WriteBehindQueue(
+            self._write_batch,
+            max_size=int(os.getenv('DB_WRITE_QUEUE_SIZE', 10000)),
+            batch_size=int(os.getenv('DB_WRITE_BATCH_SIZE', 500)),
+            flush_interval=float(os.getenv('DB_WRITE_FLUSH_INTERVAL', 1.0)),
+            put_timeout=float(os.getenv('DB_WRITE_PUT_TIMEOUT', 0.5))
+        )
+        self.writer.start()
+
+    def _queue_write(self, kind: str, row: tuple, error_message: str) -> bool:
+        """ارسال نوشتن به صف پس‌زمینه؛ اگر صف غیرفعال یا پر باشد، نوشتن همزمان انجام می‌شود"""
+        if self.writer and self.writer.put(kind, row):
+            return True
+        try:
+            self._write_batch([(kind, row)])
+            return True
+        except mysql.connector.Error as e:
+            logger.error(f"{error_message}: {e}")
+            return False
+
+    def _write_batch(self, items: List[tuple]) -> None:
+        """نوشتن دسته‌ای لاگ‌ها، پیام‌ها و فعالیت کاربران با INSERT های چندسطری در یک تراکنش"""
+        logs = []
+        messages = []
+        activity = {}  # {user_id: (تعداد پیام‌ها, آخرین زمان فعالیت)}
+        for kind, row in items:
+            if kind == 'log':
+                logs.append(row)
+            elif kind == 'message':
+                messages.append(row)
+            elif kind == 'activity':
+                user_id, when = row
+                count, last = activity.get(user_id, (0, when))
+                activity[user_id] = (count + 1, max(last, when))
+
+        # لاگ‌ها و پیام‌ها به جدول users وابسته‌اند؛ کاربران ناشناخته ابتدا اضافه می‌شوند
+        user_ids = sorted({row[0] for row in logs if row[0] is not None} | {row[0] for row in messages})
+        now = datetime.now()
+
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+
+            if user_ids:
+                cursor.executemany('''
+                    INSERT IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_activity)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                ''', [(user_id, 'Unknown', 'Unknown', 'User', now, now) for user_id in user_ids])
+                if cursor.rowcount > 0:
+                    self._bump_daily_stats(cursor, now.date(), new_users=cursor.rowcount)
+
+            if logs:
+                cursor.executemany('''
+                    INSERT INTO logs (user_id, action, details, log_date)
+                    VALUES (%s, %s, %s, %s)
+                ''', logs)
+
+            if messages:
+                cursor.executemany('''
+                    INSERT INTO messages (user_id, message_text, message_type, message_date)
+                    VALUES (%s, %s, %s, %s)
+                ''', messages)
+                self._record_messages_stats(cursor, messages)
+
+            if activity:
+                # یک UPDATE برای تمام کاربران دسته به جای یک UPDATE برای هر پیام
+                ids = sorted(activity)
+                cases = ' '.join(['WHEN %s THEN %s'] * len(ids))
+                placeholders = ', '.join(['%s'] * len(ids))
+                params = [v for user_id in ids for v in (user_id, activity[user_id][0])]
+                params += [v for user_id in ids for v in (user_id, activity[user_id][1])]
+                params += ids
+                cursor.execute(f'''
+                    UPDATE users
+                    SET message_count = message_count + CASE user_id {cases} END,
+                        last_activity = CASE user_id {cases} END
+                    WHERE user_id IN ({placeholders})
+                ''', params)
+
+            conn.commit()
             cursor.close()
-            logger.info("✅ Database tables created")
+
+    _DAILY_STATS_COLUMNS = ('new_users', 'messages', 'active_users',
+                            'orders_created', 'orders_approved', 'orders_rejected')
+
+    def _bump_daily_stats(self, cursor, day: date, **deltas) -> None:
+        """افزودن مقادیر به ردیف آمار یک روز در همان تراکنش نوشتن اصلی"""
+        columns = [column for column in self._DAILY_STATS_COLUMNS if deltas.get(column)]
+        if not columns:
+            return
+        cursor.execute(f'''
+            INSERT INTO daily_stats (stat_date, {', '.join(columns)})
+            VALUES (%s, {', '.join(['%s'] * len(columns))})
+            ON DUPLICATE KEY UPDATE {', '.join(f'{column} = {column} + VALUES({column})' for column in columns)}
+        ''', [day] + [deltas[column] for column in columns])
+
+    def _record_messages_stats(self, cursor, messages: List[tuple]) -> None:
+        """به‌روزرسانی تعداد پیام‌ها و کاربران فعال روزانه برای یک دسته پیام"""
+        per_day = {}  # {روز: (تعداد پیام‌ها, مجموعه کاربران)}
+        for user_id, _, _, message_date in messages:
+            day_stats = per_day.setdefault(message_date.date(), [0, set()])
+            day_stats[0] += 1
+            day_stats[1].add(user_id)
+
+        for day, (count, users) in per_day.items():
+            # فقط کاربرانی که امروز برای اولین بار دیده می‌شوند active_users را افزایش می‌دهند
+            cursor.executemany('''
+                INSERT IGNORE INTO daily_active_users (stat_date, user_id)
+                VALUES (%s, %s)
+            ''', [(day, user_id) for user_id in sorted(users)])
+            self._bump_daily_stats(cursor, day, messages=count, active_users=max(cursor.rowcount, 0))
+
+        # اولین دسته پیام هر روز جدید، ردیف‌های قدیمی کاربران فعال را پاک می‌کند
+        today = max(per_day)
+        if self._pruned_day is None or today > self._pruned_day:
+            self._prune_active_users(cursor, today)
+            self._pruned_day = today
+
+    def _prune_active_users(self, cursor, day: date) -> None:
+        """حذف ردیف‌های daily_active_users قدیمی‌تر از active_days روز قبل از day"""
+        cursor.execute('''
+            DELETE FROM daily_active_users WHERE stat_date < %s
+        ''', (day - timedelta(days=self.active_days),))
+
+    def rebuild_daily_stats(self, day: date = None) -> bool:
+        """محاسبه دوباره ردیف آمار یک روز (پیش‌فرض امروز) از روی جداول اصلی
+
+        برای پر کردن اولیه جدول خلاصه و اصلاح انحراف احتمالی استفاده می‌شود. فیلترها
+        به صورت بازه روی ستون‌های ایندکس شده هستند تا فقط سطرهای همان روز خوانده شوند.
+        """
+        day = day or date.today()
+        start = datetime.combine(day, datetime.min.time())
+        end = start + timedelta(days=1)
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+
+                cursor.execute('''
+                    INSERT IGNORE INTO daily_active_users (stat_date, user_id)
+                    SELECT DISTINCT %s, user_id FROM messages
+                    WHERE message_date >= %s AND message_date < %s AND user_id IS NOT NULL
+                ''', (day, start, end))
+
+                cursor.execute('''
+                    REPLACE INTO daily_stats
+                        (stat_date, new_users, messages, active_users,
+                         orders_created, orders_approved, orders_rejected)
+                    SELECT %s,
+                        (SELECT COUNT(*) FROM users WHERE join_date >= %s AND join_date < %s),
+                        (SELECT COUNT(*) FROM messages WHERE message_date >= %s AND message_date < %s),
+                        (SELECT COUNT(*) FROM daily_active_users WHERE stat_date = %s),
+                        (SELECT COUNT(*) FROM orders WHERE created_at >= %s AND created_at < %s),
+                        (SELECT COUNT(*) FROM orders WHERE status = 'approved' AND approved_at >= %s AND approved_at < %s),
+                        (SELECT COUNT(*) FROM orders WHERE status = 'rejected' AND updated_at >= %s AND updated_at < %s)
+                ''', (day, start, end, start, end, day, start, end, start, end, start, end))
+
+                conn.commit()
+                cursor.close()
+            logger.info(f"✅ Daily stats rebuilt for {day}")
+            return True
+
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error rebuilding daily stats: {e}")
+            return False
+
+    def ensure_daily_stats(self) -> bool:
+        """ساخت ردیف آمار امروز با rebuild_daily_stats فقط اگر هنوز وجود نداشته باشد
+
+        ردیف‌های موجود با _bump_daily_stats به‌روز نگه داشته می‌شوند؛ پس شروع هر پروسه (مثلاً
+        هر worker در اجرای چند پروسه‌ای) فقط یک SELECT روی کلید اصلی هزینه دارد.
+        """
+        try:
+            if self._fetch_one('SELECT 1 FROM daily_stats WHERE stat_date = %s', (date.today(),)):
+                return True
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error checking daily stats: {e}")
+            return False
+        return self.rebuild_daily_stats()
+
+    def init_database(self):
+        """اعمال migration های نسخه‌دار schema (اگر schema به‌روز باشد هیچ DDL ای اجرا نمی‌شود)"""
+        try:
+            with self._get_connection() as conn:
+                applied = migrations.migrate(conn)
+            if applied:
+                logger.info(f"✅ Database schema migrated to version {migrations.LATEST_VERSION} ({applied} migrations applied)")
+            else:
+                logger.info(f"✅ Database schema is up to date (version {migrations.LATEST_VERSION})")
             
         except mysql.connector.Error as e:
-            logger.error(f"❌ Error creating tables: {e}")
+            logger.error(f"❌ Error migrating database schema: {e}")
             raise
     
     def add_user(self, user_id: int, username: str, first_name: str, last_name: str) -> bool:
         """اضافه کردن کاربر جدید (بدون ثبت نام کامل)"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name, join_date, last_activity)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                username = VALUES(username),
-                first_name = VALUES(first_name),
-                last_name = VALUES(last_name),
-                last_activity = VALUES(last_activity),
-                is_active = TRUE
-            ''', (user_id, username, first_name, last_name, 
-                  datetime.now(), datetime.now()))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name, join_date, last_activity)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                    username = VALUES(username),
+                    first_name = VALUES(first_name),
+                    last_name = VALUES(last_name),
+                    last_activity = VALUES(last_activity),
+                    is_active = TRUE
+                ''', (user_id, username, first_name, last_name, 
+                      datetime.now(), datetime.now()))
+                # rowcount برابر 1 یعنی کاربر جدید درج شده است (2 یا 0 یعنی کاربر موجود)
+                if cursor.rowcount == 1:
+                    self._bump_daily_stats(cursor, date.today(), new_users=1)
+                
+                conn.commit()
+                cursor.close()
             
             # ثبت لاگ
             self.add_log(user_id, 'user_added', f'User {username} added')
@@ -239,17 +623,18 @@ class DatabaseManager:
     def register_user(self, user_id: int, first_name: str, last_name: str, phone: str = None, city: str = None) -> bool:
         """ثبت نام کامل کاربر"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                UPDATE users 
-                SET first_name = %s, last_name = %s, phone = %s, city = %s, 
-                    is_registered = TRUE, updated_at = %s
-                WHERE user_id = %s
-            ''', (first_name, last_name, phone, city, datetime.now(), user_id))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    UPDATE users 
+                    SET first_name = %s, last_name = %s, phone = %s, city = %s, 
+                        is_registered = TRUE, updated_at = %s
+                    WHERE user_id = %s
+                ''', (first_name, last_name, phone, city, datetime.now(), user_id))
+                
+                conn.commit()
+                cursor.close()
             
             # ثبت لاگ
             self.add_log(user_id, 'user_registered', f'User {first_name} {last_name} registered')
@@ -263,15 +648,10 @@ class DatabaseManager:
     def is_user_registered(self, user_id: int) -> bool:
         """بررسی اینکه آیا کاربر ثبت نام کرده است یا نه"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
+            result = self._fetch_one('''
                 SELECT is_registered FROM users WHERE user_id = %s
             ''', (user_id,))
             
-            result = cursor.fetchone()
-            cursor.close()
-            
             return result[0] if result else False
             
         except mysql.connector.Error as e:
@@ -281,32 +661,33 @@ class DatabaseManager:
     def update_user_profile(self, user_id: int, **kwargs) -> bool:
         """به‌روزرسانی پروفایل کاربر"""
         try:
-            cursor = self.connection.cursor()
-            
-            # ساخت query دینامیک
-            fields = []
-            values = []
-            
-            for field, value in kwargs.items():
-                if field in ['phone', 'first_name', 'last_name', 'city']:
-                    fields.append(f"{field} = %s")
-                    values.append(value)
-            
-            if not fields:
-                return False
-            
-            values.append(datetime.now())
-            values.append(user_id)
-            
-            query = f'''
-                UPDATE users 
-                SET {', '.join(fields)}, updated_at = %s
-                WHERE user_id = %s
-            '''
-            
-            cursor.execute(query, values)
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # ساخت query دینامیک
+                fields = []
+                values = []
+                
+                for field, value in kwargs.items():
+                    if field in ['phone', 'first_name', 'last_name', 'city']:
+                        fields.append(f"{field} = %s")
+                        values.append(value)
+                
+                if not fields:
+                    return False
+                
+                values.append(datetime.now())
+                values.append(user_id)
+                
+                query = f'''
+                    UPDATE users 
+                    SET {', '.join(fields)}, updated_at = %s
+                    WHERE user_id = %s
+                '''
+                
+                cursor.execute(query, values)
+                conn.commit()
+                cursor.close()
             
             # ثبت لاگ
             self.add_log(user_id, 'profile_updated', f'User profile updated: {list(kwargs.keys())}')
@@ -318,36 +699,16 @@ class DatabaseManager:
             return False
     
     def update_user_activity(self, user_id: int) -> bool:
-        """به‌روزرسانی فعالیت کاربر"""
-        try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                UPDATE users 
-                SET last_activity = %s, message_count = message_count + 1
-                WHERE user_id = %s
-            ''', (datetime.now(), user_id))
-            
-            self.connection.commit()
-            cursor.close()
-            return True
-            
-        except mysql.connector.Error as e:
-            logger.error(f"❌ Error updating user activity: {e}")
-            return False
+        """به‌روزرسانی فعالیت کاربر (از طریق صف نوشتن پس‌زمینه)"""
+        return self._queue_write('activity', (user_id, datetime.now()),
+                                 "❌ Error updating user activity")
     
     def get_user(self, user_id: int) -> Optional[Dict]:
         """دریافت اطلاعات کاربر"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self._fetch_one('''
                 SELECT * FROM users WHERE user_id = %s
-            ''', (user_id,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            return result
+            ''', (user_id,), dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting user info: {e}")
@@ -356,95 +717,236 @@ class DatabaseManager:
     def get_all_users(self) -> List[Dict]:
         """دریافت لیست تمام کاربران"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self._fetch_all('''
                 SELECT user_id, username, first_name, last_name, join_date, last_activity, message_count
                 FROM users 
                 WHERE is_active = TRUE
                 ORDER BY join_date DESC
-            ''')
-            
-            results = cursor.fetchall()
-            cursor.close()
-            return results
+            ''', dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting users list: {e}")
             return []
     
-    def get_users_count(self) -> int:
-        """تعداد کل کاربران فعال"""
+    def iter_active_user_ids(self, chunk_size: int = 1000, after_user_id: int = 0) -> Iterator[List[int]]:
+        """پیمایش شناسه تمام کاربران فعال به صورت دسته‌های مرتب"""
+        return self.iter_segment_user_ids('all', chunk_size=chunk_size, after_user_id=after_user_id)
+    
+    def iter_segment_user_ids(self, segment: str = 'all', segment_value=None, chunk_size: int = 1000,
+                              after_user_id: int = 0) -> Iterator[List[int]]:
+        """پیمایش شناسه کاربران فعال یک بخش به صورت دسته‌های مرتب (keyset روی کلید اصلی)
+
+        هر دسته با یک کوئری جداگانه و یک اتصال کوتاه‌مدت از pool خوانده می‌شود، پس حافظه
+        مصرفی مستقل از تعداد کل کاربران است. after_user_id برای ادامه از یک نقطه مشخص است.
+        """
+        condition, params = broadcast_segment_filter(segment, segment_value)
+        index = SEGMENT_KEYSET_INDEXES.get(segment)
+        index_hint = f'FORCE INDEX ({index})' if index else ''
+        last_id = after_user_id
+        while True:
+            rows = self._fetch_all(f'''
+                SELECT user_id FROM users {index_hint}
+                WHERE is_active = TRUE AND user_id > %s {condition}
+                ORDER BY user_id
+                LIMIT %s
+            ''', (last_id,) + params + (chunk_size,))
+            if not rows:
+                return
+            chunk = [row[0] for row in rows]
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1]
+    
+    def count_segment_users(self, segment: str = 'all', segment_value=None) -> int:
+        """تعداد کاربران فعال یک بخش (پیش‌نمایش قبل از ارسال همگانی)"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                SELECT COUNT(*) FROM users WHERE is_active = TRUE
-            ''')
-            
-            count = cursor.fetchone()[0]
-            cursor.close()
-            return count
+            condition, params = broadcast_segment_filter(segment, segment_value)
+            return self._fetch_one(f'''
+                SELECT COUNT(*) FROM users WHERE is_active = TRUE {condition}
+            ''', params)[0]
             
         except mysql.connector.Error as e:
-            logger.error(f"❌ Error counting users: {e}")
+            logger.error(f"❌ Error counting segment users: {e}")
             return 0
     
-    def add_message(self, user_id: int, message_text: str, message_type: str = "text") -> bool:
-        """اضافه کردن پیام به تاریخچه"""
+    def create_broadcast_job(self, admin_id: int, message_text: str, total: int = None,
+                             segment: str = 'all', segment_value=None) -> Optional[int]:
+        """ثبت job ارسال همگانی جدید و برگرداندن شناسه آن"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                INSERT INTO messages (user_id, message_text, message_type, message_date)
-                VALUES (%s, %s, %s, %s)
-            ''', (user_id, message_text, message_type, datetime.now()))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO broadcast_jobs (admin_id, message_text, total, segment, segment_value)
+                    VALUES (%s, %s, %s, %s, %s)
+                ''', (admin_id, message_text, total, segment,
+                      None if segment_value is None else str(segment_value)))
+                conn.commit()
+                job_id = cursor.lastrowid
+                cursor.close()
+            self.add_log(admin_id, 'broadcast_created', f'broadcast job #{job_id} created for {total} users')
+            return job_id
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error creating broadcast job: {e}")
+            return None
+
+    def update_broadcast_job(self, job_id: int, status: str, sent: int, failed: int, blocked: int,
+                             last_user_id: int, finished: bool = False) -> bool:
+        """ذخیره وضعیت، شمارنده‌ها و نقطه ادامه (last_user_id) یک job ارسال همگانی"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE broadcast_jobs
+                    SET status = %s, sent = %s, failed = %s, blocked = %s, last_user_id = %s,
+                        finished_at = %s
+                    WHERE id = %s
+                ''', (status, sent, failed, blocked, last_user_id,
+                      datetime.now() if finished else None, job_id))
+                conn.commit()
+                cursor.close()
             return True
-            
         except mysql.connector.Error as e:
-            logger.error(f"❌ Error adding message: {e}")
+            logger.error(f"❌ Error updating broadcast job: {e}")
             return False
-    
-    def add_log(self, user_id: int, action: str, details: str = "") -> bool:
-        """اضافه کردن لاگ"""
+
+    def get_broadcast_jobs(self, statuses: tuple = ('running', 'paused')) -> List[Dict]:
+        """دریافت job های ارسال همگانی با وضعیت‌های مشخص (پیش‌فرض: ناتمام)"""
         try:
-            cursor = self.connection.cursor()
-            
-            # بررسی وجود کاربر در جدول users
-            if user_id != 0:  # اگر user_id صفر نباشد
-                cursor.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
-                if not cursor.fetchone():
-                    # اگر کاربر وجود ندارد، ابتدا آن را اضافه کن
-                    cursor.execute('''
-                        INSERT IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_activity)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    ''', (user_id, 'Unknown', 'Unknown', 'User', datetime.now(), datetime.now()))
-                    self.connection.commit()  # commit کردن قبل از اضافه کردن لاگ
-            
-            # اضافه کردن لاگ با user_id یا NULL
-            log_user_id = user_id if user_id != 0 else None
-            cursor.execute('''
-                INSERT INTO logs (user_id, action, details, log_date)
-                VALUES (%s, %s, %s, %s)
-            ''', (log_user_id, action, details, datetime.now()))
-            
-            self.connection.commit()
-            cursor.close()
+            placeholders = ', '.join(['%s'] * len(statuses))
+            return self._fetch_all(f'''
+                SELECT * FROM broadcast_jobs
+                WHERE status IN ({placeholders})
+                ORDER BY id
+            ''', tuple(statuses), dictionary=True)
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting broadcast jobs: {e}")
+            return []
+
+    def get_update_offset(self) -> int:
+        """آخرین update_id که تمام آپدیت‌های تا آن پردازش شده‌اند (صفر اگر ثبت نشده باشد)"""
+        try:
+            row = self._fetch_one('''
+                SELECT int_value FROM bot_state WHERE name = 'update_offset'
+            ''')
+            return row[0] if row else 0
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting update offset: {e}")
+            return 0
+
+    def save_update_offset(self, update_id: int) -> bool:
+        """ذخیره آخرین update_id پردازش شده (هرگز به عقب برنمی‌گردد)"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO bot_state (name, int_value) VALUES ('update_offset', %s)
+                    ON DUPLICATE KEY UPDATE int_value = GREATEST(int_value, VALUES(int_value))
+                ''', (update_id,))
+                conn.commit()
+                cursor.close()
+            return True
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error saving update offset: {e}")
+            return False
+
+    def get_state_entry(self, namespace: str, key: str) -> Optional[str]:
+        """مقدار منقضی نشده وضعیت مشترک یا None"""
+        try:
+            row = self._fetch_one('''
+                SELECT value FROM state_entries
+                WHERE namespace = %s AND state_key = %s AND expires_at > %s
+            ''', (namespace, key, time.time()))
+            return row[0] if row else None
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting state entry {namespace}/{key}: {e}")
+            return None
+
+    def set_state_entry(self, namespace: str, key: str, value: str, expires_at: float) -> bool:
+        """ذخیره وضعیت مشترک تا زمان expires_at (epoch)"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO state_entries (namespace, state_key, value, expires_at)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE value = VALUES(value), expires_at = VALUES(expires_at)
+                ''', (namespace, key, value, expires_at))
+                conn.commit()
+                cursor.close()
             return True
-            
         except mysql.connector.Error as e:
-            logger.error(f"❌ Error adding log: {e}")
+            logger.error(f"❌ Error saving state entry {namespace}/{key}: {e}")
             return False
+
+    def delete_state_entry(self, namespace: str, key: str) -> bool:
+        """حذف وضعیت مشترک"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM state_entries WHERE namespace = %s AND state_key = %s
+                ''', (namespace, key))
+                conn.commit()
+                cursor.close()
+            return True
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error deleting state entry {namespace}/{key}: {e}")
+            return False
+
+    def delete_expired_state_entries(self, namespace: str) -> int:
+        """حذف وضعیت‌های منقضی شده namespace و برگرداندن تعداد حذف شده‌ها"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM state_entries WHERE namespace = %s AND expires_at <= %s
+                ''', (namespace, time.time()))
+                removed = cursor.rowcount
+                conn.commit()
+                cursor.close()
+            return removed
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error deleting expired state entries of {namespace}: {e}")
+            return 0
+
+    def count_state_entries(self, namespace: str) -> int:
+        """تعداد وضعیت‌های منقضی نشده namespace"""
+        try:
+            return self._fetch_one('''
+                SELECT COUNT(*) FROM state_entries WHERE namespace = %s AND expires_at > %s
+            ''', (namespace, time.time()))[0]
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error counting state entries of {namespace}: {e}")
+            return 0
+
+    def get_users_count(self) -> int:
+        """تعداد کل کاربران فعال"""
+        try:
+            return self._fetch_one('''
+                SELECT COUNT(*) FROM users WHERE is_active = TRUE
+            ''')[0]
+            
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error counting users: {e}")
+            return 0
+    
+    def add_message(self, user_id: int, message_text: str, message_type: str = "text") -> bool:
+        """اضافه کردن پیام به تاریخچه (از طریق صف نوشتن پس‌زمینه)"""
+        return self._queue_write('message', (user_id, message_text, message_type, datetime.now()),
+                                 "❌ Error adding message")
+    
+    def add_log(self, user_id: int, action: str, details: str = "") -> bool:
+        """اضافه کردن لاگ (از طریق صف نوشتن پس‌زمینه)"""
+        # اضافه کردن لاگ با user_id یا NULL
+        log_user_id = user_id if user_id != 0 else None
+        return self._queue_write('log', (log_user_id, action, details, datetime.now()),
+                                 "❌ Error adding log")
     
     def get_user_stats(self, user_id: int) -> Optional[Dict]:
         """دریافت آمار کاربر"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self._fetch_one('''
                 SELECT 
                     u.*,
                     COUNT(m.id) as total_messages,
@@ -453,51 +955,29 @@ class DatabaseManager:
                 LEFT JOIN messages m ON u.user_id = m.user_id
                 WHERE u.user_id = %s
                 GROUP BY u.user_id
-            ''', (user_id,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            return result
+            ''', (user_id,), dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting user stats: {e}")
             return None
     
     def get_daily_stats(self) -> Dict:
-        """دریافت آمار روزانه"""
+        """دریافت آمار روزانه از جدول خلاصه daily_stats (خواندن یک ردیف با کلید اصلی)"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            # آمار کاربران جدید امروز
-            cursor.execute('''
-                SELECT COUNT(*) as new_users_today
-                FROM users 
-                WHERE DATE(join_date) = CURDATE()
-            ''')
-            new_users = cursor.fetchone()
-            
-            # آمار پیام‌های امروز
-            cursor.execute('''
-                SELECT COUNT(*) as messages_today
-                FROM messages 
-                WHERE DATE(message_date) = CURDATE()
-            ''')
-            messages = cursor.fetchone()
-            
-            # آمار کاربران فعال امروز
-            cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) as active_users_today
-                FROM messages 
-                WHERE DATE(message_date) = CURDATE()
-            ''')
-            active_users = cursor.fetchone()
-            
-            cursor.close()
-            
+            row = self._fetch_one('''
+                SELECT new_users, messages, active_users,
+                       orders_created, orders_approved, orders_rejected
+                FROM daily_stats
+                WHERE stat_date = %s
+            ''', (date.today(),), dictionary=True) or {}
+
             return {
-                'new_users_today': new_users['new_users_today'],
-                'messages_today': messages['messages_today'],
-                'active_users_today': active_users['active_users_today']
+                'new_users_today': row.get('new_users', 0),
+                'messages_today': row.get('messages', 0),
+                'active_users_today': row.get('active_users', 0),
+                'orders_created_today': row.get('orders_created', 0),
+                'orders_approved_today': row.get('orders_approved', 0),
+                'orders_rejected_today': row.get('orders_rejected', 0)
             }
             
         except mysql.connector.Error as e:
@@ -507,16 +987,17 @@ class DatabaseManager:
     def deactivate_user(self, user_id: int) -> bool:
         """غیرفعال کردن کاربر"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                UPDATE users 
-                SET is_active = FALSE, updated_at = %s
-                WHERE user_id = %s
-            ''', (datetime.now(), user_id))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    UPDATE users 
+                    SET is_active = FALSE, updated_at = %s
+                    WHERE user_id = %s
+                ''', (datetime.now(), user_id))
+                
+                conn.commit()
+                cursor.close()
             
             # ثبت لاگ
             self.add_log(user_id, 'user_deactivated', f'User {user_id} deactivated')
@@ -527,24 +1008,75 @@ class DatabaseManager:
             logger.error(f"❌ Error deactivating user: {e}")
             return False
     
+    def deactivate_users(self, user_ids: List[int], reason: str = '', chunk_size: int = 1000) -> int:
+        """غیرفعال کردن دسته‌ای کاربران (مانند deactivate_user ولی با یک UPDATE برای هر دسته)
+
+        تعداد کاربرانی که واقعاً غیرفعال شدند را برمی‌گرداند.
+        """
+        if not user_ids:
+            return 0
+        user_ids = sorted(set(user_ids))
+        deactivated = 0
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = datetime.now()
+                for start in range(0, len(user_ids), chunk_size):
+                    chunk = user_ids[start:start + chunk_size]
+                    placeholders = ', '.join(['%s'] * len(chunk))
+                    cursor.execute(f'''
+                        UPDATE users 
+                        SET is_active = FALSE, updated_at = %s
+                        WHERE user_id IN ({placeholders}) AND is_active = TRUE
+                    ''', [now] + chunk)
+                    deactivated += cursor.rowcount
+                
+                conn.commit()
+                cursor.close()
+            
+            # ثبت لاگ (از طریق صف نوشتن پس‌زمینه به صورت دسته‌ای نوشته می‌شود)
+            details = f' ({reason})' if reason else ''
+            for user_id in user_ids:
+                self.add_log(user_id, 'user_deactivated', f'User {user_id} deactivated{details}')
+            
+            return deactivated
+            
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error deactivating users: {e}")
+            return 0
+    
     def close_connection(self):
-        """بستن اتصال به دیتابیس"""
-        if self.connection:
-            self.connection.close()
+        """flush کردن صف نوشتن و بستن اتصال‌های دیتابیس"""
+        if self.writer:
+            self.writer.stop()
+        if self.pool:
+            self.pool.close_all()
             logger.info("✅ Database connection closed")
     
-    def add_product(self, name: str, price: float, image_url: str = None, description: str = None) -> bool:
-        """اضافه کردن محصول جدید"""
+    def add_product(self, name: str, price: float, image_url: str = None, description: str = None,
+                    first_image: Dict = None) -> Optional[int]:
+        """اضافه کردن محصول جدید و برگرداندن شناسه آن
+
+        first_image (اختیاری) دیکشنری با کلیدهای file_id، file_unique_id، file_size، width و height
+        است و در همان تراکنش درج می‌شود.
+        """
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                INSERT INTO products (name, price, image_url, description)
-                VALUES (%s, %s, %s, %s)
-            ''', (name, price, image_url, description))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    INSERT INTO products (name, price, image_url, description)
+                    VALUES (%s, %s, %s, %s)
+                ''', (name, price, image_url, description))
+                product_id = cursor.lastrowid
+
+                if first_image:
+                    self._insert_product_image(cursor, product_id, **first_image)
+                
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts('products')
+                self.catalog.bump()
             
             # ثبت لاگ (بدون user_id برای محصولات)
             try:
@@ -552,26 +1084,20 @@ class DatabaseManager:
             except:
                 pass  # اگر user_id وجود نداشت، لاگ را نادیده بگیر
             
-            return True
+            return product_id
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error adding product: {e}")
-            return False
+            return None
     
     def get_all_products(self) -> List[Dict]:
         """دریافت لیست تمام محصولات فعال"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self._fetch_all('''
                 SELECT * FROM products 
                 WHERE is_active = TRUE
                 ORDER BY created_at DESC
-            ''')
-            
-            results = cursor.fetchall()
-            cursor.close()
-            return results
+            ''', dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting products list: {e}")
@@ -579,9 +1105,7 @@ class DatabaseManager:
     
     def get_products_paginated(self, page: int = 1, per_page: int = 5) -> Dict:
         """دریافت محصولات با pagination"""
-        try:
-            cursor = self.connection.cursor(dictionary=True)
-            
+        def work(cursor):
             # محاسبه offset
             offset = (page - 1) * per_page
             
@@ -604,8 +1128,6 @@ class DatabaseManager:
             total_count = cursor.fetchone()['total']
             total_pages = (total_count + per_page - 1) // per_page
             
-            cursor.close()
-            
             return {
                 'products': products,
                 'current_page': page,
@@ -615,6 +1137,9 @@ class DatabaseManager:
                 'has_next': page < total_pages,
                 'has_prev': page > 1
             }
+        
+        try:
+            return self._run_read(work, dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting paginated products: {e}")
@@ -628,18 +1153,63 @@ class DatabaseManager:
                 'has_prev': False
             }
     
+    def get_products_page(self, cursor: str = None, page: int = 1, per_page: int = 5,
+                          with_total: bool = True) -> Dict:
+        """دریافت یک صفحه محصولات با pagination از نوع keyset
+
+        cursor مقدار next_cursor/prev_cursor صفحه قبلی است (None برای صفحه اول) و
+        مستقیماً در callback_data قابل استفاده است. page فقط برای نمایش شماره صفحه است.
+        """
+        def load():
+            total_count = self._cached_count('products', '''
+                SELECT COUNT(*) FROM products WHERE is_active = TRUE
+            ''') if with_total else None
+
+            result = self._run_read(lambda db_cursor: self._seek_page(
+                db_cursor,
+                'SELECT * FROM products',
+                'is_active = TRUE',
+                (),
+                descending=True,
+                page_cursor=cursor,
+                per_page=per_page
+            ), dictionary=True)
+
+            return {
+                'products': result['rows'],
+                'current_page': page,
+                'total_pages': (total_count + per_page - 1) // per_page if with_total else None,
+                'total_count': total_count,
+                'per_page': per_page,
+                'has_next': result['has_next'],
+                'has_prev': result['has_prev'],
+                'next_cursor': result['next_cursor'],
+                'prev_cursor': result['prev_cursor']
+            }
+
+        try:
+            return self.catalog.get_or_load(('products_page', cursor, page, per_page, with_total), load)
+
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting products page: {e}")
+            return {
+                'products': [],
+                'current_page': 1,
+                'total_pages': 0,
+                'total_count': 0,
+                'per_page': per_page,
+                'has_next': False,
+                'has_prev': False,
+                'next_cursor': None,
+                'prev_cursor': None
+            }
+
     def get_product(self, product_id: int) -> Optional[Dict]:
         """دریافت اطلاعات یک محصول"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self.catalog.get_or_load(('product', product_id), lambda: self._fetch_one('''
                 SELECT * FROM products WHERE id = %s
-            ''', (product_id,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            return result
+            ''', (product_id,), dictionary=True))
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting product: {e}")
@@ -648,32 +1218,35 @@ class DatabaseManager:
     def update_product(self, product_id: int, **kwargs) -> bool:
         """به‌روزرسانی محصول"""
         try:
-            cursor = self.connection.cursor()
-            
-            # ساخت query دینامیک
-            fields = []
-            values = []
-            
-            for field, value in kwargs.items():
-                if field in ['name', 'price', 'image_url', 'description', 'is_active']:
-                    fields.append(f"{field} = %s")
-                    values.append(value)
-            
-            if not fields:
-                return False
-            
-            values.append(datetime.now())
-            values.append(product_id)
-            
-            query = f'''
-                UPDATE products 
-                SET {', '.join(fields)}, updated_at = %s
-                WHERE id = %s
-            '''
-            
-            cursor.execute(query, values)
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # ساخت query دینامیک
+                fields = []
+                values = []
+                
+                for field, value in kwargs.items():
+                    if field in ['name', 'price', 'image_url', 'description', 'is_active']:
+                        fields.append(f"{field} = %s")
+                        values.append(value)
+                
+                if not fields:
+                    return False
+                
+                values.append(datetime.now())
+                values.append(product_id)
+                
+                query = f'''
+                    UPDATE products 
+                    SET {', '.join(fields)}, updated_at = %s
+                    WHERE id = %s
+                '''
+                
+                cursor.execute(query, values)
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts('products')
+                self.catalog.bump()
             
             # ثبت لاگ
             self.add_log(0, 'product_updated', f'Product {product_id} updated: {list(kwargs.keys())}')
@@ -687,16 +1260,19 @@ class DatabaseManager:
     def delete_product(self, product_id: int) -> bool:
         """حذف محصول (غیرفعال کردن)"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                UPDATE products 
-                SET is_active = FALSE, updated_at = %s
-                WHERE id = %s
-            ''', (datetime.now(), product_id))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    UPDATE products 
+                    SET is_active = FALSE, updated_at = %s
+                    WHERE id = %s
+                ''', (datetime.now(), product_id))
+                
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts('products')
+                self.catalog.bump()
             
             # ثبت لاگ
             self.add_log(0, 'product_deleted', f'Product {product_id} deleted')
@@ -710,32 +1286,35 @@ class DatabaseManager:
     def get_products_count(self) -> int:
         """تعداد کل محصولات فعال"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
+            return self._cached_count('products', '''
                 SELECT COUNT(*) FROM products WHERE is_active = TRUE
             ''')
             
-            count = cursor.fetchone()[0]
-            cursor.close()
-            return count
-            
         except mysql.connector.Error as e:
             logger.error(f"❌ Error counting products: {e}")
             return 0
     
+    @staticmethod
+    def _insert_product_image(cursor, product_id: int, file_id: str, file_unique_id: str,
+                              file_size: int = None, width: int = None, height: int = None) -> None:
+        """درج یک عکس محصول با cursor تراکنش جاری"""
+        cursor.execute('''
+            INSERT INTO product_images (product_id, file_id, file_unique_id, file_size, width, height)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (product_id, file_id, file_unique_id, file_size, width, height))
+
     def add_product_image(self, product_id: int, file_id: str, file_unique_id: str, file_size: int = None, width: int = None, height: int = None) -> bool:
         """اضافه کردن عکس به محصول"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                INSERT INTO product_images (product_id, file_id, file_unique_id, file_size, width, height)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (product_id, file_id, file_unique_id, file_size, width, height))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                self._insert_product_image(cursor, product_id, file_id, file_unique_id, file_size, width, height)
+                
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts(('images', product_id))
+                self.catalog.bump()
             return True
             
         except mysql.connector.Error as e:
@@ -745,17 +1324,11 @@ class DatabaseManager:
     def get_product_images(self, product_id: int) -> List[Dict]:
         """دریافت عکس‌های یک محصول"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            cursor.execute('''
+            return self.catalog.get_or_load(('images', product_id), lambda: self._fetch_all('''
                 SELECT * FROM product_images 
                 WHERE product_id = %s 
                 ORDER BY created_at ASC
-            ''', (product_id,))
-            
-            results = cursor.fetchall()
-            cursor.close()
-            return results
+            ''', (product_id,), dictionary=True))
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting product images: {e}")
@@ -763,9 +1336,7 @@ class DatabaseManager:
     
     def get_product_images_paginated(self, product_id: int, page: int = 1, per_page: int = 3) -> Dict:
         """دریافت عکس‌های یک محصول با pagination"""
-        try:
-            cursor = self.connection.cursor(dictionary=True)
-            
+        def work(cursor):
             # محاسبه offset
             offset = (page - 1) * per_page
             
@@ -788,8 +1359,6 @@ class DatabaseManager:
             total_count = cursor.fetchone()['total']
             total_pages = (total_count + per_page - 1) // per_page
             
-            cursor.close()
-            
             return {
                 'images': images,
                 'current_page': page,
@@ -799,6 +1368,9 @@ class DatabaseManager:
                 'has_next': page < total_pages,
                 'has_prev': page > 1
             }
+        
+        try:
+            return self._run_read(work, dictionary=True)
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting paginated images: {e}")
@@ -811,18 +1383,68 @@ class DatabaseManager:
                 'has_next': False,
                 'has_prev': False
             }
+    
+    def get_product_images_page(self, product_id: int, cursor: str = None, page: int = 1,
+                                per_page: int = 1, with_total: bool = True) -> Dict:
+        """دریافت یک صفحه عکس‌های محصول با pagination از نوع keyset"""
+        def load():
+            total_count = self._cached_count(('images', product_id), '''
+                SELECT COUNT(*) FROM product_images WHERE product_id = %s
+            ''', (product_id,)) if with_total else None
+
+            result = self._run_read(lambda db_cursor: self._seek_page(
+                db_cursor,
+                'SELECT * FROM product_images',
+                'product_id = %s',
+                (product_id,),
+                descending=False,
+                page_cursor=cursor,
+                per_page=per_page
+            ), dictionary=True)
+
+            return {
+                'images': result['rows'],
+                'current_page': page,
+                'total_pages': (total_count + per_page - 1) // per_page if with_total else None,
+                'total_count': total_count,
+                'per_page': per_page,
+                'has_next': result['has_next'],
+                'has_prev': result['has_prev'],
+                'next_cursor': result['next_cursor'],
+                'prev_cursor': result['prev_cursor']
+            }
+
+        try:
+            return self.catalog.get_or_load(('images_page', product_id, cursor, page, per_page, with_total), load)
+
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting product images page: {e}")
+            return {
+                'images': [],
+                'current_page': 1,
+                'total_pages': 0,
+                'total_count': 0,
+                'per_page': per_page,
+                'has_next': False,
+                'has_prev': False,
+                'next_cursor': None,
+                'prev_cursor': None
+            }
 
     def create_order(self, user_id: int, product_id: int, price: float, screenshot_file_id: str, shipping_address: str) -> Optional[int]:
         """ایجاد سفارش جدید در حالت در انتظار تایید همراه با نشانی ارسال"""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute('''
-                INSERT INTO orders (user_id, product_id, price, status, screenshot_file_id, shipping_address)
-                VALUES (%s, %s, %s, 'pending', %s, %s)
-            ''', (user_id, product_id, price, screenshot_file_id, shipping_address))
-            self.connection.commit()
-            order_id = cursor.lastrowid
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO orders (user_id, product_id, price, status, screenshot_file_id, shipping_address)
+                    VALUES (%s, %s, %s, 'pending', %s, %s)
+                ''', (user_id, product_id, price, screenshot_file_id, shipping_address))
+                order_id = cursor.lastrowid
+                self._bump_daily_stats(cursor, date.today(), orders_created=1)
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts('pending_orders')
             # ثبت لاگ سفارش
             self.add_log(user_id, 'order_created', f'order #{order_id} for product {product_id} created pending approval')
             return order_id
@@ -833,25 +1455,20 @@ class DatabaseManager:
     def get_user_orders(self, user_id: int) -> List[Dict]:
         """دریافت سفارش‌های کاربر"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute('''
+            return self._fetch_all('''
                 SELECT o.*, p.name as product_name
                 FROM orders o
                 JOIN products p ON p.id = o.product_id
                 WHERE o.user_id = %s
                 ORDER BY o.created_at DESC
-            ''', (user_id,))
-            results = cursor.fetchall()
-            cursor.close()
-            return results
+            ''', (user_id,), dictionary=True)
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting user orders: {e}")
             return []
-
+    
     def get_pending_orders(self, page: int = 1, per_page: int = 10) -> Dict:
         """دریافت سفارش‌های در انتظار تایید با pagination برای ادمین"""
-        try:
-            cursor = self.connection.cursor(dictionary=True)
+        def work(cursor):
             offset = (page - 1) * per_page
             cursor.execute('''
                 SELECT o.*, p.name as product_name, u.username, u.first_name, u.last_name
@@ -866,7 +1483,6 @@ class DatabaseManager:
             cursor.execute("SELECT COUNT(*) as total FROM orders WHERE status = 'pending'")
             total_count = cursor.fetchone()['total']
             total_pages = (total_count + per_page - 1) // per_page
-            cursor.close()
             return {
                 'orders': orders,
                 'current_page': page,
@@ -876,6 +1492,8 @@ class DatabaseManager:
                 'has_next': page < total_pages,
                 'has_prev': page > 1
             }
+        try:
+            return self._run_read(work, dictionary=True)
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting pending orders: {e}")
             return {
@@ -887,48 +1505,95 @@ class DatabaseManager:
                 'has_next': False,
                 'has_prev': False
             }
+    
+    def get_pending_orders_page(self, cursor: str = None, page: int = 1, per_page: int = 10,
+                                with_total: bool = True) -> Dict:
+        """دریافت یک صفحه سفارش‌های در انتظار تایید با pagination از نوع keyset"""
+        try:
+            total_count = self._cached_count('pending_orders', '''
+                SELECT COUNT(*) FROM orders WHERE status = 'pending'
+            ''') if with_total else None
+
+            result = self._run_read(lambda db_cursor: self._seek_page(
+                db_cursor,
+                '''SELECT o.*, p.name as product_name, u.username, u.first_name, u.last_name
+                FROM orders o
+                JOIN products p ON p.id = o.product_id
+                JOIN users u ON u.user_id = o.user_id''',
+                "o.status = 'pending'",
+                (),
+                descending=False,
+                page_cursor=cursor,
+                per_page=per_page,
+                alias='o.'
+            ), dictionary=True)
+
+            return {
+                'orders': result['rows'],
+                'current_page': page,
+                'total_pages': (total_count + per_page - 1) // per_page if with_total else None,
+                'total_count': total_count,
+                'per_page': per_page,
+                'has_next': result['has_next'],
+                'has_prev': result['has_prev'],
+                'next_cursor': result['next_cursor'],
+                'prev_cursor': result['prev_cursor']
+            }
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting pending orders page: {e}")
+            return {
+                'orders': [],
+                'current_page': 1,
+                'total_pages': 0,
+                'total_count': 0,
+                'per_page': per_page,
+                'has_next': False,
+                'has_prev': False,
+                'next_cursor': None,
+                'prev_cursor': None
+            }
 
     def get_order(self, order_id: int) -> Optional[Dict]:
         """دریافت جزئیات یک سفارش"""
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute('''
+            return self._fetch_one('''
                 SELECT o.*, p.name as product_name
                 FROM orders o
                 JOIN products p ON p.id = o.product_id
                 WHERE o.id = %s
-            ''', (order_id,))
-            order = cursor.fetchone()
-            cursor.close()
-            return order
+            ''', (order_id,), dictionary=True)
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting order: {e}")
             return None
-
+    
     def update_order_status(self, order_id: int, status: str, admin_id: int = None, rejection_reason: str = None) -> bool:
         """به‌روزرسانی وضعیت سفارش و ثبت زمان تایید"""
         try:
-            cursor = self.connection.cursor()
-            if status == 'approved':
-                cursor.execute('''
-                    UPDATE orders
-                    SET status = 'approved', admin_id = %s, approved_at = %s, updated_at = %s, rejection_reason = NULL
-                    WHERE id = %s
-                ''', (admin_id, datetime.now(), datetime.now(), order_id))
-            elif status == 'rejected':
-                cursor.execute('''
-                    UPDATE orders
-                    SET status = 'rejected', admin_id = %s, updated_at = %s, rejection_reason = %s
-                    WHERE id = %s
-                ''', (admin_id, datetime.now(), rejection_reason, order_id))
-            else:
-                cursor.execute('''
-                    UPDATE orders
-                    SET status = %s, updated_at = %s
-                    WHERE id = %s
-                ''', (status, datetime.now(), order_id))
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if status == 'approved':
+                    cursor.execute('''
+                        UPDATE orders
+                        SET status = 'approved', admin_id = %s, approved_at = %s, updated_at = %s, rejection_reason = NULL
+                        WHERE id = %s
+                    ''', (admin_id, datetime.now(), datetime.now(), order_id))
+                elif status == 'rejected':
+                    cursor.execute('''
+                        UPDATE orders
+                        SET status = 'rejected', admin_id = %s, updated_at = %s, rejection_reason = %s
+                        WHERE id = %s
+                    ''', (admin_id, datetime.now(), rejection_reason, order_id))
+                else:
+                    cursor.execute('''
+                        UPDATE orders
+                        SET status = %s, updated_at = %s
+                        WHERE id = %s
+                    ''', (status, datetime.now(), order_id))
+                if status in ('approved', 'rejected') and cursor.rowcount > 0:
+                    self._bump_daily_stats(cursor, date.today(), **{f'orders_{status}': 1})
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts('pending_orders')
             # ثبت لاگ
             self.add_log(admin_id or 0, 'order_status_updated', f'order #{order_id} -> {status}')
             return True
@@ -939,52 +1604,145 @@ class DatabaseManager:
     def delete_product_image(self, image_id: int) -> bool:
         """حذف عکس محصول"""
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                DELETE FROM product_images WHERE id = %s
-            ''', (image_id,))
-            
-            self.connection.commit()
-            cursor.close()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    DELETE FROM product_images WHERE id = %s
+                ''', (image_id,))
+                
+                conn.commit()
+                cursor.close()
+                self._invalidate_counts()
+                self.catalog.bump()
             return True
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error deleting product image: {e}")
             return False
     
+    # ستون‌های عکس در JOIN با پیشوند img_ انتخاب می‌شوند تا با ستون‌های محصول (id، created_at) تداخل نکنند
+    _IMAGE_SELECT = ', '.join(f'i.{column} AS img_{column}' for column in (
+        'id', 'product_id', 'file_id', 'file_unique_id', 'file_size', 'width', 'height', 'created_at'))
+
+    @staticmethod
+    def _split_product_row(row: Dict):
+        """جدا کردن یک سطر JOIN به (محصول، عکس یا None)"""
+        product = {key: value for key, value in row.items() if not key.startswith('img_')}
+        image = {key[4:]: value for key, value in row.items() if key.startswith('img_')}
+        return product, (image if image['id'] is not None else None)
+
     def get_product_with_images(self, product_id: int) -> Optional[Dict]:
-        """دریافت محصول همراه با عکس‌هایش"""
-        try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            # دریافت اطلاعات محصول
-            cursor.execute('''
-                SELECT * FROM products WHERE id = %s
+        """دریافت محصول همراه با عکس‌هایش در یک کوئری (LEFT JOIN)"""
+        def work(cursor):
+            cursor.execute(f'''
+                SELECT p.*, {self._IMAGE_SELECT}
+                FROM products p
+                LEFT JOIN product_images i ON i.product_id = p.id
+                WHERE p.id = %s
+                ORDER BY i.created_at ASC, i.id ASC
             ''', (product_id,))
-            
-            product = cursor.fetchone()
-            if not product:
-                cursor.close()
+            rows = cursor.fetchall()
+            if not rows:
                 return None
-            
-            # دریافت عکس‌های محصول
-            cursor.execute('''
-                SELECT * FROM product_images 
-                WHERE product_id = %s 
-                ORDER BY created_at ASC
-            ''', (product_id,))
-            
-            images = cursor.fetchall()
-            product['images'] = images
-            
-            cursor.close()
+
+            product, _ = self._split_product_row(rows[0])
+            images = (self._split_product_row(row)[1] for row in rows)
+            product['images'] = [image for image in images if image]
             return product
+        
+        try:
+            return self.catalog.get_or_load(('product_with_images', product_id),
+                                            lambda: self._run_read(work, dictionary=True))
             
         except mysql.connector.Error as e:
             logger.error(f"❌ Error getting product with images: {e}")
             return None
 
+    def get_product_gallery(self, product_id: int, cursor: str = None, page: int = 1) -> Dict:
+        """دریافت مشخصات محصول، یک عکس و تعداد کل عکس‌ها در یک کوئری
+
+        مانند get_product_images_page از cursor نوع keyset استفاده می‌کند (هر صفحه یک عکس).
+        اگر محصول وجود نداشته باشد، product برابر None است.
+        """
+        direction, position = decode_page_cursor(cursor)
+        backwards = direction == 'p'
+        order = 'DESC' if backwards else 'ASC'
+        seek = ''
+        params = []
+        if position:
+            op = '<' if backwards else '>'
+            seek = f'AND (i.created_at {op} %s OR (i.created_at = %s AND i.id {op} %s))'
+            params = [position[0], position[0], position[1]]
+
+        def work(db_cursor):
+            # دو سطر خوانده می‌شود تا وجود عکس بعدی (در جهت پیمایش) مشخص شود
+            db_cursor.execute(f'''
+                SELECT p.*, {self._IMAGE_SELECT},
+                       (SELECT COUNT(*) FROM product_images c WHERE c.product_id = p.id) AS image_count
+                FROM products p
+                LEFT JOIN product_images i ON i.product_id = p.id {seek}
+                WHERE p.id = %s
+                ORDER BY i.created_at {order}, i.id {order}
+                LIMIT 2
+            ''', params + [product_id])
+            return db_cursor.fetchall()
+
+        def load():
+            rows = self._run_read(work, dictionary=True)
+            if not rows:
+                return {
+                    'product': None,
+                    'image': None,
+                    'current_page': 1,
+                    'total_pages': 0,
+                    'total_count': 0,
+                    'has_next': False,
+                    'has_prev': False,
+                    'next_cursor': None,
+                    'prev_cursor': None
+                }
+
+            product, _ = self._split_product_row(rows[0])
+            total_count = product.pop('image_count')
+            images = [image for image in (self._split_product_row(row)[1] for row in rows) if image]
+            image = images[0] if images else None
+            has_more = len(images) > 1
+            if backwards:
+                has_prev, has_next = has_more, position is not None
+            else:
+                has_prev, has_next = position is not None, has_more
+            has_prev, has_next = bool(image) and has_prev, bool(image) and has_next
+
+            return {
+                'product': product,
+                'image': image,
+                'current_page': page,
+                'total_pages': total_count,
+                'total_count': total_count,
+                'has_next': has_next,
+                'has_prev': has_prev,
+                'next_cursor': encode_page_cursor('n', image['created_at'], image['id']) if has_next else None,
+                'prev_cursor': encode_page_cursor('p', image['created_at'], image['id']) if has_prev else None
+            }
+
+        try:
+            return self.catalog.get_or_load(('gallery', product_id, cursor, page), load)
+
+        except mysql.connector.Error as e:
+            logger.error(f"❌ Error getting product gallery: {e}")
+            return {
+                'product': None,
+                'image': None,
+                'current_page': 1,
+                'total_pages': 0,
+                'total_count': 0,
+                'has_next': False,
+                'has_prev': False,
+                'next_cursor': None,
+                'prev_cursor': None
+            }
+    
     def __del__(self):
         """بستن اتصال هنگام حذف شی"""
         self.close_connection()
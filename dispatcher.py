@@ -0,0 +1,241 @@
+"""
+توزیع آپدیت‌ها بین worker ها بر اساس چت: ترتیب کامل داخل هر چت و اجرای موازی بین چت‌ها
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import telebot
+from telebot.types import Update
+
+from broadcast import RecipientCheckpoint
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """شناسه چتی که آپدیت به آن تعلق دارد (برای پیام و callback)"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        callback = update.callback_query
+        return callback.message.chat.id if callback.message else callback.from_user.id
+    return None
+
+
+class ChatDispatcher:
+    """اجرای آپدیت‌ها روی workers thread که هر چت همیشه به همان worker می‌رسد
+
+    هر worker صف محدود خودش را دارد؛ پس دو آپدیت پشت سر هم یک چت (مثلاً دو بار زدن سریع
+    یک دکمه) هرگز همزمان اجرا نمی‌شوند و وضعیت‌های مشترک هر کاربر بدون race تغییر می‌کنند،
+    در حالی که چت‌های مختلف به صورت موازی پردازش می‌شوند.
+    """
+
+    def __init__(self, process_updates: Callable[[List[Update]], None], workers: int = 4,
+                 queue_size: int = 1000):
+        self.process_updates = process_updates
+        self.workers = workers
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self.stats = {'dispatched': 0, 'rejected': 0, 'failed': 0}
+
+    def start(self) -> None:
+        """شروع thread های worker"""
+        if self._threads:
+            return
+        for index, updates in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(updates,),
+                                      name=f'update-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"✅ Update dispatcher started with {self.workers} workers")
+
+    def _queue_for(self, update: Update) -> queue.Queue:
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        return self._queues[key % self.workers]
+
+    def submit(self, update: Update, timeout: float = None) -> bool:
+        """قرار دادن آپدیت در صف worker چت آن؛ اگر صف تا timeout پر بماند False برمی‌گرداند"""
+        try:
+            self._queue_for(update).put(update, timeout=timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            logger.warning("⚠️ Update queue is full; update was not accepted")
+            return False
+        self.stats['dispatched'] += 1
+        return True
+
+    def dispatch(self, updates: List[Update]) -> None:
+        """قرار دادن دسته‌ای آپدیت‌ها به ترتیب (در صورت پر بودن صف صبر می‌کند)"""
+        for update in updates:
+            self.submit(update)
+
+    def _worker(self, updates: queue.Queue) -> None:
+        while True:
+            update = updates.get()
+            if update is _STOP:
+                return
+            try:
+                self.process_updates([update])
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"❌ Error processing update {update.update_id}: {e}")
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """توقف worker ها پس از پردازش آپدیت‌های باقی‌مانده در صف‌ها"""
+        for updates in self._queues:
+            updates.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        logger.info("✅ Update dispatcher stopped")
+
+
+class OrderedTeleBot(telebot.TeleBot):
+    """TeleBot که آپدیت‌های دریافتی (polling یا webhook) را از طریق ChatDispatcher اجرا می‌کند
+
+    ربات به صورت threaded=False ساخته می‌شود و pool داخلی telebot استفاده نمی‌شود؛
+    handler ها مستقیم روی worker های dispatcher اجرا می‌شوند.
+
+    آخرین update_id که تمام آپدیت‌های تا آن پردازش شده‌اند (processed.value) هر save_interval
+    ثانیه در offset_store (متدهای get_update_offset و save_update_offset، مانند DatabaseManager)
+    ذخیره می‌شود تا پس از ری‌استارت آپدیت‌های در انتظار از همان نقطه پردازش شوند. آپدیت‌های
+    تکراری (پردازش شده یا اخیراً دریافت شده) نادیده گرفته می‌شوند.
+
+    در حالت polling، last_update_id همان processed.value است؛ پس getUpdates فقط آپدیت‌هایی
+    را برای تلگرام تایید می‌کند که واقعاً پردازش شده‌اند و آپدیت‌های در صف هنگام crash از
+    دست نمی‌روند (دوباره تحویل و تکراری‌ها حذف می‌شوند). در حالت webhook تایید همان پاسخ
+    200 به درخواست است که پیش از پردازش داده می‌شود؛ آپدیت‌های در صف هنگام crash در این
+    حالت از دست می‌روند (محدودیت شناخته شده webhook).
+    """
+
+    def __init__(self, token: str, workers: int = 4, queue_size: int = 1000,
+                 recent_updates: int = 10000, redelivery_wait: float = 1.0, **kwargs):
+        self.processed = RecipientCheckpoint()  # پیش از TeleBot.__init__ که last_update_id را مقداردهی می‌کند
+        super().__init__(token, threaded=False, **kwargs)
+        self.redelivery_wait = redelivery_wait
+        self.dispatcher = ChatDispatcher(self.handle_updates, workers=workers, queue_size=queue_size)
+        self.offset_store = None
+        self.recent_updates = recent_updates
+        self._recent = OrderedDict()  # {update_id: True} برای حذف آپدیت‌های تکراری
+        self._recent_lock = threading.Lock()
+        self._saver = None
+        self._stopped = threading.Event()
+
+    def start_processing(self, offset_store=None, save_interval: float = 1.0) -> None:
+        """بارگذاری offset ذخیره شده، شروع worker ها و ذخیره دوره‌ای offset"""
+        self.offset_store = offset_store
+        if offset_store:
+            offset = offset_store.get_update_offset()
+            self.processed = RecipientCheckpoint(offset)
+            logger.info(f"✅ Resuming updates after update_id {offset}")
+        self.dispatcher.start()
+        if offset_store:
+            self._stopped.clear()
+            self._saver = threading.Thread(target=self._save_offsets, args=(save_interval,),
+                                           name='update-offset-writer', daemon=True)
+            self._saver.start()
+
+    def stop_processing(self) -> None:
+        """پردازش آپدیت‌های باقی‌مانده، توقف worker ها و ذخیره نهایی offset"""
+        self.dispatcher.stop()
+        self._stopped.set()
+        if self._saver:
+            self._saver.join()
+            self._saver = None
+        if self.offset_store:
+            self.offset_store.save_update_offset(self.processed.value)
+
+    @property
+    def last_update_id(self) -> int:
+        """offset تایید شده برای getUpdates: آخرین آپدیتی که خودش و قبلی‌هایش پردازش شده‌اند"""
+        return self.processed.value
+
+    @last_update_id.setter
+    def last_update_id(self, value: int) -> None:
+        # telebot هنگام دریافت offset را جلو می‌برد؛ تایید فقط با پیشرفت processed انجام می‌شود
+        pass
+
+    def _save_offsets(self, interval: float) -> None:
+        saved = self.processed.value
+        while not self._stopped.wait(interval):
+            value = self.processed.value
+            if value > saved and self.offset_store.save_update_offset(value):
+                saved = value
+
+    def _accept(self, update: Update) -> bool:
+        """ثبت آپدیت جدید (باید زیر _recent_lock فراخوانی شود)؛ False برای آپدیت تکراری"""
+        if update.update_id <= self.processed.value or update.update_id in self._recent:
+            return False
+        self._recent[update.update_id] = True
+        while len(self._recent) > self.recent_updates:
+            self._recent.popitem(last=False)
+        self.processed.issued(update.update_id)
+        return True
+
+    def handle_updates(self, updates: List[Update]) -> None:
+        """اجرای handler ها برای آپدیت‌ها (روی worker dispatcher)"""
+        try:
+            super().process_new_updates(updates)
+        finally:
+            for update in updates:
+                self.processed.completed(update.update_id)
+
+    def _enqueue(self, updates: List[Update]) -> int:
+        """صف کردن آپدیت‌های جدید یک دسته getUpdates؛ تعداد آپدیت‌های جدید را برمی‌گرداند"""
+        with self._recent_lock:
+            accepted = [update for update in sorted(updates, key=lambda u: u.update_id)
+                        if self._accept(update)]
+        self.dispatcher.dispatch(accepted)
+        return len(accepted)
+
+    def _wait_for_progress(self, timeout: float) -> None:
+        """انتظار تا جلو رفتن processed (حداکثر timeout ثانیه)"""
+        value = self.processed.value
+        deadline = time.monotonic() + timeout
+        while self.processed.value == value and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def process_new_updates(self, updates: List[Update]) -> None:
+        # offset (last_update_id) تا پردازش واقعی جلو نمی‌رود و getUpdates بعدی آپدیت‌های در صف را
+        # دوباره برمی‌گرداند؛ اگر دسته فقط شامل همین‌ها باشد تا پیشرفت پردازش صبر می‌شود
+        if updates and not self._enqueue(updates):
+            self._wait_for_progress(self.redelivery_wait)
+
+    def submit_update(self, update: Update, timeout: float = None) -> bool:
+        """قرار دادن یک آپدیت (مثلاً از webhook) در صف؛ آپدیت تکراری بدون پردازش پذیرفته می‌شود"""
+        with self._recent_lock:
+            if not self._accept(update):
+                return True
+        # ارسال به صف بیرون از قفل انجام می‌شود تا انتظار برای صف پر بقیه آپدیت‌ها را متوقف نکند
+        if self.dispatcher.submit(update, timeout):
+            return True
+        # آپدیت پذیرفته نشد و تلگرام آن را دوباره می‌فرستد
+        with self._recent_lock:
+            self._recent.pop(update.update_id, None)
+            self.processed.discard(update.update_id)
+        return False
+
+    def drain_pending(self, batch_size: int = 100, allowed_updates: List[str] = None) -> int:
+        """دریافت و صف کردن دسته‌ای آپدیت‌های در انتظار (پس از offset فعلی) قبل از شروع polling
+
+        چون offset فقط با پردازش جلو می‌رود، دریافت تا زمانی ادامه می‌یابد که دسته‌ای آپدیت
+        جدید نداشته باشد؛ اگر بیش از batch_size آپدیت در صف باشد، بقیه با polling دریافت می‌شوند.
+        """
+        drained = 0
+        while True:
+            updates = self.get_updates(offset=self.last_update_id + 1, limit=batch_size,
+                                       allowed_updates=allowed_updates, long_polling_timeout=0)
+            accepted = self._enqueue(updates) if updates else 0
+            if not accepted:
+                if drained:
+                    logger.info(f"✅ {drained} pending updates drained")
+                return drained
+            drained += accepted
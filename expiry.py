@@ -0,0 +1,146 @@
+"""
+نگهداری داده‌های موقت در حافظه با انقضای هر ورودی، حداکثر اندازه و پاکسازی دوره‌ای
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ExpiringDict:
+    """dict با TTL جداگانه برای هر ورودی و سقف تعداد ورودی‌ها
+
+    زمان انقضای ورودی‌ها در یک heap نگهداری می‌شود؛ sweep فقط ورودی‌های منقضی شده سر
+    heap را برمی‌دارد و هزینه آن به تعداد ورودی‌های منقضی شده بستگی دارد نه کل ورودی‌ها.
+    ورودی منقضی شده هنگام خواندن هم حذف می‌شود. اگر تعداد ورودی‌ها از max_size بیشتر شود
+    ورودی‌هایی که مدت بیشتری set نشده‌اند حذف می‌شوند. تعداد حذف‌ها در stats شمرده می‌شود.
+    """
+
+    def __init__(self, default_ttl: float, max_size: int = 0):
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self._values: Dict[Hashable, Any] = OrderedDict()
+        self._expires: Dict[Hashable, float] = {}
+        self._heap = []  # (زمان انقضا، ترتیب، کلید)؛ ورودی‌های قدیمی هنگام خروج نادیده گرفته می‌شوند
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.stats = {'expired': 0, 'evicted': 0}
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        """ذخیره value با انقضا پس از ttl (یا default_ttl) ثانیه"""
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            self._expires[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, next(self._sequence), key))
+            if self.max_size:
+                while len(self._values) > self.max_size:
+                    self._remove(next(iter(self._values)))
+                    self.stats['evicted'] += 1
+            if len(self._heap) > 2 * len(self._values) + 64:
+                self._compact()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """مقدار ذخیره شده یا default اگر وجود نداشته باشد یا منقضی شده باشد"""
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return default
+        if expires_at <= time.monotonic():
+            with self._lock:
+                if self._expires.get(key) == expires_at:
+                    self._remove(key)
+                    self.stats['expired'] += 1
+            return default
+        return self._values.get(key, default)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """حذف و برگرداندن مقدار"""
+        with self._lock:
+            if key not in self._values:
+                return default
+            return self._remove(key)
+
+    def expires_in(self, key: Hashable) -> Optional[float]:
+        """ثانیه‌های باقی‌مانده تا انقضای key یا None"""
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return None
+        return max(0.0, expires_at - time.monotonic())
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def sweep(self) -> int:
+        """حذف تمام ورودی‌های منقضی شده؛ تعداد حذف شده‌ها را برمی‌گرداند"""
+        removed = 0
+        now = time.monotonic()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, _, key = heapq.heappop(self._heap)
+                if self._expires.get(key) == expires_at:
+                    self._remove(key)
+                    removed += 1
+            self.stats['expired'] += removed
+        return removed
+
+    def _remove(self, key: Hashable) -> Any:
+        del self._expires[key]
+        return self._values.pop(key)
+
+    def _compact(self) -> None:
+        """بازسازی heap بدون ورودی‌های قدیمی کلیدهایی که دوباره ذخیره یا حذف شده‌اند"""
+        self._heap = [(expires_at, next(self._sequence), key) for key, expires_at in self._expires.items()]
+        heapq.heapify(self._heap)
+
+
+class ExpirySweeper:
+    """thread پس‌زمینه که هر interval ثانیه ورودی‌های منقضی شده stores را پاک می‌کند"""
+
+    def __init__(self, stores: Dict[str, Any], interval: float = 60.0):
+        self.stores = stores
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='expiry-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def sweep(self) -> int:
+        """یک دور پاکسازی تمام stores"""
+        total = 0
+        for name, store in self.stores.items():
+            try:
+                removed = store.sweep()
+            except Exception as e:
+                logger.error(f"❌ Error sweeping expired {name}: {e}")
+                continue
+            if removed:
+                logger.info(f"🧹 {removed} expired {name} removed ({len(store)} left)")
+            total += removed
+        return total
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.sweep()
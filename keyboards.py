@@ -0,0 +1,81 @@
+"""
+کیبوردهای inline ساخته شده یک باره با JSON آماده (ثابت‌ها هنگام شروع و پارامتری‌ها در LRU)
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Dict
+
+from telebot.types import InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """کیبورد inline تغییرناپذیر که JSON آن فقط یک بار ساخته می‌شود
+
+    telebot برای هر درخواست to_json را فراخوانی می‌کند؛ این کلاس همان رشته آماده را
+    برمی‌گرداند. چون یک نمونه بین تمام درخواست‌ها مشترک است، افزودن دکمه مجاز نیست.
+    """
+
+    def __init__(self, markup: InlineKeyboardMarkup):
+        super().__init__(keyboard=markup.keyboard, row_width=markup.row_width)
+        self._json = markup.to_json()
+
+    def add(self, *args, **kwargs):
+        raise TypeError("FrozenKeyboard cannot be modified")
+
+    def row(self, *args, **kwargs):
+        raise TypeError("FrozenKeyboard cannot be modified")
+
+    def to_json(self) -> str:
+        return self._json
+
+
+class KeyboardRegistry:
+    """ثبت سازنده‌های کیبورد: ثابت‌ها با static و پارامتری‌ها با cached
+
+    سازنده ثابت (بدون آرگومان) هنگام ثبت یک بار اجرا می‌شود. سازنده پارامتری به ازای
+    هر ترکیب آرگومان (که باید hashable باشند) یک بار اجرا و نتیجه در LRU مشترک با
+    حداکثر cache_size کیبورد نگهداری می‌شود.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self.cache_size = cache_size
+        self.keyboards: Dict[str, FrozenKeyboard] = {}
+        self._cache = OrderedDict()  # {(نام سازنده، آرگومان‌ها): FrozenKeyboard}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def static(self, builder: Callable[[], InlineKeyboardMarkup]):
+        """دکوریتور سازنده کیبورد ثابت"""
+        keyboard = FrozenKeyboard(builder())
+        self.keyboards[builder.__name__] = keyboard
+
+        @wraps(builder)
+        def get_keyboard() -> FrozenKeyboard:
+            return keyboard
+        return get_keyboard
+
+    def cached(self, builder: Callable[..., InlineKeyboardMarkup]):
+        """دکوریتور سازنده کیبورد پارامتری"""
+        @wraps(builder)
+        def get_keyboard(*args) -> FrozenKeyboard:
+            key = (builder.__name__,) + args
+            with self._lock:
+                keyboard = self._cache.get(key)
+                if keyboard is not None:
+                    self._cache.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return keyboard
+                self.stats['misses'] += 1
+            keyboard = FrozenKeyboard(builder(*args))
+            with self._lock:
+                self._cache[key] = keyboard
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                    self.stats['evictions'] += 1
+            return keyboard
+        return get_keyboard
@@ -0,0 +1,322 @@
+"""
+migration های نسخه‌دار schema پایگاه داده
+"""
+
+import logging
+from typing import Callable, List, Tuple
+
+from mysql.connector import errorcode
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+# نام قفل MySQL برای جلوگیری از اجرای همزمان migration توسط چند نمونه ربات
+MIGRATION_LOCK_NAME = 'heshmatbot_schema_migrations'
+
+_TABLE_OPTIONS = 'ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci'
+
+
+def column_exists(cursor, table: str, column: str) -> bool:
+    """بررسی وجود ستون در جدول پایگاه داده جاری"""
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    ''', (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def index_exists(cursor, table: str, index: str) -> bool:
+    """بررسی وجود ایندکس روی جدول پایگاه داده جاری"""
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    ''', (table, index))
+    return cursor.fetchone()[0] > 0
+
+
+def add_column(cursor, table: str, column: str, definition: str) -> None:
+    """افزودن ستون فقط اگر وجود نداشته باشد (برای دیتابیس‌های ساخته شده قبل از migration ها)"""
+    if not column_exists(cursor, table, column):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info(f"✅ Column {table}.{column} added")
+
+
+def create_index(cursor, table: str, index: str, columns: str) -> None:
+    """ایجاد ایندکس فقط اگر وجود نداشته باشد"""
+    if not index_exists(cursor, table, index):
+        cursor.execute(f'CREATE INDEX {index} ON {table}({columns})')
+        logger.info(f"✅ Index {index} created")
+
+
+def _v1_base_tables(cursor) -> None:
+    """جداول اصلی کاربران، پیام‌ها، لاگ‌ها، محصولات، عکس‌ها و سفارش‌ها"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            phone VARCHAR(20),
+            city VARCHAR(100),
+            is_registered BOOLEAN DEFAULT FALSE,
+            join_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
+            message_count INT DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    # ستون‌هایی که در نسخه‌های قدیمی جدول users وجود نداشتند
+    add_column(cursor, 'users', 'phone', 'VARCHAR(20)')
+    add_column(cursor, 'users', 'city', 'VARCHAR(100)')
+    add_column(cursor, 'users', 'is_registered', 'BOOLEAN DEFAULT FALSE')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT,
+            message_text TEXT,
+            message_type VARCHAR(50) DEFAULT 'text',
+            message_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT,
+            action VARCHAR(255),
+            details TEXT,
+            log_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS products (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            price DECIMAL(10,2) NOT NULL,
+            image_url VARCHAR(500),
+            description TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS product_images (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            product_id INT NOT NULL,
+            file_id VARCHAR(255) NOT NULL,
+            file_unique_id VARCHAR(255) NOT NULL,
+            file_size INT,
+            width INT,
+            height INT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            product_id INT NOT NULL,
+            price DECIMAL(10,2) NOT NULL,
+            status ENUM('pending','approved','rejected') DEFAULT 'pending',
+            screenshot_file_id VARCHAR(255),
+            shipping_address TEXT NULL,
+            admin_id BIGINT NULL,
+            rejection_reason TEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            approved_at DATETIME NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    # ستون آدرس ارسال برای سازگاری با پایگاه داده‌های قدیمی
+    add_column(cursor, 'orders', 'shipping_address', 'TEXT NULL')
+
+
+def _v2_base_indexes(cursor) -> None:
+    """ایندکس‌های جستجو و مرتب‌سازی پایه"""
+    create_index(cursor, 'users', 'idx_users_username', 'username')
+    create_index(cursor, 'users', 'idx_users_join_date', 'join_date')
+    create_index(cursor, 'messages', 'idx_messages_user_id', 'user_id')
+    create_index(cursor, 'messages', 'idx_messages_date', 'message_date')
+    create_index(cursor, 'logs', 'idx_logs_date', 'log_date')
+    create_index(cursor, 'orders', 'idx_orders_user_id', 'user_id')
+    create_index(cursor, 'orders', 'idx_orders_status', 'status')
+    create_index(cursor, 'orders', 'idx_orders_created_at', 'created_at')
+
+
+def _v3_keyset_indexes(cursor) -> None:
+    """ایندکس‌های مرکب برای pagination از نوع keyset روی (created_at, id)"""
+    create_index(cursor, 'products', 'idx_products_active_created', 'is_active, created_at, id')
+    create_index(cursor, 'product_images', 'idx_product_images_product_created', 'product_id, created_at, id')
+    create_index(cursor, 'orders', 'idx_orders_status_created', 'status, created_at, id')
+
+
+def _v4_daily_stats(cursor) -> None:
+    """جداول خلاصه آمار روزانه"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            stat_date DATE PRIMARY KEY,
+            new_users INT NOT NULL DEFAULT 0,
+            messages INT NOT NULL DEFAULT 0,
+            active_users INT NOT NULL DEFAULT 0,
+            orders_created INT NOT NULL DEFAULT 0,
+            orders_approved INT NOT NULL DEFAULT 0,
+            orders_rejected INT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) {_TABLE_OPTIONS}
+    ''')
+
+    # کاربران فعال هر روز برای شمارش یکتای active_users
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            stat_date DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            PRIMARY KEY (stat_date, user_id)
+        ) {_TABLE_OPTIONS}
+    ''')
+
+
+def _v5_broadcast_jobs(cursor) -> None:
+    """جدول job های ارسال همگانی با نقطه ادامه برای ادامه پس از ری‌استارت"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            message_text TEXT NOT NULL,
+            status ENUM('running','paused','cancelled','done','failed') NOT NULL DEFAULT 'running',
+            total INT NULL,
+            sent INT NOT NULL DEFAULT 0,
+            failed INT NOT NULL DEFAULT 0,
+            blocked INT NOT NULL DEFAULT 0,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            finished_at DATETIME NULL
+        ) {_TABLE_OPTIONS}
+    ''')
+    create_index(cursor, 'broadcast_jobs', 'idx_broadcast_jobs_status', 'status')
+
+
+def _v6_broadcast_segments(cursor) -> None:
+    """بخش مخاطبان در job های ارسال همگانی و ایندکس‌های پیمایش keyset هر بخش"""
+    add_column(cursor, 'broadcast_jobs', 'segment', "VARCHAR(20) NOT NULL DEFAULT 'all'")
+    add_column(cursor, 'broadcast_jobs', 'segment_value', 'VARCHAR(100) NULL')
+    create_index(cursor, 'users', 'idx_users_active_registered', 'is_active, is_registered, user_id')
+    create_index(cursor, 'users', 'idx_users_active_city', 'is_active, city, user_id')
+    create_index(cursor, 'users', 'idx_users_active_last_activity', 'is_active, last_activity')
+    create_index(cursor, 'orders', 'idx_orders_user_status', 'user_id, status')
+
+
+def _v7_bot_state(cursor) -> None:
+    """مقادیر پایدار وضعیت ربات (مانند آخرین update_id پردازش شده)"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            name VARCHAR(50) PRIMARY KEY,
+            int_value BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) {_TABLE_OPTIONS}
+    ''')
+
+
+def _v8_state_entries(cursor) -> None:
+    """وضعیت مشترک بین پروسه‌های ربات (گفتگوها، session های ادمین و ...) با زمان انقضا"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS state_entries (
+            namespace VARCHAR(32) NOT NULL,
+            state_key VARCHAR(64) NOT NULL,
+            value TEXT NOT NULL,
+            expires_at DOUBLE NOT NULL,
+            PRIMARY KEY (namespace, state_key),
+            INDEX idx_state_entries_expires (namespace, expires_at)
+        ) {_TABLE_OPTIONS}
+    ''')
+
+
+def _v9_active_segment_keyset_index(cursor) -> None:
+    """ایندکس پیمایش keyset بخش active به ترتیب user_id (فیلتر last_activity از خود ایندکس)"""
+    create_index(cursor, 'users', 'idx_users_active_keyset', 'is_active, user_id, last_activity')
+
+
+# فهرست مرتب migration ها: (نسخه، توضیح، تابع). نسخه‌ها فقط اضافه می‌شوند و هرگز تغییر نمی‌کنند.
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, 'base tables', _v1_base_tables),
+    (2, 'base indexes', _v2_base_indexes),
+    (3, 'keyset pagination indexes', _v3_keyset_indexes),
+    (4, 'daily stats rollup', _v4_daily_stats),
+    (5, 'broadcast jobs', _v5_broadcast_jobs),
+    (6, 'broadcast segments', _v6_broadcast_segments),
+    (7, 'bot state', _v7_bot_state),
+    (8, 'shared state entries', _v8_state_entries),
+    (9, 'active segment keyset index', _v9_active_segment_keyset_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor) -> int:
+    """نسخه فعلی schema (صفر اگر جدول schema_version هنوز ساخته نشده باشد)"""
+    try:
+        cursor.execute('SELECT MAX(version) FROM schema_version')
+    except mysql.connector.Error as e:
+        if e.errno == errorcode.ER_NO_SUCH_TABLE:
+            return 0
+        raise
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(conn, lock_timeout: int = 30) -> int:
+    """اعمال migration های باقی‌مانده و برگرداندن تعداد migration های اجرا شده
+
+    اگر schema به‌روز باشد فقط یک SELECT اجرا می‌شود و هیچ DDL ای اجرا نمی‌شود.
+    خطای هر migration منتشر می‌شود و نسخه آن ثبت نمی‌شود تا در اجرای بعدی تکرار شود.
+    """
+    cursor = conn.cursor()
+    try:
+        if current_version(cursor) >= LATEST_VERSION:
+            return 0
+
+        cursor.execute('SELECT GET_LOCK(%s, %s)', (MIGRATION_LOCK_NAME, lock_timeout))
+        if cursor.fetchone()[0] != 1:
+            raise mysql.connector.errors.OperationalError(
+                f"Could not acquire schema migration lock within {lock_timeout}s")
+        try:
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) {_TABLE_OPTIONS}
+            ''')
+
+            # نسخه دوباره خوانده می‌شود چون ممکن است نمونه دیگری در این فاصله migrate کرده باشد
+            version = current_version(cursor)
+            applied = 0
+            for step_version, description, step in MIGRATIONS:
+                if step_version <= version:
+                    continue
+                logger.info(f"🔧 Applying schema migration {step_version}: {description}")
+                step(cursor)
+                cursor.execute('''
+                    INSERT INTO schema_version (version, description) VALUES (%s, %s)
+                ''', (step_version, description))
+                conn.commit()
+                applied += 1
+            return applied
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (MIGRATION_LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
@@ -34,7 +34,7 @@ setup(
     long_description=read_readme(),
     long_description_content_type="text/markdown",
     url="https://github.com/yourusername/heshmatbot",
-    py_modules=["bot", "database"],
+    py_modules=["bot", "broadcast", "callback_router", "catalog_cache", "conversation", "database", "dispatcher", "expiry", "keyboards", "migrations", "state_store", "telegram_gateway", "webhook", "write_behind"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
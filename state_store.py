@@ -0,0 +1,324 @@
+"""
+ذخیره‌سازی وضعیت‌های موقت (گفتگوها، session های ادمین و ...) در حافظه، MySQL یا Redis
+
+تمام store ها رابط ExpiringDict را دارند: get/set/pop، in، len، sweep و stats.
+store حافظه برای یک پروسه کافی است؛ با store های MySQL و Redis چند پروسه ربات (مثلاً
+پشت یک load balancer در حالت webhook) وضعیت مشترک دارند.
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Any, Callable, Hashable, List, Optional
+from urllib.parse import unquote, urlparse
+
+from expiry import ExpiringDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_NOT_CACHED = object()
+
+STATE_BACKENDS = ('memory', 'mysql', 'redis')
+
+
+class RedisError(Exception):
+    """پاسخ خطای سرور Redis"""
+
+
+class RedisClient:
+    """کلاینت ساده پروتکل RESP برای هر سرور سازگار با Redis (بدون وابستگی خارجی)
+
+    یک اتصال مشترک با lock استفاده می‌شود و در صورت قطع شدن، اتصال یک بار دوباره برقرار
+    می‌شود. pipeline چند دستور را با یک رفت و برگشت شبکه اجرا می‌کند.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0,
+                 password: str = None, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 5.0) -> 'RedisClient':
+        """ساخت کلاینت از آدرسی مانند redis://:password@localhost:6379/0"""
+        parsed = urlparse(url)
+        db = parsed.path.lstrip('/')
+        return cls(host=parsed.hostname or 'localhost', port=parsed.port or 6379,
+                   db=int(db) if db else 0,
+                   password=unquote(parsed.password) if parsed.password else None, timeout=timeout)
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._send(setup)
+            for _ in setup:
+                self._read_reply()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._sock:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+    @staticmethod
+    def _encode(command) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b''.join(parts)
+
+    def _send(self, commands) -> None:
+        self._sock.sendall(b''.join(self._encode(command) for command in commands))
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by Redis server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            return RedisError(body.decode('utf-8'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unknown reply type: {line!r}")
+
+    def pipeline(self, *commands) -> List[Any]:
+        """اجرای دستورات به ترتیب و برگرداندن پاسخ‌ها؛ در صورت خطای هر دستور RedisError"""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._send(commands)
+                    replies = [self._read_reply() for _ in commands]
+                    break
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def execute(self, *command):
+        """اجرای یک دستور"""
+        return self.pipeline(command)[0]
+
+
+class MySQLStateStore:
+    """وضعیت‌های یک namespace در جدول state_entries (متدهای state_entry در DatabaseManager)
+
+    سقف تعداد ورودی‌ها اعمال نمی‌شود؛ ورودی‌های منقضی شده با sweep حذف می‌شوند.
+    """
+
+    def __init__(self, db, namespace: str, default_ttl: float,
+                 dumps: Callable[[Any], str] = json.dumps, loads: Callable[[str], Any] = json.loads):
+        self.db = db
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.dumps = dumps
+        self.loads = loads
+        self.stats = {'expired': 0, 'evicted': 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        raw = self.db.get_state_entry(self.namespace, str(key))
+        if raw is None:
+            return default
+        try:
+            return self.loads(raw)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"❌ Invalid state entry {self.namespace}/{key}: {e}")
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        self.db.set_state_entry(self.namespace, str(key), self.dumps(value), expires_at)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        value = self.get(key, default)
+        self.db.delete_state_entry(self.namespace, str(key))
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return self.db.count_state_entries(self.namespace)
+
+    def sweep(self) -> int:
+        removed = self.db.delete_expired_state_entries(self.namespace)
+        self.stats['expired'] += removed
+        return removed
+
+
+class RedisStateStore:
+    """وضعیت‌های یک namespace به صورت کلیدهای Redis با انقضای PX
+
+    شناسه کلیدها در یک sorted set با امتیاز زمان انقضا هم نگهداری می‌شود تا تعداد
+    ورودی‌ها (len) و تعداد منقضی شده‌ها (sweep) بدون SCAN به دست بیاید. خطاهای اتصال
+    ثبت می‌شوند و مانند نبود وضعیت رفتار می‌شوند.
+    """
+
+    def __init__(self, client: RedisClient, namespace: str, default_ttl: float, prefix: str = '',
+                 dumps: Callable[[Any], str] = json.dumps, loads: Callable[[str], Any] = json.loads):
+        self.client = client
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.prefix = f"{prefix}{namespace}:"
+        self.index = f"{prefix}{namespace}"
+        self.dumps = dumps
+        self.loads = loads
+        self.stats = {'expired': 0, 'evicted': 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            raw = self.client.execute('GET', self.prefix + str(key))
+        except (OSError, ConnectionError, RedisError) as e:
+            logger.error(f"❌ Error getting state {self.namespace}/{key} from Redis: {e}")
+            return default
+        if raw is None:
+            return default
+        try:
+            return self.loads(raw.decode('utf-8'))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"❌ Invalid state entry {self.namespace}/{key}: {e}")
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            self.client.pipeline(
+                ('SET', self.prefix + str(key), self.dumps(value), 'PX', max(1, int(ttl * 1000))),
+                ('ZADD', self.index, time.time() + ttl, str(key))
+            )
+        except (OSError, ConnectionError, RedisError) as e:
+            logger.error(f"❌ Error saving state {self.namespace}/{key} to Redis: {e}")
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        value = self.get(key, default)
+        try:
+            self.client.pipeline(('DEL', self.prefix + str(key)), ('ZREM', self.index, str(key)))
+        except (OSError, ConnectionError, RedisError) as e:
+            logger.error(f"❌ Error deleting state {self.namespace}/{key} from Redis: {e}")
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        try:
+            return self.client.execute('ZCOUNT', self.index, f"({time.time()}", '+inf')
+        except (OSError, ConnectionError, RedisError) as e:
+            logger.error(f"❌ Error counting states of {self.namespace} in Redis: {e}")
+            return 0
+
+    def sweep(self) -> int:
+        """حذف شناسه کلیدهایی که Redis خودش منقضی کرده از sorted set"""
+        try:
+            removed = self.client.execute('ZREMRANGEBYSCORE', self.index, '-inf', time.time())
+        except (OSError, ConnectionError, RedisError) as e:
+            logger.error(f"❌ Error sweeping states of {self.namespace} in Redis: {e}")
+            return 0
+        self.stats['expired'] += removed
+        return removed
+
+
+class CachedStateStore:
+    """cache محلی کوتاه‌مدت جلوی یک store مشترک
+
+    خواندن‌ها (از جمله نبود وضعیت، که برای بیشتر پیام‌ها صادق است) حداکثر cache_ttl ثانیه
+    از حافظه پاسخ داده می‌شوند و نوشتن‌ها هم در store و هم در cache اعمال می‌شوند؛ پس
+    تغییری که پروسه دیگری ایجاد کرده حداکثر پس از cache_ttl ثانیه دیده می‌شود.
+    """
+
+    def __init__(self, store, cache_ttl: float = 1.0, cache_size: int = 10000):
+        self.store = store
+        self.cache_ttl = cache_ttl
+        self._cache = ExpiringDict(cache_ttl, max_size=cache_size)
+
+    @property
+    def stats(self):
+        return self.store.stats
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._cache.get(key, _NOT_CACHED)
+        if value is _NOT_CACHED:
+            value = self.store.get(key, _MISSING)
+            self._cache.set(key, value)
+        return default if value is _MISSING else value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        self.store.set(key, value, ttl)
+        self._cache.set(key, value, self.cache_ttl if ttl is None else min(ttl, self.cache_ttl))
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self._cache.set(key, _MISSING)
+        return self.store.pop(key, default)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def sweep(self) -> int:
+        self._cache.sweep()
+        return self.store.sweep()
+
+
+def create_state_store(backend: str, namespace: str, default_ttl: float, max_size: int = 0,
+                       dumps: Callable[[Any], str] = json.dumps, loads: Callable[[str], Any] = json.loads,
+                       db=None, redis: Optional[RedisClient] = None, redis_prefix: str = '',
+                       cache_ttl: float = 1.0, cache_size: int = 10000):
+    """ساخت store یک namespace برای backend ('memory'، 'mysql' یا 'redis')
+
+    dumps/loads فقط برای backend های مشترک استفاده می‌شوند و باید مقدار را به رشته JSON
+    (و برعکس) تبدیل کنند. max_size فقط در backend حافظه اعمال می‌شود.
+    """
+    if backend == 'memory':
+        return ExpiringDict(default_ttl, max_size=max_size)
+    if backend == 'mysql':
+        store = MySQLStateStore(db, namespace, default_ttl, dumps=dumps, loads=loads)
+    elif backend == 'redis':
+        store = RedisStateStore(redis, namespace, default_ttl, prefix=redis_prefix, dumps=dumps, loads=loads)
+    else:
+        raise ValueError(f"Unknown state backend: {backend} (expected one of {', '.join(STATE_BACKENDS)})")
+    if cache_ttl > 0:
+        return CachedStateStore(store, cache_ttl=cache_ttl, cache_size=cache_size)
+    return store
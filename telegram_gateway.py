@@ -0,0 +1,232 @@
+"""
+دروازه خروجی واحد برای تمام درخواست‌های API تلگرام با محدودیت نرخ، رعایت retry_after و اولویت‌بندی
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+import requests
+from telebot import apihelper
+
+from broadcast import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# مسیرهای اولویت (عدد کمتر = اولویت بیشتر)
+PRIORITY_INTERACTIVE = 0  # پاسخ مستقیم به کاربری که همین الان پیام داده یا دکمه زده
+PRIORITY_NOTIFICATION = 1  # اعلان‌ها (تغییر وضعیت سفارش، پیشرفت ارسال همگانی و ...)
+PRIORITY_BROADCAST = 2  # پیام‌های همگانی
+
+# متدهایی که پیامی به چت ارسال نمی‌کنند و مشمول محدودیت نرخ نیستند
+UNTHROTTLED_METHODS = {
+    'getUpdates', 'getMe', 'getFile', 'getWebhookInfo', 'setWebhook', 'deleteWebhook',
+    'answerCallbackQuery', 'getChat', 'getChatMember',
+}
+
+# متدهایی که فقط از محدودکننده سراسری عبور می‌کنند (حذف پیام قبلی نباید به خاطر سهمیه چت رد شود)
+CHAT_UNLIMITED_METHODS = {'deleteMessage'}
+
+
+def is_flood_error(error: Exception) -> bool:
+    """آیا خطا پاسخ 429 (Too Many Requests) تلگرام است"""
+    return getattr(error, 'error_code', None) == 429
+
+
+class PriorityRateLimiter:
+    """محدودکننده نرخ سراسری که توکن‌ها را به ترتیب اولویت (و در هر اولویت به ترتیب ورود) می‌دهد
+
+    فقط درخواستِ سر صف منتظر پر شدن توکن می‌ماند؛ درخواست با اولویت بالاتر که بعداً برسد
+    جلوتر از درخواست‌های منتظر با اولویت پایین‌تر قرار می‌گیرد.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters = []  # heap از (اولویت، ترتیب ورود)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def _take(self) -> float:
+        """برداشتن یک توکن در صورت وجود؛ در غیر این صورت زمان انتظار لازم را برمی‌گرداند"""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    wait = None
+                    if self._waiters[0] == ticket:
+                        wait = self._take()
+                        if wait <= 0:
+                            return
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """توقف تمام درخواست‌ها به مدت seconds (پس از 429 بدون چت مشخص)"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._updated = self._blocked_until
+            self._tokens = 0
+            self._cond.notify_all()
+
+
+class TelegramGateway:
+    """دروازه خروجی تمام فراخوانی‌های API ربات (از طریق apihelper.CUSTOM_REQUEST_SENDER)
+
+    هر درخواست ارسال/ویرایش ابتدا از token bucket همان چت (محدودیت حدود یک پیام در ثانیه برای
+    هر چت) و سپس از محدودکننده سراسری با اولویت عبور می‌کند. درخواست تعاملی حداکثر chat_wait
+    ثانیه برای توکن چت صبر می‌کند تا worker های مشترک dispatcher فقط مدت کوتاه و محدودی متوقف
+    شوند؛ اعلان‌ها (که فراخواننده‌شان شکست را تحمل می‌کند) صبر نمی‌کنند. درخواستی که توکن چت
+    نگیرد ارسال نمی‌شود و پاسخ 429 محلی با retry_after برمی‌گردد. deleteMessage مشمول محدودیت
+    چت نیست. مسیر اولویت با
+    with gateway.lane(PRIORITY_...) برای thread جاری تعیین می‌شود و پیش‌فرض آن تعاملی است.
+
+    در پاسخ 429 همان چت به اندازه retry_after متوقف و پاسخ بدون تکرار برگردانده می‌شود؛ 429
+    بدون چت کل ربات را متوقف می‌کند و اگر retry_after از max_retry_wait بیشتر نباشد درخواست
+    تا max_retries بار خودکار تکرار می‌شود.
+
+    پیام‌های مسیر PRIORITY_BROADCAST فقط از محدودکننده سراسری عبور می‌کنند؛ نرخ، bucket چت‌ها
+    و رسیدگی به 429 آن‌ها بر عهده BroadcastEngine است تا دو لایه همزمان صبر و تکرار نکنند.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 2, max_retry_wait: float = 10, max_chats: int = 10000,
+                 chat_wait: float = 2.0):
+        self.limiter = PriorityRateLimiter(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_wait = chat_wait
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # {chat_id: TokenBucket}
+        self._chats_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {'requests': 0, 'throttled': 0, 'retried': 0, 'rejected': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        """افزایش شمارنده stats (از thread های مختلف)"""
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _acquire_chat(self, chat_id, priority: int) -> float:
+        """برداشتن توکن چت؛ 0 در صورت موفقیت، وگرنه ثانیه‌های لازم تا توکن بعدی"""
+        bucket = self._chat_bucket(chat_id)
+        if priority == PRIORITY_INTERACTIVE and bucket.acquire(timeout=self.chat_wait):
+            return 0
+        return bucket.try_acquire()
+
+    def install(self) -> None:
+        """هدایت تمام درخواست‌های telebot از طریق این دروازه"""
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    @contextmanager
+    def lane(self, priority: int):
+        """تعیین مسیر اولویت درخواست‌های thread جاری داخل بلوک with"""
+        previous = getattr(self._local, 'priority', PRIORITY_INTERACTIVE)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        """token bucket هر چت (با حذف چت‌هایی که مدت‌ها استفاده نشده‌اند)"""
+        with self._chats_lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chats[chat_id] = bucket
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            return bucket
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        """استخراج retry_after از پاسخ 429"""
+        try:
+            return (response.json().get('parameters') or {}).get('retry_after')
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _flood_response(retry_after: float) -> requests.Response:
+        """پاسخ 429 ساختگی (مانند پاسخ تلگرام) برای درخواستی که به دلیل محدودیت چت ارسال نشد"""
+        retry_after = max(1, math.ceil(retry_after))
+        response = requests.Response()
+        response.status_code = 429
+        response.encoding = 'utf-8'
+        response._content = json.dumps({
+            'ok': False,
+            'error_code': 429,
+            'description': f'Too Many Requests: retry after {retry_after} (local chat limit)',
+            'parameters': {'retry_after': retry_after}
+        }).encode('utf-8')
+        return response
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """جایگزین درخواست HTTP داخلی telebot (امضای CUSTOM_REQUEST_SENDER)"""
+        method_name = url.rsplit('/', 1)[-1]
+        throttled = method_name not in UNTHROTTLED_METHODS
+        priority = getattr(self._local, 'priority', PRIORITY_INTERACTIVE)
+        broadcast = priority == PRIORITY_BROADCAST
+        chat_limited = throttled and not broadcast and method_name not in CHAT_UNLIMITED_METHODS
+        chat_id = (params or {}).get('chat_id') if chat_limited else None
+        self._count('requests')
+
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                if chat_id is not None:
+                    wait = self._acquire_chat(chat_id, priority)
+                    if wait > 0:
+                        self._count('rejected')
+                        return self._flood_response(wait)
+                self.limiter.acquire(priority)
+            response = apihelper._get_req_session().request(
+                method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            if response.status_code != 429 or broadcast:
+                # 429 پیام همگانی به BroadcastEngine برمی‌گردد که خودش توقف و تکرار می‌کند
+                return response
+
+            retry_after = self._retry_after(response) or 1
+            self._count('throttled')
+            logger.warning(f"⚠️ Telegram flood limit on {method_name} (chat {chat_id}), retry after {retry_after}s")
+            if chat_id is not None:
+                # توقف همان چت؛ درخواست‌های بعدی آن تا retry_after منتظر می‌مانند یا محلی رد می‌شوند
+                self._chat_bucket(chat_id).pause(retry_after)
+                return response
+            self.limiter.pause(retry_after)
+            if attempt >= self.max_retries or retry_after > self.max_retry_wait or files:
+                # فایل‌های باز شده قابل ارسال دوباره نیستند؛ خطا به فراخواننده برمی‌گردد
+                return response
+            self._count('retried')
+        return response
@@ -0,0 +1,218 @@
+"""
+تست‌های RedisClient و RedisStateStore در برابر یک سرور جایگزین Redis در سطح socket
+"""
+
+import socketserver
+import threading
+import time
+import unittest
+
+from state_store import RedisClient, RedisError, RedisStateStore
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """پیاده‌سازی حداقلی پروتکل RESP برای دستوراتی که state_store استفاده می‌کند"""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line.startswith(b'*'), line
+        args = []
+        for _ in range(int(line[1:])):
+            header = self.rfile.readline()
+            assert header.startswith(b'$'), header
+            args.append(self.rfile.read(int(header[1:]) + 2)[:-2])
+        return args
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        server = self.server
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            server.commands.append(command)
+            name, args = command[0].decode().upper(), command[1:]
+            with server.lock:
+                server.expire_keys()
+                self.wfile.write(server.reply(self, name, args))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expires = {}  # {key: زمان انقضا (epoch)}
+        self.zsets = {}
+        self.commands = []
+
+    def expire_keys(self):
+        now = time.time()
+        for key in [key for key, expires_at in self.expires.items() if expires_at <= now]:
+            self.data.pop(key, None)
+            del self.expires[key]
+
+    def reply(self, handler, name, args):
+        if name == 'PING':
+            return b'+PONG\r\n'
+        if name == 'ECHO':
+            return handler._bulk(args[0])
+        if name == 'SET':
+            self.data[args[0]] = args[1]
+            if len(args) >= 4 and args[2].upper() == b'PX':
+                self.expires[args[0]] = time.time() + int(args[3]) / 1000
+            return b'+OK\r\n'
+        if name == 'GET':
+            return handler._bulk(self.data.get(args[0]))
+        if name == 'MGET':
+            return b'*%d\r\n' % len(args) + b''.join(handler._bulk(self.data.get(key)) for key in args)
+        if name == 'BLPOP':
+            return b'*-1\r\n'
+        if name == 'DEL':
+            removed = sum(1 for key in args if self.data.pop(key, None) is not None)
+            return b':%d\r\n' % removed
+        if name == 'ZADD':
+            self.zsets.setdefault(args[0], {})[args[2]] = float(args[1])
+            return b':1\r\n'
+        if name == 'ZREM':
+            return b':%d\r\n' % (1 if self.zsets.get(args[0], {}).pop(args[1], None) is not None else 0)
+        if name == 'ZCOUNT':
+            low = float(args[1].lstrip(b'('))
+            return b':%d\r\n' % sum(1 for score in self.zsets.get(args[0], {}).values() if score > low)
+        if name == 'ZREMRANGEBYSCORE':
+            zset = self.zsets.get(args[0], {})
+            high = float(args[2])
+            expired = [member for member, score in zset.items() if score <= high]
+            for member in expired:
+                del zset[member]
+            return b':%d\r\n' % len(expired)
+        return b'-ERR unknown command \'%s\'\r\n' % name.encode()
+
+
+class RedisTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.client = RedisClient.from_url(f'redis://127.0.0.1:{self.server.server_address[1]}/0', timeout=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.stop_server()
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class RedisClientTest(RedisTestCase):
+    def test_from_url(self):
+        client = RedisClient.from_url('redis://:p%40ss@example.com:6380/2')
+        self.assertEqual((client.host, client.port, client.db, client.password),
+                         ('example.com', 6380, 2, 'p@ss'))
+
+    def test_encode_command(self):
+        self.assertEqual(RedisClient._encode(('SET', 'k', 'سلام', 'PX', 1500)),
+                         b'*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$8\r\n' + 'سلام'.encode('utf-8')
+                         + b'\r\n$2\r\nPX\r\n$4\r\n1500\r\n')
+
+    def test_simple_string(self):
+        self.assertEqual(self.client.execute('PING'), 'PONG')
+
+    def test_bulk_string_is_binary_safe(self):
+        value = 'خط اول\r\nخط دوم $3 *1'.encode('utf-8')
+        self.assertEqual(self.client.execute('ECHO', value), value)
+        self.assertEqual(self.client.execute('ECHO', ''), b'')
+
+    def test_nil_bulk_string(self):
+        self.assertIsNone(self.client.execute('GET', 'missing'))
+
+    def test_integer(self):
+        self.client.execute('SET', 'a', '1')
+        self.assertEqual(self.client.execute('DEL', 'a', 'b'), 1)
+
+    def test_array_with_nil_element(self):
+        self.client.execute('SET', 'a', 'x')
+        self.assertEqual(self.client.execute('MGET', 'a', 'missing'), [b'x', None])
+
+    def test_nil_array(self):
+        self.assertIsNone(self.client.execute('BLPOP', 'queue', 1))
+
+    def test_error_reply_raises(self):
+        with self.assertRaises(RedisError) as raised:
+            self.client.execute('NOPE')
+        self.assertIn('unknown command', str(raised.exception))
+        # اتصال پس از خطای دستور همچنان قابل استفاده است
+        self.assertEqual(self.client.execute('PING'), 'PONG')
+
+    def test_pipeline_returns_replies_in_order(self):
+        replies = self.client.pipeline(('SET', 'a', '1'), ('GET', 'a'), ('GET', 'b'), ('PING',))
+        self.assertEqual(replies, ['OK', b'1', None, 'PONG'])
+
+    def test_reconnects_after_connection_drop(self):
+        self.client.execute('SET', 'a', '1')
+        self.client._sock.close()
+        self.assertEqual(self.client.execute('GET', 'a'), b'1')
+
+
+class RedisStateStoreTest(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = RedisStateStore(self.client, 'sessions', default_ttl=0.2, prefix='test:')
+
+    def test_set_get_pop(self):
+        self.store.set(7, {'expires': 1.5, 'login_time': 1.0})
+        self.assertEqual(self.store.get(7), {'expires': 1.5, 'login_time': 1.0})
+        self.assertIn(7, self.store)
+        self.assertIn(b'test:sessions:7', self.server.data)
+        self.assertIn(b'7', self.server.zsets[b'test:sessions'])
+        self.assertEqual(self.store.pop(7)['expires'], 1.5)
+        self.assertNotIn(7, self.store)
+        self.assertEqual(self.server.zsets[b'test:sessions'], {})
+
+    def test_ttl_is_sent_in_milliseconds(self):
+        self.store.set(1, 'x', ttl=2.5)
+        set_command = next(command for command in self.server.commands if command[0] == b'SET')
+        self.assertEqual(set_command[3:], [b'PX', b'2500'])
+
+    def test_expiry_through_zset_index(self):
+        self.store.set(1, 'short')
+        self.store.set(2, 'long', ttl=10)
+        self.assertEqual(len(self.store), 2)
+        time.sleep(0.3)
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(self.store.get(2), 'long')
+        # ZCOUNT فقط امتیازهای آینده را می‌شمارد، حتی قبل از sweep
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertEqual(list(self.server.zsets[b'test:sessions']), [b'2'])
+        self.assertEqual(self.store.stats['expired'], 1)
+        self.assertEqual(self.store.sweep(), 0)
+
+    def test_invalid_entry_returns_default(self):
+        self.server.data[b'test:sessions:3'] = b'{not json'
+        self.assertEqual(self.store.get(3, 'default'), 'default')
+
+    def test_connection_errors_behave_as_missing_state(self):
+        self.store.set(1, 'x', ttl=10)
+        self.stop_server()
+        self.client.close()
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.sweep(), 0)
+        self.store.set(1, 'y')  # خطا ثبت می‌شود و منتشر نمی‌شود
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+دریافت آپدیت‌های تلگرام از طریق webhook با یک سرور HTTP داخلی
+"""
+
+import hmac
+import json
+import logging
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """سرور HTTP که آپدیت‌ها را دریافت و به صف‌های محدود پردازش (مانند ChatDispatcher) می‌سپارد
+
+    هر درخواست POST به path باید هدر X-Telegram-Bot-Api-Secret-Token برابر secret_token
+    داشته باشد. submit(update, timeout) آپدیت را در صف قرار می‌دهد و پاسخ بلافاصله داده
+    می‌شود؛ اگر صف تا put_timeout پر بماند پاسخ 503 برمی‌گردد تا تلگرام همان آپدیت را بعداً
+    دوباره بفرستد (فشار برگشتی بدون از دست رفتن آپدیت). بدنه‌های بزرگ‌تر از max_body بایت
+    بدون خواندن با 413 و بدنه‌هایی که آپدیت معتبر نیستند با 400 رد می‌شوند.
+
+    پاسخ 200 برای تلگرام یعنی تحویل قطعی؛ آپدیتی که در صف است ولی هنوز پردازش نشده با crash
+    پروسه از دست می‌رود و offset ذخیره شده در این حالت چیزی را بازیابی نمی‌کند. اگر از دست
+    نرفتن آپدیت‌ها مهم‌تر از تاخیر است، از polling استفاده کنید.
+    """
+
+    def __init__(self, submit: Callable[[Update, float], bool], host: str = '0.0.0.0',
+                 port: int = 8443, path: str = '/webhook', secret_token: str = None,
+                 put_timeout: float = 1.0, ssl_cert: str = None, ssl_key: str = None,
+                 max_body: int = 1024 * 1024):
+        self.submit = submit
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.put_timeout = put_timeout
+        self.ssl_cert = ssl_cert
+        self.ssl_key = ssl_key
+        self.max_body = max_body
+        self._server: Optional[ThreadingHTTPServer] = None
+        self.stats = {'received': 0, 'rejected': 0, 'unauthorized': 0}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._respond(404)
+                    return
+                token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if server.secret_token and not hmac.compare_digest(token, server.secret_token):
+                    server.stats['unauthorized'] += 1
+                    logger.warning(f"⚠️ Webhook request with invalid secret token from {self.client_address[0]}")
+                    self._respond(403)
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.close_connection = True
+                    self._respond(400)
+                    return
+                if length > server.max_body:
+                    # بدنه خوانده نمی‌شود، پس اتصال قابل استفاده دوباره نیست
+                    logger.warning(f"⚠️ Webhook payload too large ({length} bytes) from {self.client_address[0]}")
+                    self.close_connection = True
+                    self._respond(413)
+                    return
+                try:
+                    payload = json.loads(self.rfile.read(length).decode('utf-8'))
+                    if not isinstance(payload, dict):
+                        raise ValueError(f"expected a JSON object, got {type(payload).__name__}")
+                    update = Update.de_json(payload)
+                except Exception as e:
+                    logger.warning(f"⚠️ Invalid webhook payload: {e}")
+                    self._respond(400)
+                    return
+                if server.submit(update, server.put_timeout):
+                    server.stats['received'] += 1
+                    self._respond(200)
+                else:
+                    server.stats['rejected'] += 1
+                    self._respond(503)
+
+            def do_GET(self):
+                self._respond(404)
+
+            def _respond(self, status: int):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # لاگ دسترسی هر درخواست در سطح debug ثبت می‌شود تا bot.log شلوغ نشود
+                logger.debug(f"Webhook {self.address_string()} - {format % args}")
+
+        return Handler
+
+    def start(self) -> None:
+        """راه‌اندازی سرور HTTP (برای اجرا با serve_forever)"""
+        self._server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self._server.daemon_threads = True
+        if self.ssl_cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.ssl_cert, self.ssl_key)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        logger.info(f"✅ Webhook server listening on {self.host}:{self.port}{self.path}")
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        """توقف سرور"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        logger.info("✅ Webhook server stopped")
@@ -0,0 +1,138 @@
+"""
+صف نوشتن پس‌زمینه (write-behind) برای نوشتن‌های کم‌اهمیت دیتابیس
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# هر آیتم صف به شکل (نوع، سطر) است؛ مثلاً ('log', (user_id, action, details, log_date))
+WriteItem = Tuple[str, tuple]
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """جمع‌آوری نوشتن‌ها در یک صف محدود و flush دسته‌ای آن‌ها در یک thread جداگانه
+
+    flush_func لیستی از آیتم‌ها را می‌گیرد و آن‌ها را (معمولاً در یک تراکنش) می‌نویسد.
+    اگر صف پر باشد، put تا put_timeout صبر می‌کند و سپس False برمی‌گرداند تا
+    فراخواننده خودش نوشتن را به صورت همزمان انجام دهد (backpressure بدون از دست رفتن داده).
+    """
+
+    def __init__(self, flush_func: Callable[[List[WriteItem]], None], max_size: int = 10000,
+                 batch_size: int = 500, flush_interval: float = 1.0, put_timeout: float = 0.5,
+                 flush_retries: int = 2):
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.flush_retries = flush_retries
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._stopped = False
+        self.stats = {'enqueued': 0, 'flushed': 0, 'batches': 0, 'rejected': 0, 'failed': 0}
+
+    def start(self) -> None:
+        """شروع thread نویسنده"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='db-write-behind', daemon=True)
+        self._thread.start()
+
+    def put(self, kind: str, row: tuple) -> bool:
+        """افزودن یک نوشتن به صف؛ در صورت پر بودن صف یا توقف نویسنده False برمی‌گرداند"""
+        if self._stopped:
+            return False
+        try:
+            self._queue.put((kind, row), timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            logger.warning("⚠️ Write-behind queue is full; writing synchronously")
+            return False
+        self.stats['enqueued'] += 1
+        return True
+
+    def _run(self) -> None:
+        """حلقه اصلی: جمع کردن دسته تا رسیدن به batch_size یا گذشتن flush_interval"""
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if first is _STOP:
+                self._drain_and_flush()
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            stop_requested = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop_requested = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stop_requested:
+                self._drain_and_flush()
+                return
+
+    def _drain_and_flush(self) -> None:
+        """نوشتن تمام آیتم‌های باقی‌مانده هنگام توقف"""
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch: List[WriteItem]) -> None:
+        """نوشتن یک دسته با چند تلاش محدود"""
+        for attempt in range(self.flush_retries + 1):
+            try:
+                self.flush_func(batch)
+                self.stats['flushed'] += len(batch)
+                self.stats['batches'] += 1
+                return
+            except Exception as e:
+                if attempt >= self.flush_retries:
+                    self.stats['failed'] += len(batch)
+                    logger.error(f"❌ Write-behind flush failed, {len(batch)} writes dropped: {e}")
+                    return
+                logger.warning(f"⚠️ Write-behind flush failed, retrying ({attempt + 1}/{self.flush_retries}): {e}")
+                time.sleep(0.2 * (attempt + 1))
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """توقف نویسنده پس از flush کردن تمام نوشتن‌های باقی‌مانده"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._thread and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning("⚠️ Write-behind writer did not finish flushing in time")
+        else:
+            self._drain_and_flush()
+        logger.info(f"✅ Write-behind queue stopped ({self.stats['flushed']} writes flushed)")